@@ -0,0 +1,1290 @@
+# ===================================================================
+# PRUEBA DE CARGA: UNA PROYECCIÓN COMPLETA CON N ESPECTADORES SIMULADOS
+# ===================================================================
+"""
+Levanta la aplicación en local (uno o varios workers, en una carpeta temporal con su propia base de
+datos) y recorre el ciclo de vida real de una sesión con N clientes de Socket.IO:
+
+    /cartelera -> /vestibulo/<id> -> 'join' al vestíbulo -> 'force_start' del admin
+    -> 'force_start_projection' -> /watch/<id> + 'join' a la sala -> 'sync_pulse'
+    -> ráfagas de chat -> saltos del admin ('state_change') -> desconexión masiva
+
+Con --stress-seconds, antes del chat se mide la sala en reposo y después mientras el admin programa
+sesiones y sube vídeos con póster sin parar: si nada bloquea el hub, el retraso de los pulsos y el
+tiempo de respuesta de los eventos deben quedarse igual en las dos ventanas.
+
+El resultado sale en JSON (stdout o --output) para comparar entre commits: rendimiento, latencias
+p50/p99 por evento, memoria por espectador, desfase entre espectadores, bytes/s por espectador y,
+con --workers 1,2,4, la escala en modo multiproceso (necesita --message-queue, p. ej. redis://).
+
+Con --encoding msgpack (o mixed: uno de cada dos) los espectadores negocian MessagePack como el navegador
+con socket_codec.js; 'wire' compara por formato los bytes recibidos (medidos en el WebSocket) y el tiempo
+de serialización del servidor, junto con los huecos de secuencia que han obligado a pedir el estado completo.
+
+Otras pruebas, cada una de una sola parte de la aplicación, con --scenario:
+
+    scheduler   --sessions proyecciones a la vez: CPU del servidor, tiempo con el cerrojo de cada sesión tomado
+                (peliculas_session_lock_hold_seconds) y retraso del proyeccionista
+    contention  --rooms salas, en reposo y con el chat de una inundado: p99 del tiempo de atención de cada
+                evento y de la ida y vuelta de 'time_sync' en las demás
+    churn       --cycles conexiones, cambios de sala, baneos y desconexiones: el índice inverso sid -> sala
+                (peliculas_socket_memberships) tiene que cuadrar con los que siguen conectados
+    upload      un vídeo de --upload-bytes (4 GiB) por fragmentos: MiB/s y pico de memoria del servidor
+    seek        --seekers clientes pidiendo 'Range: bytes=N-' a la vez, a la misma posición y a posiciones
+                distintas: peticiones/s y latencia p50/p99 de /media
+    chat        --sockets espectadores (5k) en una sala y --chatters escribiendo a la vez: mensajes entregados/s
+                y frames 'new_messages' que ha necesitado el servidor
+    chat-memory --messages mensajes (1M) en --rooms salas dentro de un proceso con la aplicación: el RSS
+                por sesión debe quedarse plano en cuanto se llenan los historiales
+    restart     --sessions proyecciones en marcha, SIGKILL del worker y arranque en caliente: segundos hasta que
+                responde /metrics y hasta tenerlas todas en memoria, y salto de la posición de reproducción
+    instrumentation
+                la misma carga (--viewers en una sala con 'join', 'request_state_sync', 'time_sync', chat y
+                saltos del admin) sin métricas ni logs, con ellos y con LOG_LEVEL=DEBUG, --repeats veces
+                alternando: latencia p50/p99 de cada evento (con acuse) y CPU del servidor, y su sobrecarga
+    routes      --concurrency clientes HTTP pidiendo /cartelera, /admin/snapshot y /vestibulo/<id> durante
+                --measure-seconds con --sessions sesiones en la base de datos y el admin programando más:
+                latencia p50/p99 por ruta, peticiones/s y peliculas_db_query_seconds por operación
+
+Requisitos solo del cliente de pruebas: python-socketio[client] y requests (y msgpack para --encoding).
+
+    python loadtest.py --viewers 100
+    python loadtest.py --viewers 200 --workers 1,2,4 --message-queue redis://localhost:6379/0 --output bench.json
+    python loadtest.py --viewers 50 --stress-seconds 20
+    python loadtest.py --viewers 100 --encoding mixed
+    python loadtest.py --scenario scheduler --sessions 500 --viewers 100
+    python loadtest.py --scenario contention --rooms 50 --viewers 200
+    python loadtest.py --scenario churn --cycles 10000 --viewers 50
+    python loadtest.py --scenario upload --upload-bytes 4294967296
+    python loadtest.py --scenario seek --seekers 500
+    python loadtest.py --scenario chat --sockets 5000 --chatters 100
+    python loadtest.py --scenario chat-memory --messages 1000000 --rooms 50
+    python loadtest.py --scenario restart --sessions 200
+    python loadtest.py --scenario instrumentation --viewers 50 --repeats 3
+    python loadtest.py --scenario routes --sessions 500 --concurrency 64
+"""
+import os
+import re
+import sys
+import json
+import zlib
+import struct
+import time
+import statistics
+import shutil
+import argparse
+import hashlib
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import socketio
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'peliculasv5_refactored.py')
+ADMIN_PASSWORD = '4321'
+MOVIE_TITLE = 'loadtest'
+BASE_PORT = 5100
+STARTUP_TIMEOUT_SECONDS = 30
+PHASE_TIMEOUT_SECONDS = 30
+COUNTDOWN_SECONDS = 5 # La cuenta atrás de start_projection
+TIME_SYNC_ROUNDS = 3
+STRESS_UPLOAD_BYTES = 32 * 1024 * 1024
+STRESS_CHUNK_BYTES = 8 * 1024 * 1024
+STRESS_POSTER_SIZE = (2000, 3000)
+PROBE_INTERVAL_SECONDS = 0.1
+CHAT_MEMORY_SAMPLES = 20
+RESTART_PROBES = 10 # Sesiones de --scenario restart en las que se comprueba la posición antes y después
+INSTRUMENTATION_ROUNDS = 40 # Rondas de eventos de cada espectador en cada pasada de --scenario instrumentation
+INSTRUMENTATION_MODES = {   # Pasada -> entorno del worker; la sobrecarga se calcula respecto a 'off'
+    'off': {'METRICS_ENABLED': '0', 'LOG_LEVEL': 'WARNING'},
+    'on': {'LOG_LEVEL': 'INFO'},    # Lo que corre en producción
+    'debug': {'LOG_LEVEL': 'DEBUG'},
+}
+ROUTE_WRITES_PER_SECOND = 5 # Sesiones que programa el admin durante --scenario routes (escrituras a la vez que las lecturas)
+ENCODINGS = {'json': ('json',), 'msgpack': ('msgpack',), 'mixed': ('json', 'msgpack')} # --encoding -> reparto por espectador
+
+# --- 1. UTILIDADES ---
+def percentile(values, pct):
+    """Percentil por rango más cercano; None si no hay muestras."""
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))]
+
+def summary_ms(values):
+    """p50/p99/máximo en milisegundos de una lista de segundos."""
+    if not values: return {'count': 0}
+    return {'count': len(values), 'p50_ms': round(percentile(values, 50) * 1000, 3),
+            'p99_ms': round(percentile(values, 99) * 1000, 3), 'max_ms': round(max(values) * 1000, 3)}
+
+def cpu_seconds(pid):
+    """Tiempo de CPU (usuario + sistema) de un proceso (Linux, /proc); None si no se puede leer."""
+    try:
+        with open(f'/proc/{pid}/stat') as stat: fields = stat.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def rss_bytes(pid):
+    """Memoria residente de un proceso (Linux, /proc); None si no se puede leer."""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'): return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+def wait_until(condition, timeout=PHASE_TIMEOUT_SECONDS, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition(): return True
+        time.sleep(interval)
+    return condition()
+
+def histogram_summary(before, after):
+    """
+    Lo observado en un histograma de /metrics entre dos lecturas: media y p50/p99 en ms. Los percentiles son
+    la cota superior de su cubeta (None si cae en +Inf).
+    """
+    (buckets0, sum0, count0), (buckets1, sum1, count1) = before, after
+    count = count1 - count0
+    if not count: return {'count': 0}
+    def quantile(q):
+        for le, cumulative in buckets1.items(): # En el orden de /metrics: de menor a mayor
+            if cumulative - buckets0.get(le, 0) >= q * count:
+                return None if le == '+Inf' else round(float(le) * 1000, 3)
+    return {'count': int(count), 'mean_ms': round((sum1 - sum0) / count * 1000, 3), 'p50_le_ms': quantile(0.5), 'p99_le_ms': quantile(0.99)}
+
+def mp4_chunks(size, chunk_bytes, filler, duration=3600):
+    """
+    (offset, trozo) de un MP4 de 'size' bytes: ftyp + moov/mvhd con la duración (basta para el parser MP4 de la
+    aplicación) y un mdat que repite 'filler' (chunk_bytes de ruido). Se genera por trozos: 4 GB no ocupan memoria.
+    """
+    def box(box_type, payload): return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+    mvhd = struct.pack('>B3xIIII', 0, 0, 0, 1000, duration * 1000) + b'\0' * 80
+    header = box(b'ftyp', b'isom\0\0\0\0isom') + box(b'moov', box(b'mvhd', mvhd))
+    header += struct.pack('>I4s', size - len(header), b'mdat') if size < 2 ** 32 else struct.pack('>I4sQ', 1, b'mdat', size - len(header))
+    for offset in range(0, size, chunk_bytes):
+        length = min(chunk_bytes, size - offset)
+        yield offset, (header + filler[:length - len(header)]) if offset == 0 else filler[:length]
+
+def png_file(width, height, tag):
+    """PNG de ruido (caro de decodificar y de redimensionar). 'tag' va en un bloque tEXt: cambia el hash, no la imagen."""
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+    row = os.urandom(width * 3)
+    raw = b''.join(b'\0' + row[y % 7:] + row[:y % 7] for y in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'tEXt', b'loadtest\0' + tag.encode()) + chunk(b'IDAT', zlib.compress(raw, 1)) + chunk(b'IEND', b''))
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(APP_PATH),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# --- 2. SERVIDOR LOCAL ---
+class LocalCluster:
+    """
+    Uno o varios workers de la aplicación sobre la misma carpeta temporal (misma base de datos y vídeos).
+    El primero arranca solo para aplicar las migraciones; los demás se levantan después.
+    """
+    def __init__(self, workers, message_queue, env=None):
+        self.workers = workers
+        self.message_queue = message_queue
+        self.env = env or {} # Variables de entorno extra para los workers (p. ej. LOG_LEVEL)
+        self.folder = tempfile.mkdtemp(prefix='peliculas-loadtest-')
+        self.processes = []
+        self.urls = []
+
+    def __enter__(self):
+        videos = os.path.join(self.folder, 'static', 'videos')
+        os.makedirs(videos)
+        # Sin cabecera válida la duración cae en DEFAULT_MOVIE_DURATION: sobra para toda la prueba
+        with open(os.path.join(videos, f'{MOVIE_TITLE}.mp4'), 'wb') as video: video.write(b'\0' * 1024)
+        for index in range(self.workers):
+            self._spawn(index)
+        return self
+
+    def _spawn(self, index):
+        port = BASE_PORT + index
+        env = dict(os.environ, PORT=str(port), WORKER_ID=f'loadtest-{index}', LOG_LEVEL='WARNING')
+        if self.message_queue: env['SOCKETIO_MESSAGE_QUEUE'] = self.message_queue
+        env.update(self.env)
+        process = subprocess.Popen([sys.executable, APP_PATH], cwd=self.folder, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = f'http://127.0.0.1:{port}'
+        if index < len(self.processes): self.processes[index] = process # Reinicio: el mismo puerto y la misma carpeta
+        else: self.processes.append(process); self.urls.append(url)
+        def ready():
+            if process.poll() is not None: raise RuntimeError(f'El worker {index} ha terminado al arrancar')
+            try: return requests.get(f'{url}/metrics', timeout=1).ok
+            except requests.RequestException: return False
+        if not wait_until(ready, timeout=STARTUP_TIMEOUT_SECONDS, interval=0.2):
+            raise RuntimeError(f'El worker {index} no responde en {url}')
+
+    def __exit__(self, *exc):
+        for process in self.processes: process.terminate()
+        for process in self.processes:
+            try: process.wait(timeout=10)
+            except subprocess.TimeoutExpired: process.kill()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def restart(self, index):
+        """Mata el worker con SIGKILL (como una caída: sin apagado ordenado) y lo vuelve a levantar; devuelve lo que tarda /metrics."""
+        self.processes[index].kill()
+        self.processes[index].wait()
+        started = time.monotonic()
+        self._spawn(index)
+        return time.monotonic() - started
+
+    def rss(self):
+        samples = [rss_bytes(process.pid) for process in self.processes]
+        return None if None in samples else sum(samples)
+
+    def cpu(self):
+        samples = [cpu_seconds(process.pid) for process in self.processes]
+        return None if None in samples else sum(samples)
+
+    def metrics(self):
+        """Texto de /metrics de todos los workers."""
+        return [requests.get(f'{url}/metrics', timeout=5).text for url in self.urls]
+
+    def viewers(self):
+        total = 0
+        for text in self.metrics():
+            total += sum(float(value) for value in re.findall(r'^peliculas_room_viewers\{[^}]*\} (\S+)$', text, re.M))
+        return total
+
+    def socket_event_means(self):
+        """Tiempo medio de atención por evento en el servidor (ms), sumando todos los workers."""
+        sums, counts = {}, {}
+        for text in self.metrics():
+            for event, value in re.findall(r'^peliculas_socket_event_seconds_sum\{event="([^"]+)"\} (\S+)$', text, re.M):
+                sums[event] = sums.get(event, 0) + float(value)
+            for event, value in re.findall(r'^peliculas_socket_event_seconds_count\{event="([^"]+)"\} (\S+)$', text, re.M):
+                counts[event] = counts.get(event, 0) + float(value)
+        return {event: round(sums[event] / counts[event] * 1000, 3) for event in sums if counts.get(event)}
+
+    def counter(self, name, **labels):
+        selector = ','.join(f'{key}="{value}"' for key, value in labels.items())
+        series = re.escape(f'{{{selector}}}') if labels else ''
+        return sum(float(value) for text in self.metrics() for value in re.findall(rf'^{name}{series} (\S+)$', text, re.M))
+
+    def histogram(self, name, **labels):
+        """Cubetas acumuladas {le: cuenta}, suma y total de un histograma, sumando todos los workers."""
+        selector = ''.join(f'{key}="{value}",' for key, value in labels.items())
+        series = re.escape(f'{{{selector.rstrip(",")}}}') if labels else '' # Sin etiquetas, _sum y _count no llevan llaves
+        buckets, total = {}, {'sum': 0.0, 'count': 0.0}
+        for text in self.metrics():
+            for le, value in re.findall(rf'^{name}_bucket\{{{selector}le="([^"]+)"\}} (\S+)$', text, re.M):
+                buckets[le] = buckets.get(le, 0) + float(value)
+            for part in total:
+                match = re.search(rf'^{name}_{part}{series} (\S+)$', text, re.M)
+                if match: total[part] += float(match.group(1))
+        return buckets, total['sum'], total['count']
+
+# --- 3. ESPECTADORES SIMULADOS ---
+class NegotiatedPacket(socketio.packet.Packet):
+    """Como socket_codec.js: envía JSON y decodifica tanto los frames de texto (JSON) como los binarios (MessagePack)."""
+    def decode(self, encoded_packet):
+        if not isinstance(encoded_packet, bytes): return super().decode(encoded_packet)
+        decoded = msgpack.loads(encoded_packet)
+        self.packet_type, self.namespace = decoded['type'], decoded['nsp']
+        self.data, self.id = decoded.get('data'), decoded.get('id')
+        return 0
+
+class CountingClient(socketio.Client):
+    """Cliente que cuenta los bytes de cada mensaje tal como llegan por el WebSocket (sin la cabecera del frame)."""
+    wire_bytes = 0
+
+    def _handle_eio_message(self, data):
+        # En texto va delante el tipo de paquete de Engine.IO ('4'); los frames binarios no lo llevan
+        self.wire_bytes += len(data) if isinstance(data, bytes) else len(data.encode()) + 1
+        super()._handle_eio_message(data)
+
+class Stats:
+    """Muestras compartidas por todos los clientes (los manejadores corren en los hilos de cada cliente)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}  # evento -> [segundos]
+        self.anchors = {}    # server_ts de cada pulso o salto -> [retraso de entrega de cada espectador]
+        self.chat_delivered = 0
+        self.events_received = 0
+        self.state_gaps = 0  # Cambios de estado con hueco en 'seq': el cliente pide el estado completo
+
+    def latency(self, event, seconds):
+        with self.lock: self.latencies.setdefault(event, []).append(seconds)
+
+    def anchor(self, server_ts, delay):
+        with self.lock: self.anchors.setdefault(server_ts, []).append(delay)
+
+class Viewer:
+    def __init__(self, index, url, session_id, stats, headers=None, encoding='json'):
+        self.index = index
+        self.url = url
+        self.session_id = session_id
+        self.stats = stats
+        self.username = f'viewer{index}'
+        self.headers = headers or {}
+        self.encoding = encoding
+        self.http = requests.Session()
+        self.sio = CountingClient(reconnection=False, serializer=NegotiatedPacket)
+        self.state_seq = None
+        self.position = None # (time, server_ts) del último 'room_state'
+        self.newest_message_id = None # Como chat_logic.js: lo que ya llegó en el historial del 'join' no se cuenta otra vez
+        self.clock_offset = 0.0 # Servidor menos cliente, estimado con 'time_sync'
+        self.room = None
+        self.joined = threading.Event()
+        self.moved = threading.Event()
+        self._join_sent = None
+        self._sync_replies = []
+        self._sync_done = threading.Event()
+        self.force_start_at = None
+        for event in ('room_state', 'initial_state', 'force_start_projection', 'sync_pulse', 'state_change', 'play_next_video', 'state_snapshot',
+                      'new_messages', 'time_sync_reply'):
+            self.sio.on(event, self._tracked(getattr(self, f'_on_{event}')))
+        self.sio.on('*', self._on_other)
+
+    def _tracked(self, handler):
+        def tracked(*args):
+            self._count(args)
+            handler(*args)
+        return tracked
+
+    @property
+    def bytes_received(self):
+        return self.sio.wire_bytes
+
+    def _count(self, args):
+        with self.stats.lock: self.stats.events_received += 1
+
+    def _on_other(self, event, *args):
+        self._count(args)
+
+    def connect(self):
+        started = time.perf_counter()
+        self.sio.connect(self.url, headers=self.headers, transports=['websocket'], auth={'encoding': self.encoding},
+                         wait_timeout=PHASE_TIMEOUT_SECONDS)
+        self.stats.latency('connect', time.perf_counter() - started)
+        self.connected_at = time.monotonic()
+
+    def visit(self, path):
+        started = time.perf_counter()
+        response = self.http.get(f'{self.url}{path}', timeout=PHASE_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        self.stats.latency(f'http {path.split("/")[1]}', time.perf_counter() - started)
+
+    def join(self, room):
+        self.room = room
+        self.joined.clear()
+        self._join_sent = time.perf_counter()
+        self.sio.emit('join', {'session_id': self.session_id, 'room_type': room, 'username': self.username})
+
+    def sync_clock(self):
+        for _ in range(TIME_SYNC_ROUNDS):
+            self._sync_done.clear()
+            self.sio.emit('time_sync', {'t0': time.time()})
+            self._sync_done.wait(PHASE_TIMEOUT_SECONDS)
+        # La muestra con menor RTT es la de desfase más fiable
+        rtt, offset = min(self._sync_replies)
+        self.clock_offset = offset
+
+    def chat(self, count):
+        for n in range(count):
+            self.sio.emit('chat_message', {'session_id': self.session_id, 'room_type': self.room,
+                                           'message': f'lt {self.index} {n} {time.time():.6f}'})
+
+    def probe(self, seconds):
+        """Tiempo de ida y vuelta de 'time_sync' cada PROBE_INTERVAL_SECONDS: lo que tarda el hub en atender un evento."""
+        rtts = []
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self._sync_done.clear()
+            sent = time.perf_counter()
+            self.sio.emit('time_sync', {'t0': time.time()})
+            if self._sync_done.wait(PHASE_TIMEOUT_SECONDS): rtts.append(time.perf_counter() - sent)
+            time.sleep(PROBE_INTERVAL_SECONDS)
+        return rtts
+
+    def _on_room_state(self, data):
+        self.state_seq = data['seq']
+        self.position = (data['state']['time'], data['state']['server_ts'])
+
+    def _on_initial_state(self, data):
+        self.stats.latency(f'join {self.room}', time.perf_counter() - self._join_sent)
+        history = data.get('chat_history') or []
+        self.newest_message_id = history[-1]['id'] if history else None
+        self.joined.set()
+
+    def _on_force_start_projection(self, *args):
+        if self.force_start_at: self.stats.latency('force_start_projection', time.time() - self.force_start_at)
+        self.moved.set()
+
+    def _on_sync_pulse(self, data):
+        self._anchor(data)
+
+    def _on_state_change(self, data):
+        # Solo llega lo que ha cambiado; un hueco en 'seq' se resuelve pidiendo el estado completo, como el navegador
+        if self.state_seq is not None and data['seq'] != self.state_seq + 1:
+            with self.stats.lock: self.stats.state_gaps += 1
+            self.sio.emit('request_state_sync', {'session_id': self.session_id})
+        self.state_seq = max(self.state_seq or 0, data['seq'])
+        self._anchor(data['changes'])
+
+    _on_play_next_video = _on_state_change
+
+    def _on_state_snapshot(self, data):
+        self.state_seq = max(self.state_seq or 0, data['seq'])
+
+    def _anchor(self, data):
+        # Retraso de entrega: cuánto ha pasado (en reloj del servidor) desde que se fijó el ancla
+        if 'server_ts' in data:
+            self.stats.anchor(data['server_ts'], time.time() + self.clock_offset - data['server_ts'])
+
+    def _on_new_messages(self, data):
+        now = time.time()
+        for message in data.get('messages', []):
+            if self.newest_message_id is not None and message['id'] <= self.newest_message_id: continue
+            self.newest_message_id = message['id']
+            parts = message.get('text', '').split()
+            if len(parts) == 4 and parts[0] == 'lt':
+                self.stats.latency('chat_message', now - float(parts[3]))
+                with self.stats.lock: self.stats.chat_delivered += 1
+
+    def _on_time_sync_reply(self, data):
+        received = time.time()
+        rtt = (received - data['t0']) - (data['t2'] - data['t1'])
+        self._sync_replies.append((rtt, ((data['t1'] - data['t0']) + (data['t2'] - received)) / 2))
+        self.stats.latency('time_sync', received - data['t0'])
+        self._sync_done.set()
+
+# --- 4. ESCENARIO ---
+def admin_cookie(url):
+    """Cookie de sesión del admin. Es 'Secure', así que requests no la reenvía por http: se pasa a mano."""
+    response = requests.post(f'{url}/login', data={'password': ADMIN_PASSWORD}, allow_redirects=False, timeout=10)
+    cookie = response.cookies.get('session')
+    if not cookie: raise RuntimeError('No se ha podido iniciar sesión como admin')
+    return {'Cookie': f'session={cookie}'}
+
+def schedule_sessions(url, headers, count):
+    """Programa 'count' sesiones con el vestíbulo ya abierto y devuelve los ids de todas las de MOVIE_TITLE."""
+    scheduled = (datetime.now() + timedelta(minutes=5)).isoformat(timespec='minutes')
+    for _ in range(count):
+        requests.post(f'{url}/schedule_session', data={'movie_title': MOVIE_TITLE, 'scheduled_time': scheduled},
+                      headers=headers, allow_redirects=False, timeout=10).raise_for_status()
+    sessions = requests.get(f'{url}/admin/snapshot', headers=headers, timeout=10).json()['sessions']
+    return [s['id'] for s in sessions if s['movie_title'] == MOVIE_TITLE]
+
+def schedule_session(url, headers):
+    return schedule_sessions(url, headers, 1)[0]
+
+def session_statuses(url, headers):
+    """Estado en memoria de cada sesión según el panel de administración."""
+    sessions = requests.get(f'{url}/admin/snapshot', headers=headers, timeout=PHASE_TIMEOUT_SECONDS).json()['sessions']
+    return {s['id']: s.get('current_status_in_memory') for s in sessions}
+
+class StressLoad:
+    """
+    Trabajo pesado del admin contra el primer worker mientras dura la fase: un hilo programa sesiones sin
+    parar y otro sube vídeos por fragmentos, cada uno con un póster grande (hash, sondeo, variantes...).
+    """
+    def __init__(self, url, headers):
+        self.url = url
+        self.headers = headers
+        self.filler = os.urandom(STRESS_CHUNK_BYTES)
+        self.stop = threading.Event()
+        self.scheduled = 0
+        self.uploaded = 0
+        self.errors = 0
+        self._threads = [threading.Thread(target=self._loop, args=(action,), daemon=True) for action in (self._schedule, self._upload)]
+
+    def __enter__(self):
+        for thread in self._threads: thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        for thread in self._threads: thread.join(PHASE_TIMEOUT_SECONDS)
+
+    def _loop(self, action):
+        while not self.stop.is_set():
+            try: action()
+            except requests.RequestException: self.errors += 1
+
+    def _schedule(self):
+        scheduled = (datetime.now() + timedelta(hours=3)).isoformat(timespec='minutes') # Lejos: no abre vestíbulos
+        requests.post(f'{self.url}/schedule_session', data={'movie_title': MOVIE_TITLE, 'scheduled_time': scheduled},
+                      headers=self.headers, allow_redirects=False, timeout=PHASE_TIMEOUT_SECONDS).raise_for_status()
+        self.scheduled += 1
+
+    def _upload(self):
+        name = f'stress-{self.uploaded}'
+        upload_id = upload_movie(self.url, self.headers, f'{name}.mp4', STRESS_UPLOAD_BYTES, self.filler)
+        poster = png_file(*STRESS_POSTER_SIZE, name)
+        requests.post(f"{self.url}/upload/chunked/{upload_id}/poster", files={'poster_file': (f'{name}.png', poster)},
+                      headers=self.headers, timeout=PHASE_TIMEOUT_SECONDS).raise_for_status()
+        self.uploaded += 1
+
+def upload_movie(url, headers, filename, size, filler, chunk_bytes=STRESS_CHUNK_BYTES, on_chunk=None):
+    """
+    Sube por fragmentos (o termina, si había una a medias) un MP4 de mp4_chunks y devuelve su upload_id.
+    on_chunk(segundos, bytes) se llama tras cada PUT.
+    """
+    http = requests.Session()
+    upload = http.post(f'{url}/upload/chunked', json={'filename': filename, 'size': size},
+                       headers=headers, timeout=PHASE_TIMEOUT_SECONDS).json()
+    for offset, chunk in mp4_chunks(size, chunk_bytes, filler):
+        if offset < upload['offset']: continue
+        chunk_headers = dict(headers, **{'Upload-Offset': str(offset), 'X-Chunk-Sha256': hashlib.sha256(chunk).hexdigest()})
+        started = time.perf_counter()
+        http.put(f"{url}/upload/chunked/{upload['upload_id']}", data=chunk, headers=chunk_headers,
+                 timeout=PHASE_TIMEOUT_SECONDS).raise_for_status()
+        if on_chunk: on_chunk(time.perf_counter() - started, len(chunk))
+    return upload['upload_id']
+
+def stress_phase(cluster, headers, viewers, session_id, stats, seconds):
+    """
+    Misma medida con la sala en reposo y con StressLoad en marcha: retraso de los pulsos en el servidor,
+    retraso de entrega de cada ancla y tiempo de respuesta de un evento. Mientras, un espectador informa
+    de desfase cada segundo para que los pulsos no se espacien.
+    """
+    reporter, prober = viewers[0], viewers[-1]
+    done = threading.Event()
+    def report():
+        while not done.wait(1): reporter.sio.emit('sync_report', {'session_id': session_id})
+    threading.Thread(target=report, daemon=True).start()
+
+    def window(load):
+        lateness = cluster.histogram('peliculas_scheduler_lateness_seconds', scheduler='projectionist', kind='pulse')
+        started = time.time()
+        if load:
+            with load: rtts = prober.probe(seconds)
+        else:
+            rtts = prober.probe(seconds)
+        delays = [delay for server_ts, delays in list(stats.anchors.items()) if server_ts >= started for delay in delays]
+        return {'pulse_lateness': histogram_summary(lateness, cluster.histogram('peliculas_scheduler_lateness_seconds',
+                                                                                 scheduler='projectionist', kind='pulse')),
+                'anchor_delivery_delay': summary_ms(delays), 'event_round_trip': summary_ms(rtts)}
+
+    quiet = window(None)
+    load = StressLoad(cluster.urls[0], headers)
+    loaded = window(load)
+    done.set()
+    return {'seconds': seconds, 'quiet': quiet, 'loaded': loaded,
+            'load': {'sessions_scheduled': load.scheduled, 'uploads_completed': load.uploaded,
+                     'upload_bytes': load.uploaded * STRESS_UPLOAD_BYTES, 'errors': load.errors}}
+
+def wire_summary(cluster, viewers, bytes_per_second, stats):
+    """
+    Por formato: bytes/s que recibe cada espectador, bytes entregados y serializaciones del servidor (una por
+    difusión y formato, no por destinatario) con su tiempo medio y total.
+    """
+    result = {'state_gaps': stats.state_gaps}
+    for encoding in sorted({v.encoding for v in viewers}):
+        rates = [rate for v, rate in zip(viewers, bytes_per_second) if v.encoding == encoding]
+        _, encode_seconds, encodes = cluster.histogram('peliculas_socket_encode_seconds', encoding=encoding)
+        result[encoding] = {
+            'viewers': len(rates),
+            'bytes_per_second_per_viewer': round(sum(rates) / len(rates), 1),
+            'server_sent_bytes': int(cluster.counter('peliculas_socket_sent_bytes_total', encoding=encoding)),
+            'server_encodes': int(encodes),
+            'server_encode_mean_us': round(encode_seconds / encodes * 1e6, 2) if encodes else None,
+            'server_encode_total_ms': round(encode_seconds * 1000, 3),
+        }
+    return result
+
+def run_screening(args, workers):
+    stats = Stats()
+    with LocalCluster(workers, args.message_queue) as cluster:
+        headers = admin_cookie(cluster.urls[0])
+        session_id = schedule_session(cluster.urls[0], headers)
+        requests.get(f'{cluster.urls[0]}/vestibulo/{session_id}', timeout=10).raise_for_status() # Abre la sesión
+        baseline_rss = cluster.rss()
+
+        # Sin sesiones pegajosas: cada espectador cae en un worker por turno
+        encodings = ENCODINGS[args.encoding]
+        viewers = [Viewer(i, cluster.urls[i % workers], session_id, stats, encoding=encodings[i % len(encodings)])
+                   for i in range(args.viewers)]
+        admin = Viewer('admin', cluster.urls[0], session_id, Stats(), headers=headers)
+        pool = ThreadPoolExecutor(max_workers=args.concurrency)
+        def each(action):
+            list(pool.map(action, viewers))
+
+        started = time.monotonic()
+        each(lambda v: (v.visit('/cartelera'), v.visit(f'/vestibulo/{session_id}')))
+        each(lambda v: v.connect())
+        each(lambda v: v.sync_clock())
+        each(lambda v: v.join('vestibule'))
+        wait_until(lambda: all(v.joined.is_set() for v in viewers))
+        admin.connect()
+
+        # El admin arranca la proyección; cada espectador pasa a la sala como lo haría el navegador
+        force_start_at = time.time()
+        for v in viewers: v.force_start_at = force_start_at
+        admin.sio.emit('admin_action', {'session_id': session_id, 'action': 'force_start'})
+        wait_until(lambda: all(v.moved.is_set() for v in viewers))
+        each(lambda v: (v.visit(f'/watch/{session_id}'), v.join('watch_room')))
+        wait_until(lambda: all(v.joined.is_set() for v in viewers))
+        peak_rss = cluster.rss()
+
+        # Cuenta atrás y unos cuantos pulsos adaptativos
+        time.sleep(COUNTDOWN_SECONDS + args.pulse_seconds)
+        stress = stress_phase(cluster, headers, viewers, session_id, stats, args.stress_seconds) if args.stress_seconds else None
+
+        chat_started = time.monotonic()
+        each(lambda v: v.chat(args.chat_burst))
+        expected = args.viewers * args.chat_burst * args.viewers
+        wait_until(lambda: stats.chat_delivered >= expected)
+        chat_seconds = time.monotonic() - chat_started
+
+        for n in range(args.seeks):
+            admin.sio.emit('admin_action', {'session_id': session_id, 'action': 'state_change',
+                                            'state': {'time': 60.0 * (n + 1), 'playing': True}})
+            time.sleep(args.seek_interval)
+
+        elapsed = time.monotonic() - started
+        bytes_per_second = [v.bytes_received / (time.monotonic() - v.connected_at) for v in viewers]
+        server_events = cluster.socket_event_means()
+        wire = wire_summary(cluster, viewers, bytes_per_second, stats)
+
+        disconnect_started = time.monotonic()
+        each(lambda v: v.sio.disconnect())
+        wait_until(lambda: cluster.viewers() == 0)
+        disconnect_seconds = time.monotonic() - disconnect_started
+        admin.sio.disconnect()
+        pool.shutdown()
+
+    # Desfase entre espectadores: para cada ancla (pulso o salto), diferencia entre el que la recibe
+    # antes y el que la recibe después; es lo que se separarían si nadie extrapolase con server_ts
+    skews = [max(delays) - min(delays) for delays in stats.anchors.values() if len(delays) > 1]
+    delays = [delay for delays in stats.anchors.values() for delay in delays]
+    return {
+        'workers': workers,
+        'viewers': args.viewers,
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput': {
+            'events_received_per_second': round(stats.events_received / elapsed, 1),
+            'chat_messages_delivered_per_second': round(stats.chat_delivered / chat_seconds, 1) if chat_seconds else None,
+            'chat_delivered': stats.chat_delivered, 'chat_expected': expected,
+        },
+        'latency': {event: summary_ms(values) for event, values in sorted(stats.latencies.items())},
+        'server_event_mean_ms': server_events,
+        'sync': {
+            'anchors': len(stats.anchors),
+            'inter_viewer_skew': summary_ms(skews),
+            'anchor_delivery_delay': summary_ms(delays),
+        },
+        'bytes_per_second_per_viewer': {'mean': round(sum(bytes_per_second) / len(bytes_per_second), 1),
+                                        'max': round(max(bytes_per_second), 1)},
+        'wire': wire,
+        'memory': {
+            'baseline_rss_bytes': baseline_rss, 'peak_rss_bytes': peak_rss,
+            'bytes_per_viewer': round((peak_rss - baseline_rss) / args.viewers) if baseline_rss and peak_rss else None,
+        },
+        'mass_disconnect_seconds': round(disconnect_seconds, 3),
+        'stress': stress,
+    }
+
+def start_projections(url, headers, count, pool):
+    """Programa, abre y arranca 'count' sesiones; devuelve sus ids y el admin conectado que las ha arrancado."""
+    session_ids = schedule_sessions(url, headers, count)
+    list(pool.map(lambda session_id: requests.get(f'{url}/vestibulo/{session_id}', timeout=PHASE_TIMEOUT_SECONDS).raise_for_status(),
+                  session_ids))
+    admin = Viewer('admin', url, None, Stats(), headers=headers)
+    admin.connect()
+    for session_id in session_ids:
+        admin.sio.emit('admin_action', {'session_id': session_id, 'action': 'force_start'})
+    wait_until(lambda: all(status == 'active' for status in session_statuses(url, headers).values()))
+    return session_ids, admin
+
+def run_scheduler(args, workers):
+    """
+    --scenario scheduler: --sessions proyecciones a la vez en un worker, con --viewers espectadores repartidos
+    por sus salas. Con todas en marcha mide durante --measure-seconds la CPU del servidor, cuánto se tiene tomado
+    el cerrojo de cada sesión y el retraso del proyeccionista en pulsos y fines de vídeo (la intro dura 5 s).
+    """
+    stats = Stats()
+    with LocalCluster(1, None) as cluster:
+        url = cluster.urls[0]
+        headers = admin_cookie(url)
+        pool = ThreadPoolExecutor(max_workers=args.concurrency)
+        session_ids, admin = start_projections(url, headers, args.sessions, pool)
+
+        viewers = [Viewer(i, url, session_ids[i % len(session_ids)], stats) for i in range(args.viewers)]
+        list(pool.map(lambda v: (v.connect(), v.join('watch_room')), viewers))
+        wait_until(lambda: all(v.joined.is_set() for v in viewers))
+
+        def sample():
+            return {'cpu': cluster.cpu(),
+                    'lock_hold': cluster.histogram('peliculas_session_lock_hold_seconds'),
+                    'lock_wait': cluster.histogram('peliculas_session_lock_wait_seconds'),
+                    'pulse': cluster.histogram('peliculas_scheduler_lateness_seconds', scheduler='projectionist', kind='pulse'),
+                    'end': cluster.histogram('peliculas_scheduler_lateness_seconds', scheduler='projectionist', kind='end')}
+        before, started = sample(), time.monotonic()
+        time.sleep(args.measure_seconds)
+        after, elapsed = sample(), time.monotonic() - started
+        active = sum(status == 'active' for status in session_statuses(url, headers).values())
+
+        for v in viewers: v.sio.disconnect()
+        admin.sio.disconnect()
+        pool.shutdown()
+
+    cpu = after['cpu'] - before['cpu'] if None not in (before['cpu'], after['cpu']) else None
+    return {
+        'workers': 1,
+        'sessions': len(session_ids), 'sessions_active': active, 'viewers': args.viewers,
+        'measure_seconds': round(elapsed, 3),
+        'cpu': {'seconds': round(cpu, 3), 'percent_of_one_core': round(cpu / elapsed * 100, 1)} if cpu is not None else None,
+        'lock_hold': histogram_summary(before['lock_hold'], after['lock_hold']),
+        'lock_wait': histogram_summary(before['lock_wait'], after['lock_wait']),
+        'scheduler_lateness': {kind: histogram_summary(before[kind], after[kind]) for kind in ('pulse', 'end')},
+        'anchors_received': sum(len(delays) for delays in stats.anchors.values()),
+    }
+
+def run_contention(args, workers):
+    """
+    --scenario contention: --rooms salas con --viewers espectadores repartidos entre ellas. Se mide dos veces
+    durante --measure-seconds, en reposo y mientras los espectadores de la primera sala inundan el chat
+    (--flood-rate mensajes/s cada uno): tiempo de atención en el servidor de cada evento (p99 por cubeta),
+    ida y vuelta de 'time_sync' y retraso de entrega de los pulsos en las demás salas. Con cerrojos por
+    sesión la inundación no debe mover las cifras de las otras salas.
+    """
+    stats, flood_stats = Stats(), Stats()
+    with LocalCluster(1, None) as cluster:
+        url = cluster.urls[0]
+        headers = admin_cookie(url)
+        pool = ThreadPoolExecutor(max_workers=args.concurrency)
+        session_ids, admin = start_projections(url, headers, args.rooms, pool)
+        hot = session_ids[0]
+        viewers = [Viewer(i, url, session_ids[i % len(session_ids)], flood_stats if i % len(session_ids) == 0 else stats)
+                   for i in range(max(args.viewers, 2 * len(session_ids)))]
+        list(pool.map(lambda v: (v.connect(), v.join('watch_room')), viewers))
+        wait_until(lambda: all(v.joined.is_set() for v in viewers))
+        flooders = [v for v in viewers if v.session_id == hot]
+        probers = {v.session_id: v for v in viewers if v.session_id != hot} # Uno por sala fría
+
+        # Un informe de desfase por segundo en cada sala fría: pulsos cada segundo y un evento que toma el cerrojo
+        done = threading.Event()
+        def report():
+            while not done.wait(1):
+                for v in probers.values(): v.sio.emit('sync_report', {'session_id': v.session_id})
+        threading.Thread(target=report, daemon=True).start()
+
+        def flood(v, stop):
+            n = 0
+            while not stop.wait(1 / args.flood_rate):
+                v.sio.emit('chat_message', {'session_id': hot, 'room_type': 'watch_room', 'message': f'flood {v.index} {n}'})
+                n += 1
+
+        def window(flooding):
+            events = ('chat_message', 'sync_report', 'time_sync')
+            before = {event: cluster.histogram('peliculas_socket_event_seconds', event=event) for event in events}
+            started, stop = time.time(), threading.Event()
+            threads = [threading.Thread(target=flood, args=(v, stop), daemon=True) for v in flooders] if flooding else []
+            for thread in threads: thread.start()
+            with ThreadPoolExecutor(max_workers=len(probers)) as probing:
+                rtts = [rtt for result in probing.map(lambda v: v.probe(args.measure_seconds), probers.values()) for rtt in result]
+            stop.set()
+            for thread in threads: thread.join()
+            delays = [delay for server_ts, delays in list(stats.anchors.items()) if server_ts >= started for delay in delays]
+            return {'handler': {event: histogram_summary(before[event], cluster.histogram('peliculas_socket_event_seconds', event=event))
+                                for event in events},
+                    'event_round_trip': summary_ms(rtts), 'anchor_delivery_delay': summary_ms(delays)}
+
+        quiet = window(False)
+        flooded = window(True)
+        done.set()
+        for v in viewers: v.sio.disconnect()
+        admin.sio.disconnect()
+        pool.shutdown()
+
+    return {'workers': 1, 'rooms': len(session_ids), 'viewers': len(viewers), 'flooders': len(flooders),
+            'flood_messages_per_second': args.flood_rate * len(flooders), 'measure_seconds': args.measure_seconds,
+            'quiet': quiet, 'flood': flooded}
+
+def run_churn(args, workers):
+    """
+    --scenario churn: --cycles sockets que se conectan, entran al vestíbulo, la mitad pasan a la sala, uno de
+    cada 100 lo banea el admin y el resto se desconecta, mientras --viewers espectadores siguen conectados todo
+    el rato. Al final el índice inverso (peliculas_socket_memberships) y los contadores de las salas deben
+    coincidir con los que quedan, y volver a cero cuando estos se van.
+    """
+    stats = Stats()
+    with LocalCluster(1, None) as cluster:
+        url = cluster.urls[0]
+        headers = admin_cookie(url)
+        session_id = schedule_session(url, headers)
+        requests.get(f'{url}/vestibulo/{session_id}', timeout=10).raise_for_status()
+        admin = Viewer('admin', url, session_id, Stats(), headers=headers)
+        admin.connect()
+        pool = ThreadPoolExecutor(max_workers=args.concurrency)
+        staying = [Viewer(f'stay{i}', url, session_id, stats) for i in range(args.viewers)]
+        list(pool.map(lambda v: (v.connect(), v.join('vestibule'), v.joined.wait(PHASE_TIMEOUT_SECONDS)), staying))
+        before = {event: cluster.histogram('peliculas_socket_event_seconds', event=event) for event in ('join', 'disconnect')}
+        failures = []
+
+        def cycle(index):
+            v = Viewer(index, url, session_id, stats)
+            try:
+                v.connect()
+                v.join('vestibule')
+                if not v.joined.wait(PHASE_TIMEOUT_SECONDS): raise RuntimeError('sin initial_state')
+                if index % 2:
+                    v.join('watch_room')
+                    if not v.joined.wait(PHASE_TIMEOUT_SECONDS): raise RuntimeError('sin initial_state al cambiar de sala')
+                if index % 100 == 0:
+                    admin.sio.emit('admin_action', {'session_id': session_id, 'room_type': v.room, 'action': 'ban_user',
+                                                    'username': v.username, 'sid': v.sio.get_sid()})
+                    wait_until(lambda: not v.sio.connected, timeout=PHASE_TIMEOUT_SECONDS)
+                v.sio.disconnect()
+            except Exception as e:
+                failures.append(repr(e))
+                v.sio.disconnect()
+
+        started = time.monotonic()
+        list(pool.map(cycle, range(args.cycles)))
+        elapsed = time.monotonic() - started
+
+        def counts():
+            return {'memberships': cluster.counter('peliculas_socket_memberships'), 'room_viewers': cluster.viewers()}
+        wait_until(lambda: counts()['memberships'] == len(staying))
+        with_staying = counts()
+        after = {event: cluster.histogram('peliculas_socket_event_seconds', event=event) for event in before}
+        list(pool.map(lambda v: v.sio.disconnect(), staying))
+        wait_until(lambda: counts()['memberships'] == 0)
+        emptied = counts()
+        admin.sio.disconnect()
+        pool.shutdown()
+
+    return {
+        'workers': 1, 'cycles': args.cycles, 'staying_viewers': len(staying), 'failures': len(failures), 'first_failures': failures[:5],
+        'elapsed_seconds': round(elapsed, 3), 'cycles_per_second': round(args.cycles / elapsed, 1),
+        'latency': {event: summary_ms(values) for event, values in sorted(stats.latencies.items())},
+        'server_handler': {event: histogram_summary(before[event], after[event]) for event in before},
+        'index': {'with_staying_viewers': with_staying, 'after_all_left': emptied,
+                  'consistent': with_staying == {'memberships': len(staying), 'room_viewers': len(staying)}
+                                and emptied == {'memberships': 0, 'room_viewers': 0}},
+    }
+
+def run_upload(args, workers):
+    """
+    --scenario upload: un vídeo de --upload-bytes subido por fragmentos de --chunk-bytes con upload_movie.
+    Mide el rendimiento de extremo a extremo, lo que tarda cada PUT y la memoria del servidor muestreada cada
+    100 ms: con los fragmentos escritos por bloques en su sitio, el pico no debe crecer con el tamaño del fichero.
+    """
+    filename = 'upload-benchmark.mp4'
+    with LocalCluster(1, None) as cluster:
+        url = cluster.urls[0]
+        headers = admin_cookie(url)
+        baseline_rss = peak_rss = cluster.rss()
+        done = threading.Event()
+        def sample():
+            nonlocal peak_rss
+            while not done.wait(0.1): peak_rss = max(peak_rss, cluster.rss() or 0)
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+
+        chunk_seconds = []
+        started = time.monotonic()
+        upload_id = upload_movie(url, headers, filename, args.upload_bytes, os.urandom(args.chunk_bytes), args.chunk_bytes,
+                                 on_chunk=lambda seconds, size: chunk_seconds.append(seconds))
+        elapsed = time.monotonic() - started
+        done.set(); sampler.join()
+        status = requests.get(f'{url}/upload/chunked/{upload_id}', headers=headers, timeout=10).json()
+        path = os.path.join(cluster.folder, 'static', 'videos', filename)
+        stored = os.path.getsize(path) if os.path.exists(path) else None
+
+    return {
+        'workers': 1, 'upload_bytes': args.upload_bytes, 'chunk_bytes': args.chunk_bytes, 'chunks': len(chunk_seconds),
+        'elapsed_seconds': round(elapsed, 3), 'throughput_mib_per_second': round(args.upload_bytes / elapsed / 2 ** 20, 1),
+        'chunk_put': summary_ms(chunk_seconds),
+        'memory': {'baseline_rss_bytes': baseline_rss, 'peak_rss_bytes': peak_rss, 'growth_bytes': peak_rss - baseline_rss},
+        'status': status.get('status'), 'stored_bytes': stored,
+    }
+
+def run_seek(args, workers):
+    """
+    --scenario seek: --seekers clientes HTTP piden a la vez 'Range: bytes=N-' de un vídeo de --media-bytes, como
+    los navegadores de una sala tras un salto del admin. Cada ronda ('same') todos buscan la misma posición (el
+    caso que se agrupa en una sola lectura); en 'scattered' cada uno la suya. Mide peticiones/s y la latencia
+    hasta tener el cuerpo entero.
+    """
+    filename = 'seek-benchmark.mp4'
+    with LocalCluster(1, None) as cluster:
+        url = cluster.urls[0]
+        with open(os.path.join(cluster.folder, 'static', 'videos', filename), 'wb') as video:
+            for _, chunk in mp4_chunks(args.media_bytes, STRESS_CHUNK_BYTES, os.urandom(STRESS_CHUNK_BYTES)): video.write(chunk)
+        sessions = [requests.Session() for _ in range(args.seekers)]
+        barrier = threading.Barrier(args.seekers)
+        pool = ThreadPoolExecutor(max_workers=args.seekers)
+
+        def seek(http, offset):
+            barrier.wait()
+            started = time.perf_counter()
+            response = http.get(f'{url}/media/videos/{filename}', headers={'Range': f'bytes={offset}-'}, timeout=PHASE_TIMEOUT_SECONDS)
+            return response.status_code, len(response.content), time.perf_counter() - started
+
+        def rounds(offsets):
+            results, started = [], time.monotonic()
+            for positions in offsets:
+                results.extend(pool.map(seek, sessions, positions))
+            elapsed = time.monotonic() - started
+            statuses = {}
+            for status, _, _ in results: statuses[str(status)] = statuses.get(str(status), 0) + 1
+            return {'requests': len(results), 'requests_per_second': round(len(results) / elapsed, 1),
+                    'mib_per_second': round(sum(size for _, size, _ in results) / elapsed / 2 ** 20, 1),
+                    'statuses': statuses, 'latency': summary_ms([seconds for _, _, seconds in results])}
+
+        step = args.media_bytes // (args.rounds + 1)
+        same = rounds([[step * (n + 1)] * args.seekers for n in range(args.rounds)])
+        scattered = rounds([[(step * (n + 1) + 7919 * 4096 * i) % args.media_bytes for i in range(args.seekers)]
+                            for n in range(args.rounds)])
+        pool.shutdown()
+        server_rss = cluster.rss()
+
+    return {'workers': 1, 'seekers': args.seekers, 'rounds': args.rounds, 'media_bytes': args.media_bytes,
+            'same': same, 'scattered': scattered, 'server_rss_bytes': server_rss}
+
+def chat_flood_child(rooms, messages, samples):
+    """
+    Proceso hijo de --scenario chat-memory, en la carpeta temporal: importa la aplicación, da de alta 'rooms'
+    sesiones y mete 'messages' mensajes por post_chat_message (el camino de un 'chat_message' sin el límite
+    por usuario). Escribe en stdout, en JSON, el RSS tras cada uno de los 'samples' tramos.
+    """
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    import peliculasv5_refactored as app
+    app.init_db()
+    session_ids = [f'flood-{n}' for n in range(rooms)]
+    for session_id in session_ids:
+        state = {'status': 'active', 'playing': True, 'time': 0, 'current_video_index': 0, 'chat_enabled': True}
+        s_data, _ = app.active_sessions.add(session_id, app.new_session_data(session_id, MOVIE_TITLE, None, [], datetime.now(), state))
+        with app.locked_session(session_id) as s: app.publish_snapshot(s)
+    app.socketio.sleep(1)
+    points = [(0, rss_bytes(os.getpid()))]
+    for n in range(messages):
+        app.post_chat_message(session_ids[n % rooms], {'room_type': 'watch_room', 'sid': f'sid{n % 1000}',
+                                                       'username': f'user{n % 1000}', 'text': f'mensaje {n} de la inundación'})
+        if n % 100 == 99: app.socketio.sleep(0) # Que los envíos agrupados y el guardado del estado sigan su ritmo
+        if (n + 1) % (messages // samples) == 0:
+            app.socketio.sleep(app.CHAT_BATCH_INTERVAL_SECONDS * 2)
+            points.append((n + 1, rss_bytes(os.getpid())))
+    history = sum(len(s_data.chat['watch_room']) for _, s_data in app.active_sessions.items())
+    print(json.dumps({'points': points, 'history_messages': history, 'capacity': app.CHAT_HISTORY_CAPACITY}))
+
+def run_chat_memory(args, workers):
+    """
+    --scenario chat-memory: --messages mensajes de chat repartidos entre --rooms sesiones en un proceso con la
+    aplicación (chat_flood_child). Con el historial en búferes de capacidad fija, el RSS debe quedarse plano en
+    cuanto se llenan: el crecimiento desde ese punto hasta el final, por sesión, tiene que rondar cero.
+    """
+    folder = tempfile.mkdtemp(prefix='peliculas-loadtest-')
+    try:
+        started = time.monotonic()
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--chat-flood-child', '--rooms', str(args.rooms),
+                                '--messages', str(args.messages)], cwd=folder, env=dict(os.environ, LOG_LEVEL='ERROR'),
+                               capture_output=True, text=True, check=True)
+        elapsed = time.monotonic() - started
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    result = json.loads(child.stdout.strip().splitlines()[-1])
+    points = result['points']
+    full = next(rss for sent, rss in points if sent >= args.rooms * result['capacity']) # Todos los búferes llenos
+    return {
+        'workers': 1, 'rooms': args.rooms, 'messages': args.messages, 'elapsed_seconds': round(elapsed, 3),
+        'history_messages_kept': result['history_messages'],
+        'rss_bytes': {str(sent): rss for sent, rss in points},
+        'growth_after_buffers_full_bytes': points[-1][1] - full,
+        'growth_after_buffers_full_per_session_bytes': round((points[-1][1] - full) / args.rooms),
+        'growth_second_half_bytes': points[-1][1] - points[len(points) // 2][1], # Sin el calentamiento del asignador
+    }
+
+def run_chat(args, workers):
+    """
+    --scenario chat: --sockets espectadores en una sola sala y --chatters de ellos mandando --chat-burst mensajes
+    a la vez (dentro de la ráfaga que permite el límite por usuario). Mide mensajes entregados por segundo (cada
+    mensaje cuenta una vez por destinatario) y, del servidor, cuántos frames 'new_messages' han hecho falta y su
+    CPU por entrega. Con los clientes en la misma máquina, la latencia acaba midiendo lo que tardan ellos en leer.
+    """
+    stats = Stats()
+    with LocalCluster(workers, args.message_queue) as cluster:
+        headers = admin_cookie(cluster.urls[0])
+        pool = ThreadPoolExecutor(max_workers=args.concurrency)
+        (session_id,), admin = start_projections(cluster.urls[0], headers, 1, pool)
+        viewers = [Viewer(i, cluster.urls[i % workers], session_id, stats) for i in range(args.sockets)]
+        list(pool.map(lambda v: (v.connect(), v.join('watch_room')), viewers))
+        wait_until(lambda: all(v.joined.is_set() for v in viewers), timeout=PHASE_TIMEOUT_SECONDS * 4)
+        # Los avisos agrupados de las entradas llegan a todos: se espera a que los clientes los terminen de leer
+        def settled():
+            received = stats.events_received
+            time.sleep(1)
+            return stats.events_received == received
+        wait_until(settled, timeout=PHASE_TIMEOUT_SECONDS * 4)
+        rss = cluster.rss()
+        fanout = cluster.histogram('peliculas_emit_fanout', event='new_messages')
+        cpu = cluster.cpu()
+
+        chatters = viewers[:args.chatters]
+        expected = len(chatters) * args.chat_burst * len(viewers)
+        started = time.monotonic()
+        list(pool.map(lambda v: v.chat(args.chat_burst), chatters))
+        wait_until(lambda: stats.chat_delivered >= expected, timeout=PHASE_TIMEOUT_SECONDS * 4)
+        elapsed = time.monotonic() - started
+        _, recipients, frames = cluster.histogram('peliculas_emit_fanout', event='new_messages')
+        frames, recipients = frames - fanout[2], recipients - fanout[1]
+        cpu = cluster.cpu() - cpu
+
+        list(pool.map(lambda v: v.sio.disconnect(), viewers))
+        admin.sio.disconnect()
+        pool.shutdown()
+
+    return {
+        'workers': workers, 'sockets': len(viewers), 'chatters': len(chatters), 'messages_sent': len(chatters) * args.chat_burst,
+        'delivered': stats.chat_delivered, 'expected': expected, 'elapsed_seconds': round(elapsed, 3),
+        'delivered_per_second': round(stats.chat_delivered / elapsed, 1),
+        'latency': summary_ms(stats.latencies.get('chat_message', [])),
+        'server': {'new_messages_frames': int(frames), 'frame_deliveries': int(recipients), 'rss_bytes_with_all_joined': rss,
+                   'cpu_seconds': round(cpu, 3), 'cpu_microseconds_per_delivery': round(cpu / max(stats.chat_delivered, 1) * 1e6, 2)},
+    }
+
+def instrumentation_pass(args, mode):
+    """Una pasada de --scenario instrumentation con el entorno INSTRUMENTATION_MODES[mode]."""
+    stats = Stats()
+    with LocalCluster(1, None, env=INSTRUMENTATION_MODES[mode]) as cluster:
+        url = cluster.urls[0]
+        headers = admin_cookie(url)
+        pool = ThreadPoolExecutor(max_workers=args.concurrency)
+        (session_id,), admin = start_projections(url, headers, 1, pool)
+        viewers = [Viewer(i, url, session_id, stats) for i in range(args.viewers)]
+        list(pool.map(lambda v: (v.connect(), v.join('watch_room')), viewers))
+        wait_until(lambda: all(v.joined.is_set() for v in viewers), timeout=PHASE_TIMEOUT_SECONDS)
+
+        def call(client, event, data):
+            # Con acuse: el servidor responde al terminar el manejador, así se mide ida, atención y vuelta
+            sent = time.perf_counter()
+            client.sio.call(event, data, timeout=PHASE_TIMEOUT_SECONDS)
+            stats.latency(event, time.perf_counter() - sent)
+        def viewer_rounds(v):
+            for n in range(INSTRUMENTATION_ROUNDS):
+                call(v, 'request_state_sync', {'session_id': session_id})
+                call(v, 'time_sync', {'t0': time.time()})
+                call(v, 'chat_message', {'session_id': session_id, 'room_type': 'watch_room', 'message': f'ronda {n}'})
+        def admin_rounds():
+            for n in range(INSTRUMENTATION_ROUNDS):
+                call(admin, 'admin_action', {'session_id': session_id, 'action': 'state_change', 'state': {'time': n * 10}})
+
+        cpu, started = cluster.cpu(), time.monotonic()
+        seeks = pool.submit(admin_rounds)
+        list(pool.map(viewer_rounds, viewers))
+        seeks.result()
+        elapsed, cpu = time.monotonic() - started, cluster.cpu() - cpu
+
+        list(pool.map(lambda v: v.sio.disconnect(), viewers))
+        admin.sio.disconnect()
+        pool.shutdown()
+    stats.latencies['join'] = stats.latencies.pop('join watch_room', [])
+    return cpu, elapsed, stats.latencies
+
+def run_instrumentation(args, workers):
+    """
+    --scenario instrumentation: la misma carga con cada entorno de INSTRUMENTATION_MODES ('off' sin métricas y
+    con LOG_LEVEL=WARNING), --repeats veces y alternando para que el ruido de la máquina caiga en todas igual.
+    Por cada una: la CPU del servidor (mediana de las pasadas) y su sobrecarga respecto a 'off', y p50/p99 de
+    cada evento medidos en el cliente.
+    """
+    passes = {mode: [] for mode in INSTRUMENTATION_MODES}
+    for _ in range(args.repeats):
+        for mode in INSTRUMENTATION_MODES: passes[mode].append(instrumentation_pass(args, mode))
+    events = args.viewers * INSTRUMENTATION_ROUNDS * 3 + INSTRUMENTATION_ROUNDS
+    cpu = {mode: statistics.median(run[0] for run in runs) for mode, runs in passes.items()}
+    modes = {}
+    for mode, runs in passes.items():
+        latencies = {}
+        for _, _, samples in runs:
+            for event, values in samples.items(): latencies.setdefault(event, []).extend(values)
+        modes[mode] = {
+            'env': INSTRUMENTATION_MODES[mode], 'server_cpu_seconds': [round(run[0], 3) for run in runs],
+            'server_cpu_seconds_median': round(cpu[mode], 3),
+            'cpu_microseconds_per_event': round(cpu[mode] / events * 1e6, 1),
+            'cpu_overhead_percent': round((cpu[mode] - cpu['off']) / cpu['off'] * 100, 2) if cpu['off'] else None,
+            'elapsed_seconds_median': round(statistics.median(run[1] for run in runs), 3),
+            'latency': {event: summary_ms(values) for event, values in sorted(latencies.items())},
+        }
+    return {'workers': 1, 'viewers': args.viewers, 'rounds': INSTRUMENTATION_ROUNDS, 'repeats': args.repeats,
+            'events_per_pass': events, 'modes': modes}
+
+def run_routes(args, workers):
+    """
+    --scenario routes: --concurrency clientes HTTP recorren sin pausa las rutas de lectura durante --measure-seconds
+    mientras el admin programa ROUTE_WRITES_PER_SECOND sesiones por segundo. /vestibulo va a una sesión abierta
+    (en memoria) y a otra de mañana (una consulta a la base de datos en cada petición). Mide la latencia por ruta
+    y, del servidor, peliculas_db_query_seconds por operación (la espera del pool incluida).
+    """
+    with LocalCluster(1, None) as cluster:
+        url = cluster.urls[0]
+        headers = admin_cookie(url)
+        open_id = schedule_sessions(url, headers, args.sessions)[0]
+        requests.get(f'{url}/vestibulo/{open_id}', timeout=PHASE_TIMEOUT_SECONDS).raise_for_status() # La abre
+        tomorrow = (datetime.now() + timedelta(days=1)).isoformat(timespec='minutes')
+        requests.post(f'{url}/schedule_session', data={'movie_title': MOVIE_TITLE, 'scheduled_time': tomorrow},
+                      headers=headers, allow_redirects=False, timeout=10).raise_for_status()
+        sessions = requests.get(f'{url}/admin/snapshot', headers=headers, timeout=10).json()['sessions']
+        closed_id = next(s['id'] for s in sessions if s['scheduled_time'].startswith(tomorrow))
+        routes = {'/cartelera': {}, '/admin/snapshot': headers, f'/vestibulo/{open_id}': {}, f'/vestibulo/{closed_id}': {}}
+        names = {f'/vestibulo/{open_id}': '/vestibulo (abierto)', f'/vestibulo/{closed_id}': '/vestibulo (cerrado)'}
+        ops = sorted(set(re.findall(r'^peliculas_db_query_seconds_count\{op="([^"]+)"\}', cluster.metrics()[0], re.M)) | {'query', 'query_one'})
+        before = {op: cluster.histogram('peliculas_db_query_seconds', op=op) for op in ops}
+        cpu = cluster.cpu()
+
+        deadline = time.monotonic() + args.measure_seconds
+        def client(offset):
+            http, results, paths = requests.Session(), [], list(routes)
+            while time.monotonic() < deadline:
+                path = paths[offset % len(paths)]
+                offset += 1
+                started = time.perf_counter()
+                status = http.get(f'{url}{path}', headers=routes[path], allow_redirects=False, timeout=PHASE_TIMEOUT_SECONDS).status_code
+                results.append((path, status, time.perf_counter() - started))
+            return results
+        def writer():
+            results = []
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                status = requests.post(f'{url}/schedule_session', data={'movie_title': MOVIE_TITLE, 'scheduled_time': tomorrow},
+                                       headers=headers, allow_redirects=False, timeout=PHASE_TIMEOUT_SECONDS).status_code
+                results.append(('POST /schedule_session', status, time.perf_counter() - started))
+                time.sleep(max(0, 1 / ROUTE_WRITES_PER_SECOND - (time.perf_counter() - started)))
+            return results
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency + 1) as pool:
+            writes = pool.submit(writer)
+            results = [r for result in pool.map(client, range(args.concurrency)) for r in result] + writes.result()
+        elapsed = time.monotonic() - started
+        cpu = cluster.cpu() - cpu
+        db = {op: histogram_summary(before[op], cluster.histogram('peliculas_db_query_seconds', op=op)) for op in ops}
+
+    per_route = {}
+    for path, status, seconds in results:
+        route = per_route.setdefault(names.get(path, path), {'statuses': {}, 'seconds': []})
+        route['statuses'][str(status)] = route['statuses'].get(str(status), 0) + 1
+        route['seconds'].append(seconds)
+    return {
+        'workers': 1, 'clients': args.concurrency, 'sessions': args.sessions, 'elapsed_seconds': round(elapsed, 3),
+        'requests_per_second': round(len(results) / elapsed, 1),
+        'routes': {name: {'requests_per_second': round(len(route['seconds']) / elapsed, 1), 'statuses': route['statuses'],
+                          'latency': summary_ms(route['seconds'])} for name, route in per_route.items()},
+        'server': {'cpu_seconds': round(cpu, 3), 'db_query_seconds': db},
+    }
+
+def run_restart(args, workers):
+    """
+    --scenario restart: arranca --sessions proyecciones, espera a que live_sessions las tenga guardadas y mata el
+    worker con SIGKILL. Lo levanta en la misma carpeta y puerto y mide hasta que responde /metrics (la restauración
+    va antes de aceptar conexiones) y hasta que peliculas_sessions_in_memory vuelve a contarlas todas. En
+    RESTART_PROBES sesiones compara la posición de 'room_state' con la esperada: la de antes más el tiempo pasado.
+    """
+    def positions(url, session_ids):
+        found = {}
+        for session_id in session_ids:
+            probe = Viewer(f'probe-{session_id}', url, session_id, Stats())
+            probe.connect(); probe.join('watch_room')
+            if wait_until(probe.joined.is_set, timeout=PHASE_TIMEOUT_SECONDS): found[session_id] = probe.position
+            probe.sio.disconnect()
+        return found
+
+    with LocalCluster(1, None) as cluster:
+        url = cluster.urls[0]
+        headers = admin_cookie(url)
+        pool = ThreadPoolExecutor(max_workers=args.concurrency)
+        session_ids, admin = start_projections(url, headers, args.sessions, pool)
+        pool.shutdown()
+        admin.sio.disconnect()
+        time.sleep(COUNTDOWN_SECONDS + 2) # Fin de la cuenta atrás y al menos un guardado de live_state tras ella
+        before = positions(url, session_ids[:RESTART_PROBES])
+
+        serving = cluster.restart(0)
+        started = time.monotonic() - serving
+        wait_until(lambda: cluster.counter('peliculas_sessions_in_memory') >= len(session_ids), timeout=PHASE_TIMEOUT_SECONDS)
+        in_memory = time.monotonic() - started
+        restored = cluster.counter('peliculas_sessions_in_memory')
+        statuses = session_statuses(url, headers)
+        after = positions(url, list(before))
+
+    drift = [(after[i][0] - before[i][0]) - (after[i][1] - before[i][1]) for i in before if i in after]
+    return {
+        'workers': 1, 'sessions': len(session_ids), 'restart_to_metrics_seconds': round(serving, 3),
+        'restart_to_all_in_memory_seconds': round(in_memory, 3), 'sessions_in_memory': int(restored),
+        'sessions_active': sum(statuses.get(session_id) == 'active' for session_id in session_ids),
+        'position_probes': len(drift),
+        'position_drift_ms': {'max_abs': round(max(map(abs, drift)) * 1000, 1) if drift else None,
+                              'mean': round(sum(drift) / len(drift) * 1000, 1) if drift else None},
+    }
+
+SCENARIOS = {'screening': run_screening, 'scheduler': run_scheduler, 'contention': run_contention, 'churn': run_churn,
+             'upload': run_upload, 'seek': run_seek, 'chat-memory': run_chat_memory, 'chat': run_chat,
+             'routes': run_routes, 'restart': run_restart,
+             'instrumentation': run_instrumentation}
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga de una proyección completa.')
+    parser.add_argument('--viewers', type=int, default=50)
+    parser.add_argument('--workers', default='1', help='Lista de workers a probar, p. ej. 1,2,4')
+    parser.add_argument('--message-queue', default=os.environ.get('SOCKETIO_MESSAGE_QUEUE'),
+                        help='Cola de mensajes de Socket.IO; obligatoria con más de un worker')
+    parser.add_argument('--concurrency', type=int, default=32, help='Clientes que actúan a la vez en cada fase')
+    parser.add_argument('--pulse-seconds', type=float, default=8, help='Tiempo de reproducción recibiendo pulsos')
+    parser.add_argument('--chat-burst', type=int, default=3, help='Mensajes por espectador (el límite es una ráfaga de 5)')
+    parser.add_argument('--seeks', type=int, default=3)
+    parser.add_argument('--seek-interval', type=float, default=1)
+    parser.add_argument('--stress-seconds', type=float, default=0,
+                        help='Duración de cada ventana (reposo y carga) de la fase de estrés; 0 la desactiva')
+    parser.add_argument('--encoding', choices=sorted(ENCODINGS), default='json',
+                        help='Formato que negocian los espectadores; mixed reparte JSON y MessagePack a partes iguales')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='screening',
+                        help='screening: la proyección completa; el resto son pruebas de una sola parte (ver el docstring)')
+    parser.add_argument('--sessions', type=int, default=500, help='Sesiones simultáneas (--scenario scheduler, routes, restart)')
+    parser.add_argument('--cycles', type=int, default=10000, help='Conexiones y desconexiones (--scenario churn)')
+    parser.add_argument('--upload-bytes', type=int, default=4 * 1024 ** 3, help='Tamaño del vídeo (--scenario upload)')
+    parser.add_argument('--chunk-bytes', type=int, default=STRESS_CHUNK_BYTES, help='Tamaño de cada fragmento (--scenario upload)')
+    parser.add_argument('--seekers', type=int, default=500, help='Clientes que buscan a la vez (--scenario seek)')
+    parser.add_argument('--rounds', type=int, default=5, help='Búsquedas de cada cliente por modo (--scenario seek)')
+    parser.add_argument('--media-bytes', type=int, default=512 * 1024 ** 2, help='Tamaño del vídeo servido (--scenario seek)')
+    parser.add_argument('--messages', type=int, default=1000000, help='Mensajes de la inundación (--scenario chat-memory)')
+    parser.add_argument('--chat-flood-child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--sockets', type=int, default=5000, help='Espectadores en la sala (--scenario chat)')
+    parser.add_argument('--chatters', type=int, default=100, help='Espectadores que escriben (--scenario chat)')
+    parser.add_argument('--rooms', type=int, default=50, help='Salas (--scenario contention)')
+    parser.add_argument('--repeats', type=int, default=3, help='Pasadas de cada modo (--scenario instrumentation)')
+    parser.add_argument('--flood-rate', type=float, default=20, help='Mensajes/s de cada espectador de la sala inundada')
+    parser.add_argument('--measure-seconds', type=float, default=30, help='Ventana de medida de las pruebas de una sola parte')
+    parser.add_argument('--output', help='Fichero JSON de resultados (por defecto, stdout)')
+    args = parser.parse_args()
+    if args.chat_flood_child: return chat_flood_child(args.rooms, args.messages, CHAT_MEMORY_SAMPLES)
+
+    worker_counts = [int(count) for count in args.workers.split(',')]
+    if max(worker_counts) > 1 and not args.message_queue:
+        parser.error('con más de un worker hace falta --message-queue (p. ej. redis://localhost:6379/0)')
+    if args.encoding != 'json' and msgpack is None:
+        parser.error(f'--encoding {args.encoding} necesita el paquete msgpack')
+
+    runs = [SCENARIOS[args.scenario](args, workers) for workers in worker_counts]
+    result = {'revision': git_revision(), 'timestamp': datetime.now().isoformat(timespec='seconds'),
+              'parameters': vars(args), 'runs': runs}
+    if len(runs) > 1 and args.scenario == 'screening':
+        base = runs[0]['throughput']['events_received_per_second']
+        result['scaling'] = {str(run['workers']): round(run['throughput']['events_received_per_second'] / base, 2) for run in runs}
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f: f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
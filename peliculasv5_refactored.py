@@ -6,20 +6,57 @@ eventlet.monkey_patch()
 
 # Ahora sí, el resto de las importaciones
 import os
+import sys
+import atexit
 import uuid
 import json
+import bisect
+import logging
+import functools
 import sqlite3
 import threading
 import time
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-from flask_socketio import SocketIO, join_room, leave_room, emit, disconnect
+import heapq
+import itertools
+import struct
+import hashlib
+import mimetypes
+import tempfile
+import multiprocessing
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from eventlet import tpool
+from eventlet.event import Event
+from eventlet.green import subprocess
+from eventlet.queue import LightQueue, PriorityQueue
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_file, abort, Response
+from flask_socketio import SocketIO, join_room, leave_room, emit
+from socketio import Manager, RedisManager, KafkaManager, ZmqManager, KombuManager, packet as sio_packet
+from engineio import packet as eio_packet
 from werkzeug.utils import secure_filename
-from moviepy import VideoFileClip
+from werkzeug.security import safe_join
+from moviepy.config import FFMPEG_BINARY
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+import poster_worker
+try:
+    from socketio.msgpack_packet import MsgPackPacket # Necesita msgpack; sin él todos los clientes reciben JSON
+except ImportError:
+    MsgPackPacket = None
+
+# Cola e hilos del sistema sin parchear, para el escritor de logs (fuera del hub de eventlet)
+_os_queue = eventlet.patcher.original('queue')
+_os_threading = eventlet.patcher.original('threading')
 
 # --- 1. CONFIGURACIÓN ---
 UPLOAD_FOLDER = 'static/videos'
 ASSETS_FOLDER = 'static/assets'
+HLS_FOLDER = 'static/hls'
+POSTERS_FOLDER = 'static/posters'
+POSTER_VARIANTS_FOLDER = 'static/posters/variants'
 DATABASE_FILE = 'cinesa_schedule.db'
 INTRO_VIDEO = 'assets/intro.mp4'
 OUTRO_VIDEO = 'assets/outro.mp4'
@@ -31,6 +68,145 @@ STATUS_FINISHED = 'finished'
 VESTIBULE_OPEN_MINUTES = 15
 POST_SHOW_CLOSE_MINUTES = 5
 EMPTY_ROOM_CLOSE_MINUTES = 10
+SESSION_ARCHIVE_AFTER_HOURS = 24 # Las sesiones finalizadas pasan a sessions_archive pasado este tiempo
+SESSION_ARCHIVE_SWEEP_SECONDS = 600
+SCHEDULE_RESYNC_SECONDS = 60 # Relectura de las sesiones programadas (p. ej. las creadas por otro worker)
+PULSE_INTERVAL_SECONDS = 1 # Intervalo tras cada cambio de estado; se duplica mientras nadie informe de desfase
+PULSE_MAX_INTERVAL_SECONDS = 30
+CHAT_HISTORY_CAPACITY = 500
+CHAT_JOIN_HISTORY = 50
+CHAT_PAGE_SIZE = 50
+CHAT_BATCH_INTERVAL_SECONDS = 0.1
+CHAT_RATE_PER_SECOND = 1
+CHAT_RATE_BURST = 5
+ADMIN_FEED_INTERVAL_SECONDS = 0.5
+DEFAULT_MOVIE_DURATION = 3600
+UPLOAD_IN_PROGRESS = 'uploading'
+UPLOAD_COMPLETE = 'complete'
+UPLOAD_CHUNK_MAX_BYTES = 64 * 1024 * 1024
+UPLOAD_STREAM_BLOCK_BYTES = 1024 * 1024
+MEDIA_FOLDERS = {'videos': UPLOAD_FOLDER, 'assets': ASSETS_FOLDER, 'hls': HLS_FOLDER, 'posters': POSTER_VARIANTS_FOLDER}
+MEDIA_RANGE_CACHE_BYTES = 64 * 1024 * 1024
+MEDIA_COALESCE_MAX_RANGE_BYTES = 4 * 1024 * 1024
+MEDIA_RANGE_BLOCK_BYTES = 2 * 1024 * 1024 # Unidad de lectura y de caché; un rango abierto ('bytes=N-') acaba en el final de su bloque
+MEDIA_STREAM_BLOCK_BYTES = 256 * 1024
+MEDIA_MAX_AGE_SECONDS = 300
+IMMUTABLE_MAX_AGE_SECONDS = 365 * 24 * 3600
+IMMUTABLE_MEDIA_FOLDERS = {'hls', 'posters'} # Nombres por hash de contenido: un fichero nunca cambia
+HLS_SEGMENT_SECONDS = 6
+TRANSCODE_WORKERS = 2
+POSTER_WORKERS = 2
+POSTER_WIDTHS = (160, 320, 640) # Miniatura del panel, tarjeta de la cartelera y su versión para pantallas de alta densidad
+POSTER_QUALITY = 80
+JOB_QUEUED = 'queued'
+JOB_HASHING = 'hashing'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+DB_POOL_SIZE = 4
+DB_STATEMENT_CACHE_SIZE = 256
+DB_BUSY_TIMEOUT_SECONDS = 10
+DB_WRITE_BATCH_SECONDS = 0.05
+LIVE_STATE_FLUSH_SECONDS = 1 # Como mucho un guardado por segundo de cada sesión en directo
+# Modo multiproceso: con cola de mensajes (p. ej. redis://localhost:6379/0) varios workers comparten salas y sesiones
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+WORKER_ID = os.environ.get('WORKER_ID') or f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+PORT = int(os.environ.get('PORT', 5000))
+MAX_CONNECTIONS = int(os.environ.get('MAX_CONNECTIONS', 10000)) # Sockets y peticiones a la vez por worker; eventlet.wsgi acepta 1024 por defecto
+CLUSTER_LEASE_SECONDS = 6
+CLUSTER_RENEW_SECONDS = 2
+CLUSTER_REPLICA_REFRESH_SECONDS = 1
+CLUSTER_COMMAND_POLL_SECONDS = 0.1
+CLUSTER_CARTELERA_TTL_SECONDS = 2 # Las invalidaciones de otros workers no llegan: la cartelera caduca sola
+JOB_STALE_SECONDS = 300 # Un trabajo 'running' sin progreso en este tiempo se da por abandonado
+LANE_IO = 'io'   # E/S bloqueante (ficheros, fsync, hashes) en hilos del sistema
+LANE_CPU = 'cpu' # Trabajo de CPU (Pillow) en procesos aparte
+BACKGROUND_IO_WORKERS = 8 # Menos que los hilos de tpool (20): a las consultas siempre les quedan hilos libres
+BACKGROUND_CPU_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+BACKGROUND_TASK_HISTORY = 50
+TASK_PRIORITY_HIGH = 0   # Hay una petición esperando (guardar una subida, sondear un vídeo)
+TASK_PRIORITY_NORMAL = 1
+TASK_PRIORITY_LOW = 2    # Procesado de fondo (hashes de vídeos, variantes de pósters)
+ENCODING_JSON = 'json'
+ENCODING_MSGPACK = 'msgpack' # Binario y más compacto; cada cliente lo pide al conectar (auth.encoding)
+STATE_SEQ_TAKEOVER_GAP = 1000 # Salto de 'seq' al tomar una sesión: los clientes ven el hueco y piden el estado completo
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0' # Con 0 las métricas no registran nada (para medir lo que cuestan)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+FANOUT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# --- Codificación de los paquetes de Socket.IO ---
+class NegotiatedManager(Manager):
+    """
+    Gestor de clientes que codifica cada difusión una sola vez por formato, no una vez por destinatario:
+    JSON para los clientes normales y MessagePack para los que lo pidieron al conectar. Los paquetes de
+    control (CONNECT, ACK...) y lo que envían los clientes siguen siendo JSON.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.encodings = {} # sid -> ENCODING_MSGPACK; los que no están reciben JSON
+
+    def negotiate(self, sid, encoding):
+        if encoding == ENCODING_MSGPACK and MsgPackPacket: self.encodings[sid] = encoding
+
+    def forget(self, sid):
+        self.encodings.pop(sid, None)
+
+    def _encode(self, encoding, event, data, namespace):
+        """Paquetes de Engine.IO ya serializados (la caché de encode() los reutiliza en cada envío) y su tamaño."""
+        packet_class = MsgPackPacket if encoding == ENCODING_MSGPACK else self.server.packet_class
+        with SOCKET_ENCODE_SECONDS.time(encoding):
+            encoded = packet_class(sio_packet.EVENT, namespace=namespace, data=[event] + data).encode()
+            packets = [eio_packet.Packet(eio_packet.MESSAGE, p) for p in (encoded if isinstance(encoded, list) else [encoded])]
+            size = sum(len(p.encode()) for p in packets)
+        return packets, size
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        if callback or namespace not in self.rooms: # Con callback cada paquete lleva su id: no se comparte
+            return super().emit(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, to=to, **kwargs)
+        data = list(data) if isinstance(data, tuple) else [] if data is None else [data]
+        skip = set(skip_sid) if isinstance(skip_sid, list) else {skip_sid}
+        encoded, sent = {}, {}
+        for sid, eio_sid in self.get_participants(namespace, to or room):
+            if sid in skip: continue
+            encoding = self.encodings.get(sid, ENCODING_JSON)
+            if encoding not in encoded: encoded[encoding] = self._encode(encoding, event, data, namespace)
+            for p in encoded[encoding][0]: self.server._send_eio_packet(eio_sid, p)
+            sent[encoding] = sent.get(encoding, 0) + 1
+        for encoding, recipients in sent.items():
+            SOCKET_SENT_BYTES.inc(encoding, amount=encoded[encoding][1] * recipients)
+
+    def emit_cached(self, cached, to, namespace='/'):
+        """Envía un CachedEmit a un socket de este worker; cada formato se codifica solo la primera vez."""
+        eio_sid = self.eio_sid_from_sid(to, namespace)
+        if eio_sid is None: return
+        encoding = self.encodings.get(to, ENCODING_JSON)
+        if encoding not in cached.packets: cached.packets[encoding] = self._encode(encoding, cached.event, [cached.data], namespace)
+        packets, size = cached.packets[encoding]
+        for p in packets: self.server._send_eio_packet(eio_sid, p)
+        SOCKET_SENT_BYTES.inc(encoding, amount=size)
+
+class CachedEmit:
+    """Evento que se envía tal cual a muchos sockets sueltos (cada 'join'): guarda sus paquetes ya codificados por formato."""
+    __slots__ = ('event', 'data', 'packets')
+
+    def __init__(self, event, data):
+        self.event = event
+        self.data = data
+        self.packets = {} # encoding -> (paquetes de Engine.IO, tamaño)
+
+def negotiated_client_manager(url):
+    """
+    El gestor que SocketIO crearía para SOCKETIO_MESSAGE_QUEUE, con NegotiatedManager debajo: lo que llega
+    por la cola desde otros workers también se codifica una vez por formato en cada uno.
+    """
+    if not url: return NegotiatedManager()
+    if url.startswith(('redis://', 'rediss://')): queue_class = RedisManager
+    elif url.startswith('kafka://'): queue_class = KafkaManager
+    elif url.startswith('zmq'): queue_class = ZmqManager
+    else: queue_class = KombuManager
+    manager_class = type(f'Negotiated{queue_class.__name__}', (queue_class, NegotiatedManager), {})
+    return manager_class(url, channel='flask-socketio')
 
 # --- App Initialization ---
 app = Flask(__name__)
@@ -38,21 +214,692 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'este-es-el-secreto-defi
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['SESSION_COOKIE_SAMESITE'] = 'None'
 app.config['SESSION_COOKIE_SECURE'] = True
-socketio = SocketIO(app, async_mode='eventlet')
+# Con un proxy delante (Apache/lighttpd, o nginx con su módulo) los vídeos se envían con sendfile desde el propio proxy
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+socketio = SocketIO(app, async_mode='eventlet', client_manager=negotiated_client_manager(SOCKETIO_MESSAGE_QUEUE))
+
+# --- Registro (logs) ---
+class BackgroundLogHandler(logging.Handler):
+    """
+    Handler no bloqueante: quien registra solo formatea la línea y la deja en una cola; un hilo real
+    del sistema (no un greenlet) la escribe en el flujo, así que la E/S de los logs nunca para el hub.
+    """
+    def __init__(self, stream):
+        super().__init__()
+        self._stream = stream
+        self._lines = _os_queue.SimpleQueue()
+        _os_threading.Thread(target=self._drain, name='log-writer', daemon=True).start()
+
+    def emit(self, record):
+        try: self._lines.put(self.format(record) + '\n')
+        except Exception: self.handleError(record)
+
+    def _drain(self):
+        while True:
+            line = self._lines.get()
+            try:
+                self._stream.write(line)
+                self._stream.flush()
+            except Exception: pass # Sin salida no hay dónde avisar
+
+logger = logging.getLogger('peliculas')
+_log_handler = BackgroundLogHandler(sys.stderr)
+_log_handler.setFormatter(logging.Formatter('%(asctime)s level=%(levelname)s component=%(name)s %(message)s'))
+logger.addHandler(_log_handler)
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+db_log = logger.getChild('db')
+media_log = logger.getChild('media')
+transcode_log = logger.getChild('transcode')
+projection_log = logger.getChild('projectionist')
+session_log = logger.getChild('session')
+cluster_log = logger.getChild('cluster')
+monitor_log = logger.getChild('monitor')
+upload_log = logger.getChild('upload')
+poster_log = logger.getChild('posters')
+socket_log = logger.getChild('socket')
+admin_log = logger.getChild('admin')
+
+# --- Métricas (formato de texto de Prometheus) ---
+class Metric:
+    """
+    Métrica con etiquetas, sin cerrojos: los greenlets solo ceden en E/S, así que las actualizaciones
+    (que nunca hacen E/S) son atómicas entre ellos. Solo se actualizan desde el lado de eventlet, nunca desde tpool.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._series = {}
+        metrics.append(self)
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs: return ''
+        return '{' + ','.join(f'{key}="{str(value)}"' for key, value in pairs) + '}'
+
+    def samples(self):
+        for values, value in self._series.items():
+            yield self.name, self._label_text(values), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        if not METRICS_ENABLED: return
+        self._series[label_values] = self._series.get(label_values, 0) + amount
+
+class Gauge(Metric):
+    """Valor calculado al servir /metrics: collect() devuelve {valores de etiquetas: valor}."""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def samples(self):
+        for values, value in self.collect().items():
+            yield self.name, self._label_text(values), value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        if not METRICS_ENABLED: return
+        # [cuenta por cubeta (no acumulada; la última es +Inf), suma, total]
+        series = self._series.get(label_values)
+        if series is None: series = self._series[label_values] = [0] * (len(self.buckets) + 3)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        if not METRICS_ENABLED:
+            yield
+            return
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - started, *label_values)
+
+    def samples(self):
+        for values, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f"{self.name}_bucket", self._label_text(values, [('le', bound)]), cumulative
+            yield f"{self.name}_bucket", self._label_text(values, [('le', '+Inf')]), series[-1]
+            yield f"{self.name}_sum", self._label_text(values), series[-2]
+            yield f"{self.name}_count", self._label_text(values), series[-1]
+
+metrics = []
+SOCKET_EVENT_SECONDS = Histogram('peliculas_socket_event_seconds', 'Tiempo de atención de cada evento de Socket.IO.', ('event',))
+LOCK_WAIT_SECONDS = Histogram('peliculas_session_lock_wait_seconds', 'Espera para tomar el cerrojo de una sesión.')
+LOCK_HOLD_SECONDS = Histogram('peliculas_session_lock_hold_seconds', 'Tiempo con el cerrojo de una sesión tomado.')
+SCHEDULER_LATENESS_SECONDS = Histogram('peliculas_scheduler_lateness_seconds', 'Retraso de cada plazo vencido respecto a su hora.', ('scheduler', 'kind'))
+EMIT_FANOUT = Histogram('peliculas_emit_fanout', 'Destinatarios de cada difusión a una sala.', ('event',), buckets=FANOUT_BUCKETS)
+SOCKET_ENCODE_SECONDS = Histogram('peliculas_socket_encode_seconds', 'Serialización de cada difusión, una por formato y sala.', ('encoding',))
+SOCKET_SENT_BYTES = Counter('peliculas_socket_sent_bytes_total', 'Bytes de mensajes de Socket.IO entregados a los sockets.', ('encoding',))
+DB_QUERY_SECONDS = Histogram('peliculas_db_query_seconds', 'Duración de cada operación de base de datos (espera del pool incluida).', ('op',))
+BACKGROUND_TASK_SECONDS = Histogram('peliculas_background_task_seconds', 'Duración de cada tarea del ejecutor en segundo plano.', ('lane',))
+BACKGROUND_QUEUE_SECONDS = Histogram('peliculas_background_queue_seconds', 'Espera en cola de cada tarea hasta empezar.', ('lane', 'priority'))
+BACKGROUND_QUEUE_DEPTH = Gauge('peliculas_background_queue_depth', 'Tareas en cola por carril del ejecutor.', ('lane',),
+                               collect=lambda: background.queue_depths())
+ROOM_VIEWERS = Gauge('peliculas_room_viewers', 'Espectadores conectados a este worker por sesión y sala.', ('session', 'room'),
+                     collect=lambda: {(session_id, room): s_data['snapshot'][f'user_count_{room}']
+                                      for session_id, s_data in active_sessions.items() for room in ('vestibule', 'watch_room')})
+ACTIVE_SESSIONS = Gauge('peliculas_sessions_in_memory', 'Sesiones cargadas en memoria en este worker.',
+                        collect=lambda: {(): len(active_sessions.items())})
+SOCKET_MEMBERSHIPS = Gauge('peliculas_socket_memberships', 'Sockets de este worker en el índice inverso sid -> sesión y sala.',
+                           collect=lambda: {(): active_sessions.member_count()})
+
+def render_metrics():
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+def timed_event(event, namespace=None):
+    """Como socketio.on, pero registra cuánto tarda cada evento en SOCKET_EVENT_SECONDS."""
+    def decorator(handler):
+        if not METRICS_ENABLED: return socketio.on(event, namespace=namespace)(handler)
+        @functools.wraps(handler)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try: return handler(*args, **kwargs)
+            finally: SOCKET_EVENT_SECONDS.observe(time.perf_counter() - started, event)
+        return socketio.on(event, namespace=namespace)(timed)
+    return decorator
+
+def room_size(room, namespace='/'):
+    """Sockets de este worker en una sala de Socket.IO."""
+    return len(socketio.server.manager.rooms.get(namespace, {}).get(room, ()))
 
 # --- Estado Global en Memoria ---
-active_sessions = {}
-sessions_lock = threading.Lock()
+class SessionRegistry:
+    """
+    Registro de las sesiones en memoria con un cerrojo por sesión.
+    El diccionario interno se sustituye entero al añadir o quitar sesiones (copy-on-write),
+    así que buscar o recorrer sesiones nunca necesita cerrojo; solo el alta y la baja se serializan.
+    También mantiene el índice inverso sid -> (session_id, room_type, username) para que
+    desconexiones y cambios de sala no tengan que recorrer todas las sesiones.
+    """
+    def __init__(self):
+        self._sessions = {}
+        self._members = {}
+        self._write_lock = threading.Lock()
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def __getitem__(self, session_id):
+        return self._sessions[session_id]
+
+    def get(self, session_id, default=None):
+        return self._sessions.get(session_id, default)
+
+    def items(self):
+        # Copia inmutable: se puede recorrer sin cerrojo aunque otras sesiones se den de alta o baja
+        return self._sessions.items()
+
+    def add(self, session_id, s_data):
+        """Da de alta la sesión si no existía. Devuelve (sesión registrada, si se ha creado)."""
+        with self._write_lock:
+            if session_id in self._sessions: return self._sessions[session_id], False
+            s_data['lock'] = threading.RLock()
+            publish_snapshot(s_data)
+            sessions = dict(self._sessions); sessions[session_id] = s_data
+            self._sessions = sessions
+            return s_data, True
+
+    def remove(self, session_id):
+        with self._write_lock:
+            if session_id not in self._sessions: return None
+            sessions = dict(self._sessions); s_data = sessions.pop(session_id)
+            self._sessions = sessions
+        with s_data['lock']:
+            for room_users in s_data['users'].values():
+                for sid in room_users: self.unbind(sid, session_id)
+        live_state.discard(session_id)
+        cluster.release(session_id)
+        return s_data
+
+    def member_count(self):
+        return len(self._members)
+
+    def member(self, sid):
+        """(session_id, room_type, username) del socket, o None si no está en ninguna sala."""
+        return self._members.get(sid)
+
+    def bind(self, sid, session_id, room_type, username):
+        # Llamar con el cerrojo de la sesión, junto al alta en s_data['users']
+        self._members[sid] = (session_id, room_type, username)
+
+    def unbind(self, sid, session_id):
+        # Solo se borra si la entrada sigue apuntando a esa sesión
+        member = self._members.get(sid)
+        if member and member[0] == session_id: self._members.pop(sid, None)
+
+    def snapshot(self, session_id):
+        """Última vista publicada de la sesión (o None), legible sin cerrojo."""
+        s_data = self._sessions.get(session_id)
+        return s_data['snapshot'] if s_data else None
+
+def publish_snapshot(s_data):
+    """
+    Publica una vista nueva de la sesión para los lectores sin cerrojo (cartelera, admin, resincronización).
+    Llamar con el cerrojo de la sesión tras cada cambio de estado o de usuarios; la vista no se modifica nunca.
+    """
+    snapshot = {
+        'state': dict(s_data.state), 'state_seq': s_data.state_seq,
+        'user_count_vestibule': len(s_data.users['vestibule']),
+        'user_count_watch_room': len(s_data.users['watch_room']),
+    }
+    if 'started_at' in s_data: snapshot['started_at'] = s_data['started_at']
+    previous = s_data.get('snapshot')
+    if not previous or any(previous.get(key) != snapshot.get(key) for key in ('state', 'state_seq', 'started_at')):
+        s_data.room_payload = None # El 'room_state' codificado ya no vale; los contadores de usuarios no le afectan
+    if not previous or previous['state'].get('status') != snapshot['state'].get('status'):
+        cartelera_cache.invalidate() # La cartelera solo depende del estado, no de los contadores
+    empty = not snapshot['user_count_vestibule'] and not snapshot['user_count_watch_room']
+    if not previous or empty != (not previous['user_count_vestibule'] and not previous['user_count_watch_room']):
+        schedule_monitor.occupancy_changed(s_data, empty)
+    s_data.snapshot = snapshot
+    live_state.mark(s_data.db_id)
+    cluster.viewers_changed(s_data.db_id)
+
+class Viewer:
+    """
+    Un socket dentro de una sala. Los mensajes de chat apuntan a su autor en lugar de copiar
+    su sid y su nombre, y el nombre se interna: los repetidos comparten la misma cadena.
+    """
+    __slots__ = ('id', 'sid', 'username')
+    _ids = itertools.count(1)
+
+    def __init__(self, sid, username):
+        self.id = next(Viewer._ids)
+        self.sid = sid
+        self.username = sys.intern(username)
+
+class ChatMessage:
+    __slots__ = ('id', 'author', 'text')
+
+    def __init__(self, author, text, message_id=None):
+        self.id = message_id
+        self.author = author
+        self.text = text
+
+    def as_dict(self):
+        """Forma que se envía a los clientes."""
+        return {'id': self.id, 'sid': self.author.sid, 'username': self.author.username, 'text': self.text}
+
+class ChatLog:
+    """
+    Historial de chat de una sala: búfer circular de capacidad fija.
+    Cada mensaje recibe un id creciente, así que los ids guardados son consecutivos y
+    paginar hacia atrás es un simple corte del búfer. La última página (la que recibe cada
+    'join') se guarda ya convertida y solo se rehace cuando llega un mensaje nuevo.
+    """
+    def __init__(self, capacity=CHAT_HISTORY_CAPACITY):
+        self._messages = deque(maxlen=capacity)
+        self._next_id = 1
+        self._recent = None # (limit, página)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def append(self, msg):
+        msg.id = self._next_id
+        self._next_id += 1
+        self._messages.append(msg)
+        self._recent = None
+        return msg
+
+    def recent(self, limit):
+        if self._recent is None or self._recent[0] != limit:
+            page = itertools.islice(self._messages, max(0, len(self._messages) - limit), None)
+            self._recent = (limit, [msg.as_dict() for msg in page])
+        return self._recent[1]
+
+    def before(self, message_id, limit):
+        """Hasta 'limit' mensajes anteriores a message_id, en orden cronológico."""
+        if not self._messages: return []
+        end = max(0, min(message_id - self._messages[0].id, len(self._messages)))
+        return [msg.as_dict() for msg in itertools.islice(self._messages, max(0, end - limit), end)]
+
+    def has_before(self, message_id):
+        return bool(self._messages) and self._messages[0].id < message_id
+
+    def dump(self):
+        # Cada autor se guarda una vez; los mensajes lo referencian por su id entero
+        authors = {}
+        for msg in self._messages: authors.setdefault(msg.author.id, [msg.author.sid, msg.author.username])
+        return {'next_id': self._next_id, 'authors': authors,
+                'messages': [[msg.id, msg.author.id, msg.text] for msg in self._messages]}
+
+    @classmethod
+    def load(cls, data):
+        log = cls()
+        authors = {viewer_id: Viewer(sid, username) for viewer_id, (sid, username) in data.get('authors', {}).items()}
+        for entry in data.get('messages', []):
+            if isinstance(entry, dict): # Formato anterior: un dict por mensaje con el sid y el nombre
+                author = authors.setdefault((entry['sid'], entry['username']), Viewer(entry['sid'], entry['username']))
+                log._messages.append(ChatMessage(author, entry['text'], entry['id']))
+            else:
+                message_id, viewer_id, text = entry
+                log._messages.append(ChatMessage(authors[str(viewer_id)], text, message_id))
+        log._next_id = data.get('next_id', 1)
+        return log
+
+_lock_scope = threading.local() # Con monkey_patch es local a cada greenlet
+
+def after_unlock(fn, *args, **kwargs):
+    """
+    Aplaza fn(*args, **kwargs) hasta que este greenlet suelte el último cerrojo de sesión que tenga tomado.
+    Es para las difusiones: con cola de mensajes cada emit es una escritura de red, y con el cerrojo tomado
+    no se hace E/S. Los argumentos se evalúan ya (con el estado bajo el cerrojo). Sin cerrojo se llama en el acto.
+    """
+    pending = getattr(_lock_scope, 'pending', None)
+    if pending is None: return fn(*args, **kwargs)
+    pending.append((fn, args, kwargs))
+
+@contextmanager
+def locked_session(session_id):
+    """Toma el cerrojo de una sesión. Devuelve None si no existe o se ha dado de baja mientras se esperaba."""
+    s_data = active_sessions.get(session_id)
+    if s_data is None:
+        yield None
+        return
+    outermost = getattr(_lock_scope, 'pending', None) is None
+    if outermost: _lock_scope.pending = []
+    started = time.perf_counter()
+    try:
+        with s_data['lock']:
+            acquired = time.perf_counter()
+            LOCK_WAIT_SECONDS.observe(acquired - started)
+            try: yield s_data if active_sessions.get(session_id) is s_data else None
+            finally: LOCK_HOLD_SECONDS.observe(time.perf_counter() - acquired)
+    finally:
+        if outermost:
+            pending, _lock_scope.pending = _lock_scope.pending, None
+            for fn, args, kwargs in pending: fn(*args, **kwargs)
+
+def leave_session(sid):
+    """Saca un socket de la sala en la que esté. Devuelve (session_id, room_type, username) o None."""
+    member = active_sessions.member(sid)
+    if not member: return None
+    session_id, room_type, _ = member
+    with locked_session(session_id) as s_data:
+        active_sessions.unbind(sid, session_id)
+        if not s_data or s_data.users[room_type].pop(sid, None) is None: return None
+        publish_snapshot(s_data)
+    return member
+
+active_sessions = SessionRegistry()
+
+# --- Ejecutor en segundo plano: hilos del sistema para la E/S, procesos para la CPU ---
+class BackgroundTask:
+    """Tarea encolada en el ejecutor. result() la espera desde un greenlet (el hub sigue atendiendo) y devuelve o relanza."""
+    def __init__(self, fn, args, lane, priority, name):
+        self.id = uuid.uuid4().hex[:12]
+        self.fn = fn
+        self.args = args
+        self.lane = lane
+        self.priority = priority
+        self.name = name
+        self.status = JOB_QUEUED
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.finished = Event()
+
+    def done(self):
+        return self.finished.ready()
+
+    def result(self):
+        return self.finished.wait()
+
+    def as_dict(self):
+        return {'id': self.id, 'name': self.name, 'lane': self.lane, 'priority': self.priority, 'status': self.status,
+                'submitted_at': self.submitted_at, 'started_at': self.started_at, 'finished_at': self.finished_at, 'error': self.error}
+
+class BackgroundExecutor:
+    """
+    Ejecutor general para todo lo que pararía el hub de eventlet. El carril 'io' lleva la E/S bloqueante
+    a hilos del sistema (tpool); el carril 'cpu' lleva el trabajo de CPU a un pool de procesos, donde no
+    compite por el GIL con los greenlets que atienden los sockets. Cada carril tiene su cola por prioridad
+    y un número fijo de greenlets que la vacían, así que una ráfaga de trabajo de fondo nunca acapara tpool.
+    Las tareas con nombre se ven en el panel de administración; las anónimas (pasos cortos, como escribir
+    un bloque de una subida) solo cuentan en las métricas.
+    """
+    def __init__(self, workers):
+        self.workers = workers # carril -> tareas a la vez
+        self._queues = {lane: PriorityQueue() for lane in workers}
+        self._seq = itertools.count() # Desempate FIFO dentro de cada prioridad
+        self._tasks = {}              # Tareas con nombre en cola o en curso
+        self._recent = deque(maxlen=BACKGROUND_TASK_HISTORY)
+        self._processes = None
+        self._spawn_lock = threading.Lock() # Un solo submit() a la vez: cambia sys.modules['__main__'] mientras arranca hijos
+        self._started = False
+
+    def start(self):
+        if self._started: return
+        self._started = True
+        for lane, count in self.workers.items():
+            for _ in range(count): socketio.start_background_task(target=self._worker, lane=lane)
+
+    def submit(self, fn, *args, lane=LANE_IO, priority=TASK_PRIORITY_NORMAL, name=None):
+        """Encola fn(*args) y devuelve la tarea. En el carril 'cpu' fn y sus argumentos deben poder serializarse."""
+        task = BackgroundTask(fn, args, lane, priority, name)
+        self.start()
+        self._queues[lane].put((priority, next(self._seq), task))
+        if name:
+            self._tasks[task.id] = task
+            self._notify(task)
+        return task
+
+    def call(self, fn, *args, **options):
+        """submit() y espera el resultado: solo espera el greenlet que llama, no el proceso."""
+        return self.submit(fn, *args, **options).result()
+
+    def queue_depths(self):
+        return {(lane,): queue.qsize() for lane, queue in self._queues.items()}
+
+    def snapshot(self):
+        """Tareas con nombre en cola, en curso y las últimas terminadas, de la más reciente a la más antigua."""
+        tasks = itertools.chain(self._tasks.values(), self._recent)
+        return [task.as_dict() for task in sorted(tasks, key=lambda task: task.submitted_at, reverse=True)]
+
+    def _notify(self, task):
+        socketio.emit('background_task', task.as_dict(), namespace='/admin')
+
+    def _worker(self, lane):
+        queue = self._queues[lane]
+        while True:
+            _, _, task = queue.get()
+            task.started_at = time.time()
+            BACKGROUND_QUEUE_SECONDS.observe(task.started_at - task.submitted_at, lane, task.priority)
+            task.status = JOB_RUNNING
+            if task.name: self._notify(task)
+            try:
+                with BACKGROUND_TASK_SECONDS.time(lane):
+                    result = tpool.execute(task.fn, *task.args) if lane == LANE_IO else self._run_in_process(task)
+            except Exception as e:
+                task.status, task.error = JOB_FAILED, str(e)[-500:]
+                self._finish(task)
+                task.finished.send_exception(e)
+            else:
+                task.status = JOB_DONE
+                self._finish(task)
+                task.finished.send(result)
+
+    def _finish(self, task):
+        task.finished_at = time.time()
+        task.fn = task.args = None # No retener ficheros ni bloques de datos en el historial
+        if task.name:
+            self._tasks.pop(task.id, None)
+            self._recent.append(task)
+            self._notify(task)
+
+    def _run_in_process(self, task):
+        with self._spawn_lock:
+            if self._processes is None:
+                # 'spawn' y no 'fork': un hijo copiado de un proceso con el hub de eventlet y sus hilos no es fiable
+                self._processes = ProcessPoolExecutor(self.workers[LANE_CPU], mp_context=multiprocessing.get_context('spawn'))
+                # Cerrarlo a mano al salir: el cierre automático de concurrent.futures se queda esperando con eventlet
+                atexit.register(self._processes.shutdown, cancel_futures=True)
+            # submit() arranca los hijos que falten y cada uno importa el __main__ del padre, que sería esta app
+            # entera (monkey_patch, SocketIO, la cola de mensajes, el hilo de logs). Mientras tanto __main__ es
+            # poster_worker, que no hace nada al importarse; por eso task.fn tiene que venir de un módulo así.
+            main = sys.modules['__main__']
+            sys.modules['__main__'] = poster_worker
+            try: future = self._processes.submit(task.fn, *task.args)
+            finally: sys.modules['__main__'] = main
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self._processes = None # Ha muerto un proceso hijo: el pool se rehace para la siguiente tarea
+            raise
+
+background = BackgroundExecutor({LANE_IO: BACKGROUND_IO_WORKERS, LANE_CPU: BACKGROUND_CPU_WORKERS})
 
 # --- 2. GESTIÓN DE BASE DE DATOS ---
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+class Database:
+    """
+    Acceso a SQLite: pool acotado de conexiones en modo WAL (synchronous=NORMAL) con caché de
+    sentencias preparadas. Cada operación corre en un hilo real del sistema (eventlet.tpool) dentro
+    de su propia transacción, así que ni las aperturas ni los fsync paran el hub de eventlet.
+    """
+    def __init__(self, path, pool_size):
+        self.path = path
+        self.pool_size = pool_size
+        self._idle = LightQueue()
+        self._opened = 0
 
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_SECONDS, check_same_thread=False,
+                               cached_statements=DB_STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # Con WAL basta para no corromper; solo se hace fsync en los checkpoints
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        # Las conexiones se abren bajo demanda hasta pool_size; después se espera a que quede una libre
+        if self._idle.qsize() == 0 and self._opened < self.pool_size:
+            self._opened += 1
+            try: conn = tpool.execute(self._connect)
+            except Exception:
+                self._opened -= 1
+                raise
+        else:
+            conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    @staticmethod
+    def _transaction(conn, work):
+        with conn: # commit al terminar, rollback si hay excepción
+            return work(conn)
+
+    def run(self, work, op='run'):
+        """Ejecuta work(conn) en una transacción, en el pool de hilos, y devuelve su resultado."""
+        with DB_QUERY_SECONDS.time(op), self._connection() as conn:
+            return tpool.execute(self._transaction, conn, work)
+
+    def query(self, sql, params=()):
+        return self.run(lambda conn: conn.execute(sql, params).fetchall(), 'query')
+
+    def query_one(self, sql, params=()):
+        return self.run(lambda conn: conn.execute(sql, params).fetchone(), 'query_one')
+
+    def execute(self, sql, params=()):
+        return self.run(lambda conn: conn.execute(sql, params).rowcount, 'execute')
+
+    def executemany(self, sql, seq_of_params):
+        return self.run(lambda conn: conn.executemany(sql, seq_of_params).rowcount, 'executemany')
+
+db = Database(DATABASE_FILE, DB_POOL_SIZE)
+
+class DebouncedBatcher(ABC):
+    """
+    Base para trabajo agrupado (difusiones, escrituras): el primer cambio despierta al hilo, que espera
+    'interval' para acumular los que lleguen detrás y después llama a _flush() una sola vez. Cada subclase
+    implementa _flush() con lo que haya acumulado.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started = False
+
+    def _notify(self):
+        if not self._started:
+            self._started = True
+            socketio.start_background_task(target=self._run)
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            socketio.sleep(self.interval) # Ventana de agrupado
+            self._wakeup.clear()
+            try: self._flush()
+            except Exception: logger.exception("Error en %s", type(self).__name__)
+
+    @abstractmethod
+    def _flush(self): ...
+
+class SessionStatusWriter(DebouncedBatcher):
+    """
+    Cambios de 'status' en la tabla sessions agrupados durante DB_WRITE_BATCH_SECONDS: varios cierres
+    en un mismo barrido del monitor se escriben con un único executemany en una sola transacción.
+    """
+    def __init__(self, interval):
+        super().__init__(interval)
+        self._pending = {}
+
+    def set(self, session_id, status):
+        with self._lock: self._pending[session_id] = status
+        self._notify()
+
+    def _flush(self):
+        with self._lock: pending, self._pending = self._pending, {}
+        if pending:
+            db.executemany("UPDATE sessions SET status = ? WHERE id = ?", [(status, session_id) for session_id, status in pending.items()])
+            cartelera_cache.invalidate()
+
+session_status_writer = SessionStatusWriter(DB_WRITE_BATCH_SECONDS)
+
+class LiveSessionStore(DebouncedBatcher):
+    """
+    Copia en live_sessions del estado de cada sesión en memoria, para sobrevivir a un reinicio.
+    Cada cambio publicado marca la sesión y en cada ventana de LIVE_STATE_FLUSH_SECONDS se guardan todas
+    las marcadas en una sola transacción. El chat va en su propia columna y solo se reescribe si ha cambiado.
+    La posición se guarda junto con el instante del guardado para recalcularla al restaurar.
+    """
+    def __init__(self, interval):
+        super().__init__(interval)
+        self._dirty = {}      # session_id -> si también hay que guardar el chat
+        self._removed = set()
+
+    def mark(self, session_id, chat=False):
+        if not cluster.owns(session_id): return # Solo el líder de la sesión la guarda
+        with self._lock:
+            self._dirty[session_id] = chat or self._dirty.get(session_id, False)
+            self._removed.discard(session_id)
+        self._notify()
+
+    def discard(self, session_id):
+        if not cluster.owns(session_id): return
+        with self._lock:
+            self._dirty.pop(session_id, None)
+            self._removed.add(session_id)
+        self._notify()
+
+    @staticmethod
+    def _record(s_data):
+        state = dict(s_data.state)
+        state['time'] = round(playback_position(s_data), 3)
+        record = {'movie_title': s_data.movie_title, 'poster_file': s_data.poster_file, 'playlist': s_data.playlist,
+                  'scheduled_time': s_data.scheduled_time.isoformat(), 'state': state, 'state_seq': s_data.state_seq,
+                  'muted_users': sorted(s_data.muted_users), 'saved_at': time.time()}
+        for key in ('countdown_ends_at', 'close_timer_start'):
+            if key in s_data: record[key] = s_data[key]
+        return record
+
+    def _flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            removed, self._removed = self._removed, set()
+        rows, chats = [], []
+        for session_id, chat in dirty.items():
+            with locked_session(session_id) as s:
+                if not s: continue
+                rows.append((session_id, json.dumps(self._record(s)), time.time()))
+                if chat: chats.append((json.dumps({room: log.dump() for room, log in s['chat'].items()}), session_id))
+        def write(conn):
+            conn.executemany("INSERT INTO live_sessions (id, data, saved_at) VALUES (?, ?, ?) "
+                             "ON CONFLICT(id) DO UPDATE SET data = excluded.data, saved_at = excluded.saved_at", rows)
+            conn.executemany("UPDATE live_sessions SET chat = ? WHERE id = ?", chats)
+            conn.executemany("DELETE FROM live_sessions WHERE id = ?", [(session_id,) for session_id in removed])
+        if rows or removed: db.run(write, 'live_state_flush')
+
+live_state = LiveSessionStore(LIVE_STATE_FLUSH_SECONDS)
+
+def create_schema(cursor):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS sessions (
             id TEXT PRIMARY KEY, movie_title TEXT NOT NULL, movie_file TEXT NOT NULL,
@@ -60,11 +907,121 @@ def init_db():
             status TEXT NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    conn.commit()
-    conn.close()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_catalog (
+            path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL,
+            duration REAL, codec TEXT, width INTEGER, height INTEGER, bitrate INTEGER,
+            probed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY, filename TEXT NOT NULL, size INTEGER NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transcode_jobs (
+            id TEXT PRIMARY KEY, source TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL,
+            content_hash TEXT, status TEXT NOT NULL, progress REAL NOT NULL DEFAULT 0, manifest TEXT, error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transcode_jobs_hash ON transcode_jobs (content_hash, status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transcode_jobs_source ON transcode_jobs (source, size, mtime)")
+
+def add_session_indexes_and_archive(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_status_time ON sessions (status, scheduled_time)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_time ON sessions (scheduled_time)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sessions_archive (
+            id TEXT PRIMARY KEY, movie_title TEXT NOT NULL, movie_file TEXT NOT NULL,
+            poster_file TEXT, playlist TEXT NOT NULL, scheduled_time TIMESTAMP NOT NULL,
+            status TEXT NOT NULL, created_at TIMESTAMP, archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def add_live_sessions(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS live_sessions (
+            id TEXT PRIMARY KEY, data TEXT NOT NULL, chat TEXT NOT NULL DEFAULT '{}', saved_at REAL NOT NULL
+        )
+    ''')
+
+def add_cluster_tables(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS session_leases (session_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_session_leases_owner ON session_leases (owner)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS session_commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, kind TEXT NOT NULL, payload TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_session_commands_session ON session_commands (session_id, id)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS session_presence (
+            session_id TEXT NOT NULL, worker TEXT NOT NULL, vestibule INTEGER NOT NULL, watch_room INTEGER NOT NULL,
+            updated_at REAL NOT NULL, PRIMARY KEY (session_id, worker)
+        )
+    ''')
+
+def add_poster_variants(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS posters (
+            movie TEXT PRIMARY KEY, source TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL,
+            content_hash TEXT, status TEXT NOT NULL, error TEXT, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS poster_variants (
+            content_hash TEXT NOT NULL, format TEXT NOT NULL, width INTEGER NOT NULL, height INTEGER NOT NULL,
+            file TEXT NOT NULL, PRIMARY KEY (content_hash, format, width)
+        )
+    ''')
+
+# Migraciones en orden; PRAGMA user_version guarda cuántas se han aplicado. Solo se añaden al final, nunca se editan.
+MIGRATIONS = [create_schema, add_session_indexes_and_archive, add_live_sessions, add_cluster_tables, add_poster_variants]
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn.cursor())
+        conn.execute(f"PRAGMA user_version = {number}")
+        db_log.info("Migración %d aplicada (%s).", number, migration.__name__)
+
+def archive_finished_sessions():
+    """Mueve a sessions_archive las sesiones finalizadas hace más de SESSION_ARCHIVE_AFTER_HOURS."""
+    cutoff = (datetime.now() - timedelta(hours=SESSION_ARCHIVE_AFTER_HOURS)).isoformat(timespec='minutes')
+    def archive(conn):
+        where = "WHERE status = ? AND scheduled_time < ?"
+        ids = [row['id'] for row in conn.execute(f"SELECT id FROM sessions {where}", (STATUS_FINISHED, cutoff))]
+        if ids:
+            conn.execute(f"INSERT OR REPLACE INTO sessions_archive (id, movie_title, movie_file, poster_file, playlist, scheduled_time, status, created_at) "
+                         f"SELECT id, movie_title, movie_file, poster_file, playlist, scheduled_time, status, created_at FROM sessions {where}", (STATUS_FINISHED, cutoff))
+            conn.execute(f"DELETE FROM sessions {where}", (STATUS_FINISHED, cutoff))
+        return ids
+    archived = db.run(archive, 'archive_sessions')
+    for session_id in archived: admin_feed.removed(session_id)
+    if archived: db_log.info("%d sesiones finalizadas archivadas.", len(archived))
+
+def init_db():
+    db.run(migrate, 'migrate')
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
     os.makedirs(ASSETS_FOLDER, exist_ok=True)
-    os.makedirs('static/posters', exist_ok=True)
+    os.makedirs(POSTER_VARIANTS_FOLDER, exist_ok=True)
+    os.makedirs(HLS_FOLDER, exist_ok=True)
+    # Catalogar y segmentar intro/outro (y películas ya subidas); solo se procesan los ficheros nuevos o modificados
+    for video in [INTRO_VIDEO, OUTRO_VIDEO] + [f'videos/{f}' for f in get_available_movies().values()]:
+        try:
+            get_media_info(os.path.join('static', video))
+            transcoder.submit(os.path.join('static', video))
+        except Exception as e: media_log.warning("No se pudo catalogar '%s'. Error: %s", video, e)
+    # Pósters subidos antes de tener variantes (o cambiados a mano en disco)
+    for filename in os.listdir(POSTERS_FOLDER):
+        if allowed_image_file(filename):
+            poster_pipeline.submit(os.path.splitext(filename)[0], os.path.join(POSTERS_FOLDER, filename))
+    poster_pipeline.start() # Retoma los que quedaron en cola
 
 # --- 3. FUNCIONES AUXILIARES ---
 def allowed_file(filename):
@@ -83,148 +1040,1067 @@ def get_available_movies():
 def is_admin():
     return session.get('admin_logged_in', False)
 
+# --- Catálogo de medios: duración, códec, resolución y bitrate leídos de la cabecera del contenedor ---
+MP4_CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+MP4_CODEC_NAMES = {'avc1': 'h264', 'avc3': 'h264', 'hvc1': 'hevc', 'hev1': 'hevc', 'av01': 'av1', 'vp09': 'vp9'}
+
+def _iter_mp4_boxes(f, start, end):
+    """Recorre las cajas ISO-BMFF entre start y end. Devuelve (tipo, inicio del contenido, fin de la caja)."""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]; header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header: return
+        yield box_type, offset + header, offset + size
+        offset += size
+
+def _probe_mp4(path):
+    """Lee mvhd/tkhd/stsd del átomo moov sin decodificar nada. Devuelve None si no es un MP4 legible."""
+    info = {}
+    with open(path, 'rb') as f:
+        def walk(start, end):
+            for box_type, body, box_end in _iter_mp4_boxes(f, start, end):
+                f.seek(body)
+                if box_type == b'mvhd':
+                    version = f.read(1)[0]
+                    f.seek(body + (20 if version == 1 else 12))
+                    timescale = struct.unpack('>I', f.read(4))[0]
+                    duration = struct.unpack('>Q' if version == 1 else '>I', f.read(8 if version == 1 else 4))[0]
+                    if timescale: info['duration'] = duration / timescale
+                elif box_type == b'trak':
+                    track = {}
+                    walk_track(body, box_end, track)
+                    if track.get('handler') == b'vide' and 'width' not in info:
+                        info.update({k: v for k, v in track.items() if k in ('width', 'height', 'codec')})
+                elif box_type in MP4_CONTAINER_BOXES:
+                    walk(body, box_end)
+
+        def walk_track(start, end, track):
+            for box_type, body, box_end in _iter_mp4_boxes(f, start, end):
+                f.seek(body)
+                if box_type == b'tkhd':
+                    # Ancho y alto en coma fija 16.16 al final de la caja
+                    f.seek(box_end - 8)
+                    width, height = struct.unpack('>II', f.read(8))
+                    track['width'], track['height'] = width >> 16, height >> 16
+                elif box_type == b'hdlr':
+                    f.seek(body + 8)
+                    track['handler'] = f.read(4)
+                elif box_type == b'stsd':
+                    f.seek(body + 12)
+                    fourcc = f.read(4).decode('latin-1')
+                    track['codec'] = MP4_CODEC_NAMES.get(fourcc, fourcc)
+                elif box_type in MP4_CONTAINER_BOXES:
+                    walk_track(body, box_end, track)
+
+        walk(0, os.fstat(f.fileno()).st_size)
+    return info if info.get('duration') else None
+
+def probe_media(path):
+    """
+    Sondea la cabecera del fichero: parser MP4 propio (en un hilo del ejecutor, son lecturas de disco) y,
+    si no sirve, 'ffmpeg -i' (tampoco decodifica; su subproceso ya es verde).
+    """
+    info = None
+    if path.lower().endswith('.mp4'):
+        try: info = background.call(_probe_mp4, path, priority=TASK_PRIORITY_HIGH, name=f"Sondeo de {os.path.basename(path)}")
+        except (OSError, struct.error, IndexError) as e: media_log.warning("Cabecera MP4 ilegible en '%s': %s", path, e)
+    if info is None:
+        infos = ffmpeg_parse_infos(path, check_duration=True)
+        size = infos.get('video_size') or [None, None]
+        info = {'duration': infos.get('duration'), 'codec': infos.get('video_codec_name'),
+                'width': size[0], 'height': size[1]}
+    if info.get('duration'):
+        info['bitrate'] = int(os.path.getsize(path) * 8 / info['duration'])
+    return info
+
+def get_media_info(path):
+    """
+    Metadatos del vídeo desde media_catalog. Solo se vuelve a sondear el fichero si su tamaño
+    o su fecha de modificación no coinciden con lo catalogado.
+    """
+    stat = os.stat(path)
+    row = db.query_one("SELECT * FROM media_catalog WHERE path = ?", (path,))
+    if row and row['size'] == stat.st_size and row['mtime'] == stat.st_mtime:
+        return dict(row)
+    info = probe_media(path)
+    row = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime, 'duration': info.get('duration'),
+           'codec': info.get('codec'), 'width': info.get('width'), 'height': info.get('height'), 'bitrate': info.get('bitrate')}
+    db.execute("INSERT OR REPLACE INTO media_catalog (path, size, mtime, duration, codec, width, height, bitrate) VALUES (:path, :size, :mtime, :duration, :codec, :width, :height, :bitrate)", row)
+    media_log.info("Catalogado '%s': %s", path, info)
+    return row
+
+def media_duration(path, default=DEFAULT_MOVIE_DURATION):
+    """Duración en segundos enteros según el catálogo, o 'default' si no se puede determinar."""
+    try:
+        duration = get_media_info(path).get('duration')
+        if duration: return int(duration)
+        media_log.warning("'%s' no informa de su duración. Usando %ss por defecto.", path, default)
+    except Exception as e:
+        media_log.warning("No se pudo obtener la duración de '%s'. Error: %s. Usando %ss por defecto.", path, e, default)
+    return default
+
+def catalog_media(path):
+    """Cataloga un vídeo recién llegado. Si no se puede sondear se registra y ya: la subida no falla por sus metadatos."""
+    try: return get_media_info(path)
+    except Exception as e:
+        media_log.warning("No se pudo catalogar '%s'. Error: %s", path, e)
+        return None
+
+# --- Segmentado HLS en segundo plano: cola de trabajos acotada con procesos ffmpeg ---
+mimetypes.add_type('video/mp2t', '.ts')
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(UPLOAD_STREAM_BLOCK_BYTES), b''): digest.update(block)
+    return digest.hexdigest()
+
+def hls_manifest_for(path):
+    """Manifiesto HLS (relativo a 'static') de la versión actual del fichero, si ya está segmentado."""
+    try: stat = os.stat(path)
+    except OSError: return None
+    row = db.query_one("SELECT manifest FROM transcode_jobs WHERE source = ? AND size = ? AND mtime = ? AND status = ?",
+                       (path, stat.st_size, stat.st_mtime, JOB_DONE))
+    return row['manifest'] if row else None
+
+def with_hls_manifests(playlist):
+    """Añade 'hls' a cada vídeo de la playlist que ya tenga su versión segmentada."""
+    for video in playlist:
+        if 'hls' not in video:
+            manifest = hls_manifest_for(os.path.join('static', video['src']))
+            if manifest: video['hls'] = manifest
+    return playlist
+
+class TranscodePipeline:
+    """
+    Corta cada vídeo en segmentos HLS de HLS_SEGMENT_SECONDS con su manifiesto.
+    Los trabajos se guardan en la tabla transcode_jobs y los ejecutan como mucho 'workers' procesos
+    ffmpeg a la vez. Un fichero con el mismo hash de contenido que otro ya segmentado reutiliza su salida.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self._queue = LightQueue()
+        self._inflight_hashes = {}
+        self._started = False
+
+    def start(self):
+        if self._started: return
+        self._started = True
+        for _ in range(self.workers): socketio.start_background_task(target=self._worker)
+        # Reencolar lo que quedó a medias en una ejecución anterior
+        pending = db.query("SELECT id FROM transcode_jobs WHERE status IN (?, ?, ?) ORDER BY created_at",
+                           (JOB_QUEUED, JOB_HASHING, JOB_RUNNING))
+        for row in pending: self._queue.put(row['id'])
+
+    def submit(self, path):
+        """Encola el segmentado del fichero, salvo que esta misma versión ya tenga un trabajo vivo o terminado."""
+        stat = os.stat(path)
+        def find_or_insert(conn):
+            row = conn.execute("SELECT id FROM transcode_jobs WHERE source = ? AND size = ? AND mtime = ? AND status != ?",
+                               (path, stat.st_size, stat.st_mtime, JOB_FAILED)).fetchone()
+            if row: return row['id'], False
+            job_id = uuid.uuid4().hex[:12]
+            conn.execute("INSERT INTO transcode_jobs (id, source, size, mtime, status) VALUES (?, ?, ?, ?, ?)",
+                         (job_id, path, stat.st_size, stat.st_mtime, JOB_QUEUED))
+            return job_id, True
+        job_id, created = db.run(find_or_insert, 'transcode_enqueue')
+        if not created: return job_id
+        if self._started: self._queue.put(job_id)
+        self.start()
+        return job_id
+
+    def _update(self, job_id, **fields):
+        assignments = ', '.join(f"{column} = ?" for column in fields)
+        def update(conn):
+            conn.execute(f"UPDATE transcode_jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (*fields.values(), job_id))
+            return dict(conn.execute("SELECT id, source, status, progress, manifest, error FROM transcode_jobs WHERE id = ?", (job_id,)).fetchone())
+        job = db.run(update, 'transcode_update')
+        socketio.emit('transcode_progress', job, namespace='/admin')
+
+    def _worker(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run_job(job_id)
+            except Exception as e:
+                transcode_log.exception("Trabajo %s fallido", job_id)
+                self._update(job_id, status=JOB_FAILED, error=str(e)[-500:])
+
+    def _claim(self, job_id):
+        """
+        Reclama el trabajo con una comparación e intercambio sobre su estado: con varios workers
+        todos lo ven en la tabla compartida y solo uno debe ejecutarlo. En modo multiproceso un trabajo
+        ya empezado solo se retoma si lleva JOB_STALE_SECONDS sin avanzar (su worker ha caído).
+        """
+        def claim(conn):
+            job = conn.execute("SELECT *, updated_at < datetime('now', ?) AS stale FROM transcode_jobs WHERE id = ?",
+                               (f'-{JOB_STALE_SECONDS} seconds', job_id)).fetchone()
+            if not job or job['status'] in (JOB_DONE, JOB_FAILED): return None
+            if cluster.enabled and job['status'] != JOB_QUEUED and not job['stale']: return None
+            claimed = conn.execute("UPDATE transcode_jobs SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = ? AND updated_at = ?",
+                                   (JOB_HASHING, job_id, job['status'], job['updated_at'])).rowcount
+            return job if claimed else None
+        return db.run(claim, 'transcode_claim')
+
+    def _run_job(self, job_id):
+        job = self._claim(job_id)
+        if not job: return
+        self._update(job_id, status=JOB_HASHING)
+        # El hash de un fichero de varios GB se calcula en un hilo del sistema para no parar el hub de eventlet
+        content_hash = background.call(file_sha256, job['source'], priority=TASK_PRIORITY_LOW,
+                                       name=f"Hash de {os.path.basename(job['source'])}")
+        self._update(job_id, content_hash=content_hash)
+        while content_hash in self._inflight_hashes: self._inflight_hashes[content_hash].wait()
+
+        manifest = f"hls/{content_hash}/index.m3u8"
+        done = db.query_one("SELECT 1 FROM transcode_jobs WHERE content_hash = ? AND status = ?", (content_hash, JOB_DONE))
+        if done and os.path.exists(os.path.join('static', manifest)):
+            transcode_log.info("Trabajo %s: '%s' ya estaba segmentado (hash %s).", job_id, job['source'], content_hash[:12])
+            self._update(job_id, status=JOB_DONE, progress=1, manifest=manifest)
+            return
+
+        finished = self._inflight_hashes[content_hash] = Event()
+        try:
+            self._segment(job_id, job['source'], os.path.join(HLS_FOLDER, content_hash))
+            self._update(job_id, status=JOB_DONE, progress=1, manifest=manifest)
+            transcode_log.info("Trabajo %s: '%s' segmentado en %s.", job_id, job['source'], manifest)
+        finally:
+            self._inflight_hashes.pop(content_hash, None)
+            finished.send()
+
+    def _segment(self, job_id, source, out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+        info = get_media_info(source)
+        duration = info.get('duration') or DEFAULT_MOVIE_DURATION
+        if info.get('codec') == 'h264':
+            codec_args = ['-c', 'copy']
+        else:
+            codec_args = ['-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'aac',
+                          '-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})']
+        command = [FFMPEG_BINARY, '-hide_banner', '-nostats', '-y', '-i', source, *codec_args,
+                   '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+                   '-hls_segment_filename', os.path.join(out_dir, 'seg_%05d.ts'),
+                   '-progress', 'pipe:1', os.path.join(out_dir, 'index.m3u8')]
+        self._update(job_id, status=JOB_RUNNING, progress=0)
+        # La salida de ffmpeg va a un temporal fuera de HLS_FOLDER, que se sirve en público y con caché inmutable
+        with tempfile.TemporaryFile() as log:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=log)
+            reported = 0
+            for line in process.stdout:
+                key, _, value = line.decode('ascii', 'replace').strip().partition('=')
+                if key == 'out_time_us' and value.isdigit():
+                    progress = min(int(value) / 1e6 / duration, 0.99)
+                    if progress - reported >= 0.01:
+                        reported = progress
+                        self._update(job_id, progress=round(progress, 3))
+            returncode = process.wait()
+            if returncode != 0:
+                log.seek(max(0, log.seek(0, os.SEEK_END) - 500))
+                raise RuntimeError(f"ffmpeg terminó con código {returncode}: {log.read().decode('utf-8', 'replace')}")
+
+transcoder = TranscodePipeline(TRANSCODE_WORKERS)
+
+# --- Pósters: variantes redimensionadas con nombre por hash de contenido ---
+class PosterPipeline:
+    """
+    Procesa cada póster subido en segundo plano: calcula su hash, genera sus variantes y las anota en
+    poster_variants. La tabla posters dice qué póster tiene cada película, así que programar una sesión
+    o pintar la cartelera es una consulta y no un recorrido del disco. Como en el segmentado, los trabajos
+    viven en la base de datos y un póster con el mismo contenido que otro reutiliza sus variantes.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self._queue = LightQueue()
+        self._started = False
+
+    def start(self):
+        if self._started: return
+        self._started = True
+        for _ in range(self.workers): socketio.start_background_task(target=self._worker)
+        for row in db.query("SELECT movie FROM posters WHERE status IN (?, ?)", (JOB_QUEUED, JOB_RUNNING)):
+            self._queue.put(row['movie'])
+
+    def submit(self, movie, path):
+        """Registra el póster de la película y encola sus variantes, salvo que esta versión ya esté hecha o en cola."""
+        stat = os.stat(path)
+        def upsert(conn):
+            row = conn.execute("SELECT source, size, mtime, status FROM posters WHERE movie = ?", (movie,)).fetchone()
+            if row and row['status'] != JOB_FAILED and (row['source'], row['size'], row['mtime']) == (path, stat.st_size, stat.st_mtime):
+                return False
+            conn.execute("INSERT INTO posters (movie, source, size, mtime, status) VALUES (?, ?, ?, ?, ?) "
+                         "ON CONFLICT(movie) DO UPDATE SET source = excluded.source, size = excluded.size, mtime = excluded.mtime, "
+                         "status = excluded.status, content_hash = NULL, error = NULL, updated_at = CURRENT_TIMESTAMP",
+                         (movie, path, stat.st_size, stat.st_mtime, JOB_QUEUED))
+            return True
+        if not db.run(upsert, 'poster_enqueue'): return
+        if self._started: self._queue.put(movie)
+        self.start()
+
+    def _worker(self):
+        while True:
+            movie = self._queue.get()
+            try:
+                self._run_job(movie)
+            except Exception as e:
+                poster_log.exception("Póster de '%s' fallido", movie)
+                db.execute("UPDATE posters SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP WHERE movie = ?",
+                           (JOB_FAILED, str(e)[-500:], movie))
+
+    def _claim(self, movie):
+        """Reclama el trabajo (con varios workers todos lo ven); uno a medias solo se retoma si lleva JOB_STALE_SECONDS parado."""
+        def claim(conn):
+            job = conn.execute("SELECT * FROM posters WHERE movie = ?", (movie,)).fetchone()
+            claimed = conn.execute("UPDATE posters SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE movie = ? AND "
+                                   "(status = ? OR (status = ? AND updated_at < datetime('now', ?)))",
+                                   (JOB_RUNNING, movie, JOB_QUEUED, JOB_RUNNING, f'-{JOB_STALE_SECONDS} seconds')).rowcount
+            return job if claimed else None
+        return db.run(claim, 'poster_claim')
+
+    def _run_job(self, movie):
+        job = self._claim(movie)
+        if not job: return
+        content_hash = background.call(file_sha256, job['source'], priority=TASK_PRIORITY_LOW,
+                                       name=f"Hash del póster de {movie}")
+        variants = db.query("SELECT format, width, height, file FROM poster_variants WHERE content_hash = ?", (content_hash,))
+        if not variants or not all(os.path.exists(os.path.join(POSTER_VARIANTS_FOLDER, v['file'])) for v in variants):
+            variants = background.call(poster_worker.render_poster_variants, job['source'], content_hash, POSTER_VARIANTS_FOLDER,
+                                       POSTER_WIDTHS, POSTER_QUALITY, lane=LANE_CPU,
+                                       priority=TASK_PRIORITY_LOW, name=f"Variantes del póster de {movie}")
+            db.executemany("INSERT OR REPLACE INTO poster_variants (content_hash, format, width, height, file) VALUES (?, ?, ?, ?, ?)",
+                           [(content_hash, *variant) for variant in variants])
+        # Si mientras tanto se ha subido otro póster para la película, esta versión ya no cuenta
+        done = db.execute("UPDATE posters SET status = ?, content_hash = ?, updated_at = CURRENT_TIMESTAMP "
+                          "WHERE movie = ? AND source = ? AND size = ? AND mtime = ?",
+                          (JOB_DONE, content_hash, movie, job['source'], job['size'], job['mtime']))
+        if done:
+            cartelera_cache.invalidate()
+            poster_log.info("Póster de '%s': %d variantes (hash %s).", movie, len(variants), content_hash[:12])
+
+poster_pipeline = PosterPipeline(POSTER_WORKERS)
+
+def poster_variants_for(movies):
+    """
+    Variantes listas de los pósters de esas películas, en una sola consulta:
+    {película: {formato: [(ancho, fichero)] de menor a mayor}}.
+    """
+    if not movies: return {}
+    placeholders = ', '.join('?' * len(movies))
+    rows = db.query(f"SELECT p.movie, v.format, v.width, v.file FROM posters p JOIN poster_variants v ON v.content_hash = p.content_hash "
+                    f"WHERE p.status = ? AND p.movie IN ({placeholders}) ORDER BY v.width", (JOB_DONE, *movies))
+    variants = {}
+    for row in rows: variants.setdefault(row['movie'], {}).setdefault(row['format'], []).append((row['width'], row['file']))
+    return variants
+
 # --- 4. LÓGICA DEL PROYECCIONISTA Y CICLO DE VIDA ---
-class VirtualProjectionist(threading.Thread):
-    def __init__(self, session_id):
-        super().__init__()
-        self.session_id = session_id
-        self.stop_event = threading.Event()
-        self.daemon = True
-
-    def run(self):
-        print(f"[Projectionist {self.session_id}]: Hilo iniciado.")
-        while not self.stop_event.is_set():
-            socketio.sleep(1)
-            with sessions_lock:
-                if self.session_id not in active_sessions:
-                    self.stop()
+def playback_position(s_data, now=None):
+    """Posición de reproducción actual: ancla + tiempo transcurrido según el reloj monotónico."""
+    state = s_data['state']
+    if state.get('playing') and 'started_at' in s_data:
+        now = time.monotonic() if now is None else now
+        return state.get('time', 0) + (now - s_data['started_at'])
+    return state.get('time', 0)
+
+def anchored_state(view):
+    """
+    Copia del estado con un ancla de reloj de pared: 'time' es la posición exacta en el instante
+    'server_ts' (time.time() del servidor). El cliente la extrapola con el desfase de reloj que estima
+    con 'time_sync'. Vale tanto para la sesión (con su cerrojo) como para su vista publicada.
+    """
+    state = dict(view['state'])
+    state['time'] = round(playback_position(view), 3)
+    state['server_ts'] = round(time.time(), 3)
+    return state
+
+def pulse_payload(view):
+    state = anchored_state(view)
+    return {'time': state['time'], 'server_ts': state['server_ts'], 'current_video_index': state.get('current_video_index'),
+            'seq': view['state_seq']}
+
+def state_delta(s_data):
+    """
+    Cambio de estado para la sala: solo los campos que difieren de lo último difundido (el ancla time/server_ts
+    va siempre) y el siguiente número de secuencia. Llamar con el cerrojo, antes de publish_snapshot y de emitir.
+    Un cliente que vea un hueco en 'seq' (también en la de los pulsos) se ha perdido algo y pide 'request_state_sync'.
+    """
+    state = anchored_state(s_data)
+    sent, s_data.state_sent = s_data.state_sent, state
+    s_data.state_seq += 1
+    changes = {key: value for key, value in state.items() if sent.get(key) != value}
+    changes['time'], changes['server_ts'] = state['time'], state['server_ts'] # El ancla va entera aunque 'time' no cambie
+    return {'seq': s_data.state_seq, 'changes': changes}
+
+def state_snapshot(view):
+    """Estado completo con su número de secuencia: al unirse a la sala y al pedir resincronización."""
+    return {'seq': view['state_seq'], 'state': anchored_state(view)}
+
+def room_payload(s_data):
+    """
+    'room_state' de la sesión (estado anclado, seq y playlist), codificado una vez y compartido por todos los
+    que se unen hasta que publish_snapshot lo descarta. El ancla sigue valiendo mientras el estado no cambie.
+    Llamar con el cerrojo de la sesión.
+    """
+    if s_data.room_payload is None:
+        s_data.room_payload = CachedEmit('room_state', {**state_snapshot(s_data), 'playlist': s_data.playlist})
+    return s_data.room_payload
+
+def anchor_playback(s_data, now=None):
+    """Congela la posición actual en state['time'] y reinicia el ancla. Llamar con el cerrojo de la sesión."""
+    now = time.monotonic() if now is None else now
+    s_data['state']['time'] = round(playback_position(s_data, now), 3)
+    s_data['started_at'] = now
+
+class PlaybackScheduler:
+    """
+    Proyeccionista único para todas las sesiones activas.
+    Guarda los próximos eventos (pulso de sincronización o fin de vídeo) en un montículo
+    ordenado por plazo y solo se despierta cuando vence alguno, en lugar de un hilo por sesión.
+    Los pulsos son adaptativos: tras cada cambio de estado salen cada PULSE_INTERVAL_SECONDS y el
+    intervalo se duplica hasta PULSE_MAX_INTERVAL_SECONDS; un 'sync_report' lo devuelve al mínimo.
+    """
+    def __init__(self):
+        self._heap = []             # (deadline, seq, session_id, kind, generation)
+        self._generations = {}      # session_id -> generación vigente; las entradas antiguas se descartan
+        self._seq = itertools.count() # También numera las generaciones: nunca se repiten aunque la sesión se quite y vuelva
+        self._heap_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started = False
+
+    def start(self):
+        with self._heap_lock:
+            if self._started: return
+            self._started = True
+        socketio.start_background_task(target=self._run)
+        projection_log.info("Planificador de reproducción iniciado.")
+
+    def schedule(self, session_id):
+        """(Re)calcula los plazos de una sesión. Llamar con su cerrojo tras cambiar su estado."""
+        s_data = active_sessions.get(session_id)
+        if not s_data or not cluster.owns(session_id): return self.remove(session_id)
+        state = s_data.state
+        now = time.monotonic()
+        s_data['pulse_interval'] = PULSE_INTERVAL_SECONDS
+        with self._heap_lock:
+            generation = self._generations[session_id] = next(self._seq)
+            if state.get('status') == STATUS_ACTIVE and state.get('playing'):
+                duration = s_data.playlist[state['current_video_index']].get('duration', DEFAULT_MOVIE_DURATION)
+                remaining = max(0, duration - playback_position(s_data, now))
+                heapq.heappush(self._heap, (now + remaining, next(self._seq), session_id, 'end', generation))
+                if remaining > PULSE_INTERVAL_SECONDS:
+                    heapq.heappush(self._heap, (now + PULSE_INTERVAL_SECONDS, next(self._seq), session_id, 'pulse', generation))
+        self.start()
+        self._wakeup.set()
+
+    def remove(self, session_id):
+        with self._heap_lock:
+            self._generations.pop(session_id, None)
+
+    def _next_due(self, now):
+        """Extrae la siguiente entrada vigente ya vencida, o devuelve el tiempo hasta la próxima."""
+        with self._heap_lock:
+            while self._heap:
+                deadline, _, session_id, kind, generation = self._heap[0]
+                if self._generations.get(session_id) != generation:
+                    heapq.heappop(self._heap)
                     continue
-                
-                s_data = active_sessions[self.session_id]
-                state = s_data['state']
-
-                # Solo avanzar el tiempo si la sesión está ACTIVA y en PLAY
-                if state.get('status') == STATUS_ACTIVE and state.get('playing'):
-                    state['time'] += 1
-                    current_video_info = s_data['playlist'][state['current_video_index']]
-                    duration = current_video_info.get('duration', 3600)
-                    
-                    if state['time'] >= duration:
-                        self.next_video()
-                    else:
-                        # Solo enviar pulso si hay alguien en la sala de cine
-                        if s_data['users']['watch_room']:
-                           socketio.emit('sync_pulse', {'time': state['time']}, to=self.session_id)
-
-        print(f"[Projectionist {self.session_id}]: Hilo detenido.")
-
-    def next_video(self):
-        # Esta función ya se llama desde dentro de un 'with sessions_lock'
-        s_data = active_sessions[self.session_id]
-        state = s_data['state']
-        state['current_video_index'] += 1
-        
-        if state['current_video_index'] >= len(s_data['playlist']):
-            self.finish_session()
+                if deadline > now:
+                    return None, deadline - now
+                heapq.heappop(self._heap)
+                return (deadline, session_id, kind, generation), 0
+            return None, None
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            entry, timeout = self._next_due(time.monotonic())
+            if entry is None:
+                self._wakeup.wait(timeout)
+                continue
+            deadline, session_id, kind, generation = entry
+            SCHEDULER_LATENESS_SECONDS.observe(time.monotonic() - deadline, 'projectionist', kind)
+            try:
+                self._fire(session_id, kind, deadline, generation)
+            except Exception:
+                projection_log.exception("Error en '%s' de la sesión %s", kind, session_id)
+
+    def _fire(self, session_id, kind, deadline, generation):
+        with locked_session(session_id) as s_data:
+            if not s_data: return self.remove(session_id)
+            if kind == 'end':
+                next_video(session_id)
+            elif s_data.users['watch_room']:
+                # Solo enviar pulso si hay alguien en la sala de cine
+                EMIT_FANOUT.observe(len(s_data.users['watch_room']), 'sync_pulse')
+                after_unlock(socketio.emit, 'sync_pulse', pulse_payload(s_data), to=session_id)
+            if kind == 'pulse':
+                self._push_pulse(s_data, session_id, deadline, generation)
+
+    def _push_pulse(self, s_data, session_id, last_deadline, generation):
+        state = s_data.state
+        now = time.monotonic()
+        interval = s_data['pulse_interval'] = min(s_data.get('pulse_interval', PULSE_INTERVAL_SECONDS) * 2, PULSE_MAX_INTERVAL_SECONDS)
+        next_deadline = max(last_deadline + interval, now)
+        duration = s_data.playlist[state['current_video_index']].get('duration', DEFAULT_MOVIE_DURATION)
+        # No programar pulsos más allá del final del vídeo: la transición ya recalcula los plazos
+        if next_deadline - now < duration - playback_position(s_data, now):
+            with self._heap_lock:
+                if self._generations.get(session_id) == generation:
+                    heapq.heappush(self._heap, (next_deadline, next(self._seq), session_id, 'pulse', generation))
+
+projection_scheduler = PlaybackScheduler()
+
+def next_video(session_id):
+    # Esta función ya se llama con el cerrojo de la sesión tomado
+    s_data = active_sessions[session_id]
+    state = s_data.state
+    state['current_video_index'] += 1
+
+    if state['current_video_index'] >= len(s_data.playlist):
+        finish_session(session_id)
+    else:
+        state['time'] = 0
+        state['playing'] = True # Continuar reproduciendo automáticamente
+        s_data['started_at'] = time.monotonic()
+        next_video = s_data.playlist[state['current_video_index']]
+        projection_log.info("Sesión %s: cambiando al siguiente vídeo: %s", session_id, next_video['src'])
+        projection_scheduler.schedule(session_id)
+        delta = state_delta(s_data)
+        publish_snapshot(s_data)
+        after_unlock(socketio.emit, 'play_next_video', delta, to=session_id)
+
+def finish_session(session_id):
+    # Esta función ya se llama con el cerrojo de la sesión tomado
+    s_data = active_sessions[session_id]
+    state = s_data.state
+    state['status'] = STATUS_FINISHED
+    state['playing'] = False
+    s_data['close_timer_start'] = time.time()
+    projection_scheduler.remove(session_id)
+    schedule_monitor.push(session_id, 'post_show', s_data['close_timer_start'] + POST_SHOW_CLOSE_MINUTES * 60)
+    publish_snapshot(s_data)
+    projection_log.info("Sesión %s finalizada.", session_id)
+    after_unlock(socketio.emit, 'session_finished', to=session_id)
+
+class Session:
+    """
+    Estado en memoria de una sesión, con campos fijos en __slots__ en lugar de un dict por sesión.
+    Las rutas calientes leen los campos como atributos (s_data.state); también se puede leer como un
+    diccionario (s_data['state']), así que las funciones que aceptan tanto la sesión como su vista
+    publicada valen para ambas. Los campos opcionales (started_at, countdown_ends_at...) no existen
+    hasta que se asignan, igual que las claves de un dict.
+    """
+    __slots__ = ('db_id', 'movie_title', 'poster_file', 'playlist', 'scheduled_time', 'users', 'chat', 'state',
+                 'state_seq', 'state_sent', 'muted_users', 'lock', 'snapshot', 'room_payload', 'started_at', 'pulse_interval', 'close_timer_start', 'countdown_ends_at')
+
+    def __init__(self, **fields):
+        self.update(fields)
+
+    def __getitem__(self, key):
+        if key not in self: raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in Session.__slots__ and hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self else default
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default: return default[0]
+            raise KeyError(key)
+        value = getattr(self, key)
+        delattr(self, key)
+        return value
+
+    def setdefault(self, key, default):
+        if key not in self: setattr(self, key, default)
+        return getattr(self, key)
+
+    def update(self, fields):
+        for key, value in fields.items(): setattr(self, key, value)
+
+def new_session_data(session_id, movie_title, poster_file, playlist, scheduled_time, state):
+    return Session(
+        db_id=session_id, movie_title=movie_title, poster_file=poster_file,
+        playlist=playlist, scheduled_time=scheduled_time,
+        users={'vestibule': {}, 'watch_room': {}}, # sid -> Viewer
+        chat={'vestibule': ChatLog(), 'watch_room': ChatLog()},
+        state=state, state_seq=0, state_sent={}, muted_users=set(), room_payload=None
+    )
+
+def load_live_record(s_data, row, resume):
+    """
+    Vuelca en s_data (nueva, o una réplica con sus espectadores) lo guardado en live_sessions.
+    La posición se lleva hasta ahora con el tiempo transcurrido desde el guardado, pasando al vídeo
+    siguiente si hace falta. Con 'resume' (este worker va a llevar el reloj) una cuenta atrás
+    interrumpida se da por terminada: se empieza ya, desde donde estaría.
+    """
+    record = json.loads(row['data'])
+    playlist = record['playlist']; state = record['state']
+    now = time.time()
+    if state['status'] == STATUS_ACTIVE:
+        if resume and 'countdown_ends_at' in record:
+            state['playing'] = True
+            state['time'] = max(0, now - record['countdown_ends_at'])
+            del record['countdown_ends_at']
+        elif state.get('playing'):
+            state['time'] += now - record['saved_at']
+        while state['current_video_index'] < len(playlist):
+            duration = playlist[state['current_video_index']].get('duration', DEFAULT_MOVIE_DURATION)
+            if state['time'] < duration: break
+            state['time'] -= duration
+            state['current_video_index'] += 1
+    s_data.update({'movie_title': record['movie_title'], 'poster_file': record['poster_file'], 'playlist': playlist,
+                   'scheduled_time': datetime.fromisoformat(record['scheduled_time']), 'state': state,
+                   'state_seq': record.get('state_seq', 0) + (STATE_SEQ_TAKEOVER_GAP if resume else 0), 'state_sent': {},
+                   'muted_users': set(record['muted_users']), 'started_at': time.monotonic(), 'room_payload': None})
+    for key in ('countdown_ends_at', 'close_timer_start'):
+        if key in record: s_data[key] = record[key]
+        else: s_data.pop(key, None)
+    chat = json.loads(row['chat'])
+    s_data['chat'] = {room: ChatLog.load(chat.get(room, {})) for room in ('vestibule', 'watch_room')}
+    return s_data
+
+def restore_live_session(row):
+    """Da de alta (o toma, si ya había réplica) una sesión guardada y reanuda su proyeccionista. Este worker debe ser su líder."""
+    session_id = row['id']
+    _, created = active_sessions.add(session_id, load_live_record(new_session_data(session_id, None, None, [], None, {}), row, resume=True))
+    with locked_session(session_id) as s:
+        if not s: return
+        if not created: load_live_record(s, row, resume=True) # Había réplica: se conservan sus espectadores locales
+        state = s['state']
+        if state['status'] == STATUS_ACTIVE:
+            if state['current_video_index'] >= len(s['playlist']):
+                state['current_video_index'] = len(s['playlist']) - 1
+                finish_session(session_id)
+            else:
+                projection_scheduler.schedule(session_id)
+        elif state['status'] == STATUS_FINISHED:
+            s.setdefault('close_timer_start', time.time())
+            schedule_monitor.push(session_id, 'post_show', s['close_timer_start'] + POST_SHOW_CLOSE_MINUTES * 60)
         else:
-            state['time'] = 0
-            state['playing'] = True # Continuar reproduciendo automáticamente
-            next_video = s_data['playlist'][state['current_video_index']]
-            print(f"[Projectionist {self.session_id}]: Cambiando al siguiente vídeo: {next_video['src']}")
-            socketio.emit('play_next_video', {'state': state}, to=self.session_id)
-
-    def finish_session(self):
-        # Esta función ya se llama desde dentro de un 'with sessions_lock'
-        s_data = active_sessions[self.session_id]
-        state = s_data['state']
-        state['status'] = STATUS_FINISHED
-        state['playing'] = False
-        s_data['close_timer_start'] = time.time()
-        print(f"[Projectionist {self.session_id}]: Sesión finalizada.")
-        socketio.emit('session_finished', to=self.session_id)
-        self.stop() # Detener el hilo del proyeccionista
-
-    def stop(self):
-        self.stop_event.set()
-
-def schedule_monitor():
-    """
-    Hilo en segundo plano que gestiona el ciclo de vida de las sesiones:
-    1. Auto-inicia sesiones cuya hora programada ha llegado.
-    2. Cierra sesiones vacías o que han finalizado hace tiempo.
-    """
-    print("[Monitor]: El monitor de sesiones está activo.")
-    while True:
-        socketio.sleep(5) # Revisar cada 5 segundos
-        now = datetime.now()
-        sessions_to_start = []
-        sessions_to_close = []
-
-        with sessions_lock:
-            for session_id, data in list(active_sessions.items()):
-                # Lógica de auto-inicio
-                if data['state'].get('status') == STATUS_VESTIBULE and now >= data.get('scheduled_time'):
-                    sessions_to_start.append(session_id)
-
-                # Lógica de cierre de sala vacía
-                is_empty = not data['users']['vestibule'] and not data['users']['watch_room']
-                if is_empty:
-                    if 'empty_timer_start' not in data:
-                        data['empty_timer_start'] = time.time()
-                    elif time.time() - data.get('empty_timer_start', 0) > EMPTY_ROOM_CLOSE_MINUTES * 60:
-                        sessions_to_close.append(session_id)
-                elif 'empty_timer_start' in data:
-                    del data['empty_timer_start']
-                
-                # Lógica de cierre post-función
-                if data['state'].get('status') == STATUS_FINISHED and time.time() - data.get('close_timer_start', 0) > POST_SHOW_CLOSE_MINUTES * 60:
-                    sessions_to_close.append(session_id)
-        
-        # Ejecutar acciones fuera del bucle principal para evitar problemas de concurrencia
-        for session_id in set(sessions_to_start):
-            print(f"[Monitor]: La hora programada para la sesión {session_id} ha llegado. Iniciando...")
-            start_projection(session_id)
+            schedule_monitor.track(session_id, s['scheduled_time'])
+        publish_snapshot(s)
+        live_state.mark(session_id, chat=True)
+
+def restore_live_sessions():
+    """
+    Arranque en caliente: vuelve a dar de alta las sesiones guardadas en live_sessions. Los espectadores
+    vuelven solos: sus sockets reconectan y repiten el 'join'. En modo multiproceso solo se restauran las
+    sesiones cuyo arriendo consigue este worker; las demás quedan como réplicas.
+    """
+    started = time.time()
+    rows = [row for row in db.query("SELECT id, data, chat FROM live_sessions") if cluster.acquire(row['id'])]
+    for row in rows: restore_live_session(row)
+    if rows: session_log.info("%d sesiones en directo restauradas en %.2fs.", len(rows), time.time() - started)
+
+class ClusterCoordinator:
+    """
+    Reparto de sesiones entre workers cuando hay cola de mensajes (SOCKETIO_MESSAGE_QUEUE).
+    Cada sesión tiene un líder elegido con un arriendo en session_leases: solo él lleva su reloj, su chat
+    y su ciclo de vida, y guarda su estado en live_sessions. Los demás workers tienen una réplica de solo
+    lectura que refrescan desde ahí, atienden sus propios sockets (cualquier worker acepta cualquier 'join')
+    y dejan al líder en session_commands lo que modifica la sesión. Cada worker publica cuántos espectadores
+    tiene por sesión en session_presence. Si un líder cae, otro worker toma sus sesiones al caducar el arriendo.
+    Sin cola de mensajes hay un solo proceso, que es líder de todo, y nada de esto se usa.
+    """
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self._owned = set()
+        self._replicated = set()   # Réplicas ya vistas en live_sessions: si desaparecen de ahí, la sesión ha terminado
+        self._presence_dirty = set()
+        self._last_refresh = 0
+        self._started = False
+
+    def start(self):
+        if not self.enabled or self._started: return
+        self._started = True
+        socketio.start_background_task(target=self._run)
+        cluster_log.info("Worker %s en modo multiproceso.", WORKER_ID)
+
+    def owns(self, session_id):
+        return not self.enabled or session_id in self._owned
+
+    def acquire(self, session_id):
+        """Intenta hacerse con el arriendo de la sesión. Devuelve True si este worker queda como líder."""
+        if not self.enabled: return True
+        now = time.time()
+        def claim(conn):
+            conn.execute("INSERT INTO session_leases (session_id, owner, expires_at) VALUES (?, ?, ?) "
+                         "ON CONFLICT(session_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                         "WHERE session_leases.owner = excluded.owner OR session_leases.expires_at < ?",
+                         (session_id, WORKER_ID, now + CLUSTER_LEASE_SECONDS, now))
+            return conn.execute("SELECT owner FROM session_leases WHERE session_id = ?", (session_id,)).fetchone()['owner'] == WORKER_ID
+        if not db.run(claim, 'lease_acquire'): return False
+        self._owned.add(session_id)
+        return True
+
+    def release(self, session_id):
+        if not self.enabled or session_id not in self._owned: return
+        self._owned.discard(session_id)
+        db.execute("DELETE FROM session_leases WHERE session_id = ? AND owner = ?", (session_id, WORKER_ID))
+
+    def forward(self, session_id, kind, payload):
+        """Si el líder de la sesión es otro worker, le deja el comando y devuelve True; si es este, devuelve False."""
+        if self.owns(session_id): return False
+        db.execute("INSERT INTO session_commands (session_id, kind, payload) VALUES (?, ?, ?)", (session_id, kind, json.dumps(payload)))
+        return True
+
+    def viewers_changed(self, session_id):
+        if self.enabled: self._presence_dirty.add(session_id)
 
-        for session_id in set(sessions_to_close):
-            print(f"[Monitor]: Cerrando sesión inactiva/finalizada {session_id}")
-            with sessions_lock:
-                if session_id in active_sessions:
-                    if 'projectionist_thread' in active_sessions[session_id]:
-                        active_sessions[session_id]['projectionist_thread'].stop()
-                    del active_sessions[session_id]
-            conn = get_db_connection()
-            conn.execute("UPDATE sessions SET status = ? WHERE id = ?", (STATUS_FINISHED, session_id))
-            conn.commit(); conn.close()
-            socketio.emit('admin_panel_update')
+    def viewer_counts(self, session_id):
+        """(vestíbulo, sala) sumando los espectadores de todos los workers vivos."""
+        if not self.enabled:
+            snapshot = active_sessions.snapshot(session_id)
+            return (snapshot['user_count_vestibule'], snapshot['user_count_watch_room']) if snapshot else (0, 0)
+        row = db.query_one("SELECT COALESCE(SUM(vestibule), 0) AS vestibule, COALESCE(SUM(watch_room), 0) AS watch_room "
+                           "FROM session_presence WHERE session_id = ? AND updated_at >= ?", (session_id, time.time() - CLUSTER_LEASE_SECONDS))
+        return row['vestibule'], row['watch_room']
+
+    def load_replica(self, session_id, s_db=None):
+        """
+        Réplica de solo lectura de una sesión que lleva otro worker, desde live_sessions; si el líder aún no
+        la ha guardado, desde la fila de sessions (s_db). Devuelve la sesión registrada o None.
+        """
+        if not self.enabled: return None
+        row = db.query_one("SELECT id, data, chat FROM live_sessions WHERE id = ?", (session_id,))
+        if row:
+            s_data = load_live_record(new_session_data(session_id, None, None, [], None, {}), row, resume=False)
+            self._replicated.add(session_id)
+        elif s_db:
+            s_data = new_session_data(session_id, s_db['movie_title'], s_db['poster_file'], with_hls_manifests(json.loads(s_db['playlist'])),
+                                      datetime.fromisoformat(s_db['scheduled_time']), {'status': STATUS_VESTIBULE, 'chat_enabled': True})
+        else:
+            return None
+        s_data, _ = active_sessions.add(session_id, s_data)
+        return s_data
+
+    def _run(self):
+        last_renew = 0
+        while True:
+            socketio.sleep(CLUSTER_COMMAND_POLL_SECONDS)
+            try:
+                self._run_commands()
+                if self._presence_dirty:
+                    dirty, self._presence_dirty = self._presence_dirty, set()
+                    self._publish_presence(dirty)
+                if time.time() - self._last_refresh >= CLUSTER_REPLICA_REFRESH_SECONDS:
+                    self._refresh_replicas()
+                if time.time() - last_renew >= CLUSTER_RENEW_SECONDS:
+                    last_renew = time.time()
+                    self._renew()
+                    self._publish_presence([session_id for session_id, _ in active_sessions.items()])
+                    self._adopt_orphans()
+            except Exception:
+                cluster_log.exception("Error en el bucle de coordinación")
+
+    def _run_commands(self):
+        if not self._owned: return
+        def take(conn):
+            rows = conn.execute("SELECT c.id, c.session_id, c.kind, c.payload FROM session_commands c "
+                                "JOIN session_leases l ON l.session_id = c.session_id WHERE l.owner = ? ORDER BY c.id", (WORKER_ID,)).fetchall()
+            conn.executemany("DELETE FROM session_commands WHERE id = ?", [(row['id'],) for row in rows])
+            return rows
+        for row in db.run(take, 'cluster_commands'):
+            try: CLUSTER_COMMANDS[row['kind']](row['session_id'], json.loads(row['payload']))
+            except Exception: cluster_log.exception("Error en el comando '%s' de la sesión %s", row['kind'], row['session_id'])
+
+    def _publish_presence(self, session_ids):
+        rows = []
+        now = time.time()
+        for session_id in session_ids:
+            snapshot = active_sessions.snapshot(session_id)
+            counts = (snapshot['user_count_vestibule'], snapshot['user_count_watch_room']) if snapshot else (0, 0)
+            rows.append((session_id, WORKER_ID, *counts, now))
+        if rows:
+            db.executemany("INSERT INTO session_presence (session_id, worker, vestibule, watch_room, updated_at) VALUES (?, ?, ?, ?, ?) "
+                           "ON CONFLICT(session_id, worker) DO UPDATE SET vestibule = excluded.vestibule, "
+                           "watch_room = excluded.watch_room, updated_at = excluded.updated_at", rows)
+
+    def _renew(self):
+        now = time.time()
+        before = set(self._owned)
+        def renew(conn):
+            conn.execute("UPDATE session_leases SET expires_at = ? WHERE owner = ?", (now + CLUSTER_LEASE_SECONDS, WORKER_ID))
+            conn.execute("DELETE FROM session_presence WHERE updated_at < ?", (now - 10 * CLUSTER_LEASE_SECONDS,))
+            return {row['session_id'] for row in conn.execute("SELECT session_id FROM session_leases WHERE owner = ?", (WORKER_ID,))}
+        # Arriendos perdidos (p. ej. el proceso estuvo parado más de CLUSTER_LEASE_SECONDS): la sesión pasa a ser réplica
+        for session_id in before - db.run(renew, 'lease_renew'):
+            cluster_log.warning("Worker %s ha perdido la sesión %s; queda como réplica.", WORKER_ID, session_id)
+            self._owned.discard(session_id)
+            projection_scheduler.remove(session_id)
+            self._replicated.add(session_id)
+
+    def _adopt_orphans(self):
+        """Toma las sesiones guardadas cuyo líder ha dejado caducar el arriendo."""
+        rows = db.query("SELECT id, data, chat FROM live_sessions WHERE id NOT IN (SELECT session_id FROM session_leases WHERE expires_at >= ?)", (time.time(),))
+        for row in rows:
+            if self.acquire(row['id']):
+                cluster_log.info("Worker %s toma la sesión %s.", WORKER_ID, row['id'])
+                restore_live_session(row)
+
+    def _refresh_replicas(self):
+        self._last_refresh = time.time()
+        replicas = [session_id for session_id, _ in active_sessions.items() if session_id not in self._owned]
+        if not replicas: return
+        marks = ', '.join('?' * len(replicas))
+        rows = {row['id']: row for row in db.query(f"SELECT id, data, chat FROM live_sessions WHERE id IN ({marks})", replicas)}
+        for session_id in replicas:
+            row = rows.get(session_id)
+            if row is None:
+                if session_id in self._replicated: # El líder la ha cerrado
+                    self._replicated.discard(session_id)
+                    active_sessions.remove(session_id)
+                continue
+            self._replicated.add(session_id)
+            with locked_session(session_id) as s:
+                if s and session_id not in self._owned:
+                    load_live_record(s, row, resume=False)
+                    publish_snapshot(s)
+
+cluster = ClusterCoordinator(bool(SOCKETIO_MESSAGE_QUEUE))
+
+def open_session(s_db, replica=True):
+    """
+    Abre en memoria el vestíbulo de una sesión de la base de datos. Si la lleva otro worker, crea una
+    réplica (salvo con replica=False). Devuelve la sesión registrada o None.
+    """
+    session_id = s_db['id']
+    if not cluster.acquire(session_id):
+        return cluster.load_replica(session_id, s_db) if replica else None
+    scheduled_time = datetime.fromisoformat(s_db['scheduled_time'])
+    s_data, created = active_sessions.add(session_id, new_session_data(
+        session_id, s_db['movie_title'], s_db['poster_file'], with_hls_manifests(json.loads(s_db['playlist'])),
+        scheduled_time, {'status': STATUS_VESTIBULE, 'chat_enabled': True}))
+    if created:
+        session_log.info("Creando sesión '%s' en memoria desde la base de datos.", session_id)
+        session_status_writer.set(session_id, STATUS_VESTIBULE)
+        schedule_monitor.track(session_id, scheduled_time)
+        admin_feed.mark(session_id)
+    return s_data
+
+def close_session(session_id):
+    monitor_log.info("Cerrando sesión inactiva/finalizada %s", session_id)
+    schedule_monitor.cancel(session_id)
+    if active_sessions.remove(session_id):
+        projection_scheduler.remove(session_id)
+    session_status_writer.set(session_id, STATUS_FINISHED) # Los cierres que coinciden van en una sola transacción
+    admin_feed.mark(session_id, STATUS_FINISHED)
+
+class ScheduleMonitor:
+    """
+    Ciclo de vida de las sesiones guiado por plazos, sin sondeo. Un montículo guarda el próximo evento
+    de cada sesión y tipo: apertura del vestíbulo ('open', VESTIBULE_OPEN_MINUTES antes), inicio
+    programado ('start'), cierre por sala vacía ('empty') y cierre tras la función ('post_show').
+    El hilo duerme justo hasta el plazo más cercano. Programar, borrar, entrar o salir empuja o cancela
+    entradas en O(log n); las canceladas se descartan al llegar a la cima (generaciones, como en
+    PlaybackScheduler) o al compactar el montículo cuando son mayoría, que si no una sesión de la
+    semana que viene las acumularía durante días. También lleva dos tareas periódicas: el archivado
+    y la relectura de la agenda.
+    """
+    KINDS = ('open', 'start', 'empty', 'post_show')
+
+    def __init__(self):
+        self._heap = []             # (deadline, seq, session_id, kind, generation); deadline en time.time()
+        self._generations = {}      # (session_id, kind) -> (generación vigente, su plazo)
+        self._seq = itertools.count()
+        self._heap_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started = False
+
+    def start(self):
+        with self._heap_lock:
+            if self._started: return
+            self._started = True
+        now = time.time()
+        self.push(None, 'archive', now)
+        self.push(None, 'resync', now)
+        socketio.start_background_task(target=self._run)
+        monitor_log.info("El monitor de sesiones está activo.")
+
+    def push(self, session_id, kind, deadline):
+        """(Re)programa el evento 'kind' de la sesión; sustituye al que hubiera del mismo tipo."""
+        with self._heap_lock:
+            current = self._generations.get((session_id, kind))
+            if current and current[1] == deadline: return # Ya está programado justo ahí
+            generation = next(self._seq)
+            self._generations[(session_id, kind)] = (generation, deadline)
+            heapq.heappush(self._heap, (deadline, next(self._seq), session_id, kind, generation))
+            if len(self._heap) > 2 * len(self._generations) + 64: self._compact()
+        self._wakeup.set()
+
+    def _compact(self):
+        """Quita del montículo las entradas sustituidas o canceladas. Llamar con _heap_lock."""
+        self._heap = [entry for entry in self._heap if self._generations.get((entry[2], entry[3]), (None,))[0] == entry[4]]
+        heapq.heapify(self._heap)
+
+    def cancel(self, session_id, kind=None):
+        with self._heap_lock:
+            for k in ([kind] if kind else self.KINDS): self._generations.pop((session_id, k), None)
+
+    def track(self, session_id, scheduled_time):
+        """Plazos de apertura e inicio de una sesión programada."""
+        start_at = scheduled_time.timestamp()
+        self.push(session_id, 'open', start_at - VESTIBULE_OPEN_MINUTES * 60)
+        self.push(session_id, 'start', start_at)
+
+    def occupancy_changed(self, s_data, empty):
+        """Se llama al publicar la sesión cuando pasa de tener espectadores a no tenerlos, o al revés."""
+        session_id = s_data['db_id']
+        if not empty: return self.cancel(session_id, 'empty')
+        # Un vestíbulo abierto con antelación no se cierra por estar vacío antes de la hora de inicio
+        scheduled_at = s_data['scheduled_time'].timestamp() if s_data.get('scheduled_time') else 0
+        self.push(session_id, 'empty', max(time.time(), scheduled_at) + EMPTY_ROOM_CLOSE_MINUTES * 60)
+
+    def _next_due(self, now):
+        with self._heap_lock:
+            while self._heap:
+                deadline, _, session_id, kind, generation = self._heap[0]
+                if self._generations.get((session_id, kind), (None,))[0] != generation:
+                    heapq.heappop(self._heap)
+                    continue
+                if deadline > now:
+                    return None, deadline - now
+                heapq.heappop(self._heap)
+                del self._generations[(session_id, kind)]
+                return (session_id, kind, deadline), 0
+            return None, None
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            entry, timeout = self._next_due(time.time())
+            if entry is None:
+                self._wakeup.wait(timeout)
+                continue
+            session_id, kind, deadline = entry
+            SCHEDULER_LATENESS_SECONDS.observe(time.time() - deadline, 'monitor', kind)
+            try:
+                self._fire(session_id, kind)
+            except Exception:
+                monitor_log.exception("Error en '%s' de la sesión %s", kind, session_id)
+
+    def _fire(self, session_id, kind):
+        if kind == 'archive':
+            self.push(None, 'archive', time.time() + SESSION_ARCHIVE_SWEEP_SECONDS)
+            archive_finished_sessions()
+        elif kind == 'resync':
+            self.push(None, 'resync', time.time() + SCHEDULE_RESYNC_SECONDS)
+            self._resync()
+        elif kind == 'open':
+            if session_id in active_sessions: return
+            s_db = db.query_one("SELECT * FROM sessions WHERE id = ? AND status != ?", (session_id, STATUS_FINISHED))
+            if not s_db: return self.cancel(session_id)
+            if open_session(s_db, replica=False): monitor_log.info("Vestíbulo de la sesión %s abierto.", session_id)
+        elif not cluster.owns(session_id) or session_id not in active_sessions:
+            return # Las réplicas las gestiona su líder
+        elif kind == 'start':
+            snapshot = active_sessions.snapshot(session_id)
+            if snapshot and snapshot['state'].get('status') == STATUS_VESTIBULE:
+                monitor_log.info("La hora programada para la sesión %s ha llegado. Iniciando...", session_id)
+                start_projection(session_id)
+        elif kind == 'empty' and sum(cluster.viewer_counts(session_id)):
+            # Vacía en este worker pero con espectadores en otros: volver a mirar más tarde
+            self.push(session_id, 'empty', time.time() + EMPTY_ROOM_CLOSE_MINUTES * 60)
+        else:
+            close_session(session_id)
+
+    def _resync(self):
+        """Plazos de las sesiones programadas que aún no se han abierto (las recientes ya vencidas se abren ya)."""
+        cutoff = (datetime.now() - timedelta(minutes=EMPTY_ROOM_CLOSE_MINUTES)).isoformat(timespec='minutes')
+        rows = db.query("SELECT id, scheduled_time FROM sessions WHERE status = ? AND scheduled_time >= ?", (STATUS_SCHEDULED, cutoff))
+        for row in rows:
+            if row['id'] not in active_sessions: self.track(row['id'], datetime.fromisoformat(row['scheduled_time']))
+
+schedule_monitor = ScheduleMonitor()
 
 # --- 5. RUTAS FLASK (Sin cambios importantes) ---
 @app.route('/')
 def index():
     return redirect(url_for('cartelera'))
 
-@app.route('/cartelera')
-def cartelera():
-    conn = get_db_connection()
-    sessions_db_raw = conn.execute("SELECT * FROM sessions WHERE status != ? ORDER BY scheduled_time ASC", (STATUS_FINISHED,)).fetchall()
-    conn.close()
+class CarteleraCache:
+    """
+    Cartelera ya renderizada, con su ETag. Se invalida al programar o borrar una sesión y cuando cambia
+    el estado de alguna (en memoria o en la base de datos); además caduca sola en la siguiente hora de
+    apertura de vestíbulo, que es el único cambio que depende solo del reloj.
+    """
+    def __init__(self):
+        self._generation = 0
+        self._entry = None # (generation, expires_at, body, etag)
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._generation += 1
+
+    def _fresh(self, entry):
+        return entry and entry[0] == self._generation and datetime.now() < entry[1]
+
+    def get(self, build):
+        entry = self._entry
+        if self._fresh(entry): return entry
+        with self._lock: # Una sola reconstrucción aunque lleguen cien peticiones a la vez
+            entry = self._entry
+            if self._fresh(entry): return entry
+            generation = self._generation # Si se invalida durante la reconstrucción, la entrada nace caducada
+            body, expires_at = build()
+            entry = self._entry = (generation, expires_at, body, hashlib.sha1(body).hexdigest())
+            return entry
+
+cartelera_cache = CarteleraCache()
+
+def poster_sources(variants):
+    """srcset por formato y una 'src' de respaldo (la variante JPEG de la tarjeta) para <picture>."""
+    srcset = {fmt: ', '.join(f"{url_for('serve_media', folder='posters', filename=file)} {width}w" for width, file in files)
+              for fmt, files in variants.items()}
+    fallback = variants.get('jpeg') or next(iter(variants.values()))
+    _, file = next(((width, file) for width, file in fallback if width >= 320), fallback[-1])
+    return {'srcset': srcset, 'src': url_for('serve_media', folder='posters', filename=file)}
+
+def render_cartelera():
+    sessions_db_raw = db.query("SELECT * FROM sessions WHERE status IN (?, ?, ?) ORDER BY scheduled_time ASC",
+                               (STATUS_SCHEDULED, STATUS_VESTIBULE, STATUS_ACTIVE))
+    posters = poster_variants_for(list({s_db['movie_title'] for s_db in sessions_db_raw}))
     sessions_processed = []
     now = datetime.now()
-    with sessions_lock:
-        for s_db in sessions_db_raw:
-            session_dict = dict(s_db)
-            scheduled_time = datetime.fromisoformat(session_dict['scheduled_time'])
-            open_time = scheduled_time - timedelta(minutes=VESTIBULE_OPEN_MINUTES)
-            session_dict['scheduled_time_obj'] = scheduled_time
-            # Determinar el estado a mostrar
-            status_in_memory = active_sessions.get(session_dict['id'], {}).get('state', {}).get('status')
-            if status_in_memory:
-                session_dict['display_status'] = status_in_memory
+    expires_at = now + timedelta(seconds=CLUSTER_CARTELERA_TTL_SECONDS) if cluster.enabled else datetime.max
+    for s_db in sessions_db_raw:
+        session_dict = dict(s_db)
+        scheduled_time = datetime.fromisoformat(session_dict['scheduled_time'])
+        open_time = scheduled_time - timedelta(minutes=VESTIBULE_OPEN_MINUTES)
+        session_dict['scheduled_time_obj'] = scheduled_time
+        if session_dict['movie_title'] in posters: session_dict['poster'] = poster_sources(posters[session_dict['movie_title']])
+        # Determinar el estado a mostrar (lectura sin cerrojo de la vista publicada)
+        snapshot = active_sessions.snapshot(session_dict['id'])
+        status_in_memory = snapshot['state'].get('status') if snapshot else None
+        if status_in_memory:
+            session_dict['display_status'] = status_in_memory
+        else:
+            if now >= scheduled_time: session_dict['display_status'] = STATUS_VESTIBULE
+            elif now >= open_time: session_dict['display_status'] = STATUS_VESTIBULE
             else:
-                if now >= scheduled_time: session_dict['display_status'] = STATUS_VESTIBULE
-                elif now >= open_time: session_dict['display_status'] = STATUS_VESTIBULE
-                else: session_dict['display_status'] = STATUS_SCHEDULED
-            sessions_processed.append(session_dict)
-    return render_template("cartelera.html", sessions=sessions_processed)
+                session_dict['display_status'] = STATUS_SCHEDULED
+                expires_at = min(expires_at, open_time)
+        sessions_processed.append(session_dict)
+    return render_template("cartelera.html", sessions=sessions_processed).encode(), expires_at
+
+@app.route('/cartelera')
+def cartelera():
+    _, _, body, etag = cartelera_cache.get(render_cartelera)
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache' # El navegador revalida siempre; si no ha cambiado recibe un 304
+    return response.make_conditional(request)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -244,25 +2120,31 @@ def logout():
 
 @app.route('/admin')
 def admin_panel():
+    # La lista de sesiones y trabajos la pinta el navegador desde /admin/snapshot y los deltas de '/admin'
     if not is_admin(): return redirect(url_for('login'))
-    conn = get_db_connection()
-    sessions_db = conn.execute("SELECT * FROM sessions ORDER BY scheduled_time DESC").fetchall()
-    conn.close()
-    all_sessions_data = []
-    with sessions_lock:
-        for s_db in sessions_db:
-            data = dict(s_db)
-            if data['id'] in active_sessions:
-                active_data = active_sessions[data['id']]
-                data['current_status_in_memory'] = active_data['state'].get('status', 'N/A')
-                data['user_count_vestibule'] = len(active_data['users']['vestibule'])
-                data['user_count_watch_room'] = len(active_data['users']['watch_room'])
-            else:
-                data['current_status_in_memory'] = data['status']
-                data['user_count_vestibule'] = 0
-                data['user_count_watch_room'] = 0
-            all_sessions_data.append(data)
-    return render_template("admin_panel.html", movies=get_available_movies(), sessions=all_sessions_data)
+    return render_template("admin_panel.html", movies=get_available_movies())
+
+ADMIN_SESSION_COLUMNS = "id, movie_title, poster_file, scheduled_time, status"
+
+def admin_session_row(s_db):
+    data = dict(s_db)
+    data.update(admin_live_fields(data['id'], data['status']))
+    return data
+
+@app.route('/admin/snapshot')
+def admin_snapshot():
+    """Carga inicial del panel: sesiones con sus contadores en memoria, últimos trabajos de procesado y tareas en segundo plano."""
+    if not is_admin(): return jsonify({'error': 'No autorizado'}), 403
+    sessions_db = db.query(f"SELECT {ADMIN_SESSION_COLUMNS} FROM sessions ORDER BY scheduled_time DESC")
+    transcode_jobs = db.query("SELECT id, source, status, progress, manifest, error FROM transcode_jobs ORDER BY created_at DESC LIMIT 20")
+    return jsonify({'sessions': [admin_session_row(s_db) for s_db in sessions_db],
+                    'transcode_jobs': [dict(job) for job in transcode_jobs],
+                    'background_tasks': background.snapshot()})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Métricas de este worker en el formato de texto de Prometheus (cada worker se consulta por separado)."""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -271,12 +2153,130 @@ def upload_file():
     if not all([movie_file, poster_file, allowed_file(movie_file.filename), allowed_image_file(poster_file.filename)]):
         return redirect(url_for('admin_panel'))
     movie_filename = secure_filename(movie_file.filename)
-    movie_file.save(os.path.join(app.config['UPLOAD_FOLDER'], movie_filename))
-    poster_ext = poster_file.filename.rsplit('.', 1)[1].lower()
-    poster_filename = f"{os.path.splitext(movie_filename)[0]}.{poster_ext}"
-    poster_file.save(os.path.join('static/posters', secure_filename(poster_filename)))
+    movie_path = os.path.join(app.config['UPLOAD_FOLDER'], movie_filename)
+    background.call(movie_file.save, movie_path, priority=TASK_PRIORITY_HIGH, name=f"Guardado de {movie_filename}")
+    catalog_media(movie_path) # Catalogar ya: programar la sesión será una simple consulta
+    transcoder.submit(movie_path)
+    save_poster(poster_file, movie_filename)
     return redirect(url_for('admin_panel'))
 
+def save_poster(poster_file, movie_filename):
+    """Guarda el original y encola sus variantes; la petición no espera a Pillow."""
+    poster_ext = poster_file.filename.rsplit('.', 1)[1].lower()
+    poster_filename = secure_filename(f"{os.path.splitext(movie_filename)[0]}.{poster_ext}")
+    poster_path = os.path.join(POSTERS_FOLDER, poster_filename)
+    background.call(poster_file.save, poster_path, priority=TASK_PRIORITY_HIGH, name=f"Guardado de {poster_filename}")
+    poster_pipeline.submit(os.path.splitext(poster_filename)[0], poster_path)
+
+# --- Subida por fragmentos reanudable: el vídeo se escribe directamente en UPLOAD_FOLDER ---
+upload_locks = {}
+
+def _upload_part_path(upload_id):
+    # Uno por subida (dos a medias con el mismo nombre no comparten fichero); el sufijo .part evita que
+    # get_available_movies lo vea hasta que esté completo y se renombre a su nombre definitivo
+    return os.path.join(app.config['UPLOAD_FOLDER'], upload_id + '.part')
+
+def _upload_status(upload_id):
+    row = db.query_one("SELECT * FROM uploads WHERE id = ?", (upload_id,))
+    if not row: return None
+    offset = row['received']
+    if row['status'] == UPLOAD_IN_PROGRESS:
+        # Tras una caída, lo que haya en disco manda sobre lo anotado en la base de datos
+        part_path = _upload_part_path(row['id'])
+        offset = min(offset, os.path.getsize(part_path) if os.path.exists(part_path) else 0)
+    return {'upload_id': row['id'], 'filename': row['filename'], 'size': row['size'], 'offset': offset, 'status': row['status']}
+
+def _append_block(f, digest, block):
+    digest.update(block)
+    f.write(block)
+
+def _sync_file(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+@app.route('/upload/chunked', methods=['POST'])
+def upload_chunked_start():
+    """Abre (o reanuda, si ya hay una a medias con el mismo nombre y tamaño) una subida por fragmentos."""
+    if not is_admin(): return jsonify({'error': 'No autorizado'}), 403
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename', '')); size = data.get('size')
+    if not allowed_file(filename) or not isinstance(size, int) or size <= 0:
+        return jsonify({'error': 'Fichero de vídeo no válido'}), 400
+    def find_or_insert(conn):
+        row = conn.execute("SELECT id FROM uploads WHERE filename = ? AND size = ? AND status = ?", (filename, size, UPLOAD_IN_PROGRESS)).fetchone()
+        if row: return row['id']
+        upload_id = uuid.uuid4().hex
+        conn.execute("INSERT INTO uploads (id, filename, size, status) VALUES (?, ?, ?, ?)", (upload_id, filename, size, UPLOAD_IN_PROGRESS))
+        return upload_id
+    return jsonify(_upload_status(db.run(find_or_insert, 'upload_start')))
+
+@app.route('/upload/chunked/<upload_id>', methods=['GET'])
+def upload_chunked_status(upload_id):
+    if not is_admin(): return jsonify({'error': 'No autorizado'}), 403
+    status = _upload_status(upload_id)
+    return jsonify(status) if status else (jsonify({'error': 'Subida desconocida'}), 404)
+
+@app.route('/upload/chunked/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """
+    Recibe un fragmento en bruto. Cabeceras: 'Upload-Offset' (debe coincidir con lo ya recibido)
+    y 'X-Chunk-Sha256'. El cuerpo se copia por bloques al fichero final, sin pasar por un temporal.
+    """
+    if not is_admin(): return jsonify({'error': 'No autorizado'}), 403
+    lock = upload_locks.setdefault(upload_id, threading.Lock())
+    if not lock.acquire(blocking=False): return jsonify({'error': 'Ya se está recibiendo un fragmento de esta subida'}), 409
+    try:
+        status = _upload_status(upload_id)
+        if not status: return jsonify({'error': 'Subida desconocida'}), 404
+        if status['status'] != UPLOAD_IN_PROGRESS: return jsonify(status), 409
+        offset = request.headers.get('Upload-Offset', type=int)
+        checksum = request.headers.get('X-Chunk-Sha256', '').lower()
+        length = request.content_length
+        if offset != status['offset']:
+            return jsonify({'error': 'Desplazamiento incorrecto', 'offset': status['offset']}), 409
+        if not checksum or not length or length > UPLOAD_CHUNK_MAX_BYTES or offset + length > status['size']:
+            return jsonify({'error': 'Fragmento no válido', 'offset': offset}), 400
+
+        part_path = _upload_part_path(upload_id)
+        digest = hashlib.sha256(); written = 0
+        with open(part_path, 'r+b' if os.path.exists(part_path) else 'wb') as f:
+            f.seek(offset); f.truncate()
+            while written < length:
+                block = request.stream.read(min(UPLOAD_STREAM_BLOCK_BYTES, length - written))
+                if not block: break
+                # La red se lee en el greenlet; el hash y la escritura van a un hilo del ejecutor
+                background.call(_append_block, f, digest, block, priority=TASK_PRIORITY_HIGH); written += len(block)
+            if written != length or digest.hexdigest() != checksum:
+                f.truncate(offset)
+                return jsonify({'error': 'Fragmento incompleto o suma de comprobación incorrecta', 'offset': offset}), 422
+            background.call(_sync_file, f, priority=TASK_PRIORITY_HIGH)
+
+        status['offset'] = offset + written
+        if status['offset'] == status['size']:
+            movie_path = os.path.join(app.config['UPLOAD_FOLDER'], status['filename'])
+            os.replace(part_path, movie_path)
+            status['status'] = UPLOAD_COMPLETE
+        db.execute("UPDATE uploads SET received = ?, status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (status['offset'], status['status'], upload_id))
+        if status['status'] == UPLOAD_COMPLETE:
+            # Ya anotada como completa: si el sondeo falla, la subida no vuelve a empezar desde cero
+            upload_log.info("'%s' recibido completo (%d bytes).", status['filename'], status['size'])
+            transcoder.submit(movie_path)
+            catalog_media(movie_path)
+        return jsonify(status)
+    finally:
+        upload_locks.pop(upload_id, None)
+        lock.release()
+
+@app.route('/upload/chunked/<upload_id>/poster', methods=['POST'])
+def upload_chunked_poster(upload_id):
+    if not is_admin(): return jsonify({'error': 'No autorizado'}), 403
+    poster_file = request.files.get('poster_file')
+    status = _upload_status(upload_id)
+    if not status or not poster_file or not allowed_image_file(poster_file.filename):
+        return jsonify({'error': 'Póster no válido'}), 400
+    save_poster(poster_file, status['filename'])
+    return jsonify(status)
+
 @app.route('/schedule_session', methods=['POST'])
 def schedule_session():
     if not is_admin(): return redirect(url_for('login'))
@@ -287,79 +2287,60 @@ def schedule_session():
     if not all([movie_title, scheduled_time_str, movie_file]):
         return redirect(url_for('admin_panel'))
 
-    # <-- INICIO DE LA LÓGICA CORREGIDA -->
-    try:
-        # Obtiene la ruta completa al archivo de vídeo
-        video_path = os.path.join(app.config['UPLOAD_FOLDER'], movie_file)
-        # Usa moviepy para abrir el vídeo y obtener su duración en segundos
-        with VideoFileClip(video_path) as clip:
-            movie_duration = int(clip.duration)
-        print(f"Duración detectada para '{movie_file}': {movie_duration} segundos.")
-    except Exception as e:
-        print(f"ADVERTENCIA: No se pudo obtener la duración de '{movie_file}'. Error: {e}. Usando 3600s por defecto.")
-        movie_duration = 3600
-    # <-- FIN DE LA LÓGICA CORREGIDA -->
+    # Duraciones desde el catálogo de medios (solo se sondea la cabecera si el fichero es nuevo o ha cambiado)
+    movie_duration = media_duration(os.path.join(app.config['UPLOAD_FOLDER'], movie_file))
+    intro_duration = media_duration(os.path.join('static', INTRO_VIDEO), default=5)
+    outro_duration = media_duration(os.path.join('static', OUTRO_VIDEO), default=5)
+    media_log.info("Duración detectada para '%s': %s segundos.", movie_file, movie_duration)
 
-    poster_file = None
-    for ext in ['jpg', 'png', 'jpeg', 'webp', 'gif']:
-        p_file = f"{movie_title}.{ext}"
-        if os.path.exists(os.path.join('static/posters', p_file)):
-            poster_file = p_file
-            break
+    poster = db.query_one("SELECT source FROM posters WHERE movie = ?", (movie_title,))
+    poster_file = os.path.basename(poster['source']) if poster else None
 
     # Ahora la playlist usa la duración correcta
     playlist = [
-        {'src': INTRO_VIDEO, 'duration': 5},
+        {'src': INTRO_VIDEO, 'duration': intro_duration},
         {'src': f'videos/{movie_file}', 'duration': movie_duration},
-        {'src': OUTRO_VIDEO, 'duration': 5} # He puesto 5s como dijiste
+        {'src': OUTRO_VIDEO, 'duration': outro_duration}
     ]
+    with_hls_manifests(playlist)
 
-    conn = get_db_connection()
-    conn.execute("INSERT INTO sessions (id, movie_title, movie_file, poster_file, playlist, scheduled_time, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                 (str(uuid.uuid4())[:8], movie_title, movie_file, poster_file, json.dumps(playlist), scheduled_time_str, STATUS_SCHEDULED))
-    conn.commit()
-    conn.close()
+    session_id = str(uuid.uuid4())[:8]
+    def insert(conn):
+        conn.execute("INSERT INTO sessions (id, movie_title, movie_file, poster_file, playlist, scheduled_time, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (session_id, movie_title, movie_file, poster_file, json.dumps(playlist), scheduled_time_str, STATUS_SCHEDULED))
+        return conn.execute(f"SELECT {ADMIN_SESSION_COLUMNS} FROM sessions WHERE id = ?", (session_id,)).fetchone()
+    s_db = db.run(insert, 'schedule_session')
+    cartelera_cache.invalidate()
+    schedule_monitor.track(session_id, datetime.fromisoformat(scheduled_time_str))
+    admin_feed.added(admin_session_row(s_db))
     return redirect(url_for('admin_panel'))
 
 @app.route('/delete_session/<session_id>', methods=['POST'])
 def delete_session(session_id):
     if not is_admin(): return redirect(url_for('login'))
-    with sessions_lock:
-        if session_id in active_sessions:
-            if 'projectionist_thread' in active_sessions[session_id]: active_sessions[session_id]['projectionist_thread'].stop()
-            del active_sessions[session_id]
-    conn = get_db_connection(); conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,)); conn.commit(); conn.close()
-    socketio.emit('admin_panel_update'); return redirect(url_for('admin_panel'))
+    schedule_monitor.cancel(session_id)
+    if not cluster.forward(session_id, 'delete_session', {}):
+        drop_session(session_id)
+    db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+    cartelera_cache.invalidate()
+    admin_feed.removed(session_id); return redirect(url_for('admin_panel'))
 
 @app.route('/vestibulo/<session_id>')
 def vestibulo(session_id):
     # Cargar sesión o crearla si es la primera vez que se entra
-    with sessions_lock:
-        if session_id in active_sessions:
-            s_data = active_sessions[session_id]
-            if s_data['state']['status'] == STATUS_ACTIVE: return redirect(url_for('watch_room', session_id=session_id))
-            time_to_start = (s_data['scheduled_time'] - datetime.now()).total_seconds()
-            return render_template("vestibulo.html", session_id=session_id, session_data=s_data, time_to_start=max(0, time_to_start), is_admin=is_admin())
+    s_data = active_sessions.get(session_id)
+    if s_data:
+        if s_data['snapshot']['state']['status'] == STATUS_ACTIVE: return redirect(url_for('watch_room', session_id=session_id))
+        time_to_start = (s_data['scheduled_time'] - datetime.now()).total_seconds()
+        return render_template("vestibulo.html", session_id=session_id, session_data=s_data, time_to_start=max(0, time_to_start), is_admin=is_admin())
 
     # Si no está en memoria, la cargamos de la DB
-    conn = get_db_connection(); s_db = conn.execute("SELECT * FROM sessions WHERE id = ? AND status != ?", (session_id, STATUS_FINISHED)).fetchone(); conn.close()
+    s_db = db.query_one("SELECT * FROM sessions WHERE id = ? AND status != ?", (session_id, STATUS_FINISHED))
     if s_db:
         scheduled_time = datetime.fromisoformat(s_db['scheduled_time'])
         open_time = scheduled_time - timedelta(minutes=VESTIBULE_OPEN_MINUTES)
         if datetime.now() >= open_time:
-            with sessions_lock:
-                if session_id not in active_sessions:
-                    print(f"[Session]: Creando sesión '{session_id}' en memoria desde la base de datos.")
-                    active_sessions[session_id] = {
-                        'db_id': s_db['id'], 'movie_title': s_db['movie_title'], 'poster_file': s_db['poster_file'],
-                        'playlist': json.loads(s_db['playlist']), 'scheduled_time': scheduled_time,
-                        'users': {'vestibule': {}, 'watch_room': {}},
-                        'chat': {'vestibule': [], 'watch_room': []},
-                        'state': {'status': STATUS_VESTIBULE, 'chat_enabled': True},
-                        'muted_users': set()
-                    }
-                    conn = get_db_connection(); conn.execute("UPDATE sessions SET status = ? WHERE id = ?", (STATUS_VESTIBULE, s_db['id'])); conn.commit(); conn.close()
-                    socketio.emit('admin_panel_update')
+            open_session(s_db) # Si la lleva otro worker, aquí basta una réplica para atender a quien entre por este
             return redirect(url_for('vestibulo', session_id=session_id))
     return render_template("error.html", message="El vestíbulo no está abierto o la sesión no existe.")
 
@@ -368,114 +2349,413 @@ def watch_room(session_id):
     # Simplemente renderiza la plantilla. La lógica de unión y estado se maneja por sockets.
     return render_template("watch_room.html", session_id=session_id, is_admin=is_admin())
 
+# --- Servido de vídeo con Range/If-Range y ETag fuerte ---
+def _read_file_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(length)
+
+def _read_at(f, start, length):
+    f.seek(start)
+    return f.read(length)
+
+class RangeReadCoalescer:
+    """
+    Lecturas de rangos de bytes compartidas, por bloques alineados de block_bytes. Las peticiones que caen
+    en el mismo bloque a la vez (todo el público buscando el mismo punto tras un 'state_change') esperan
+    a una única lectura del disco, hecha en un hilo del ejecutor, y los bloques recientes se quedan en una
+    LRU acotada por bytes.
+    """
+    def __init__(self, max_bytes, block_bytes):
+        self.max_bytes = max_bytes
+        self.block_bytes = block_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def read(self, path, etag, start, stop):
+        """Bytes [start, stop) sacados de los bloques que los contienen."""
+        first, last = start // self.block_bytes, (stop - 1) // self.block_bytes
+        blocks = [self._block(path, etag, index) for index in range(first, last + 1)]
+        data = blocks[0] if len(blocks) == 1 else b''.join(blocks)
+        offset = first * self.block_bytes
+        return data[start - offset:stop - offset]
+
+    def _block(self, path, etag, index):
+        key = (path, etag, index)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            pending = self._inflight.get(key)
+            if pending is None: self._inflight[key] = Event()
+        if pending is not None: return pending.wait()
+
+        done = self._inflight[key]
+        try:
+            data = background.call(_read_file_range, path, index * self.block_bytes, self.block_bytes, priority=TASK_PRIORITY_HIGH)
+        except Exception as e:
+            with self._lock: self._inflight.pop(key, None)
+            done.send_exception(e)
+            raise
+        with self._lock:
+            self._inflight.pop(key, None)
+            self._cache[key] = data; self._cached_bytes += len(data)
+            while self._cached_bytes > self.max_bytes and self._cache:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+        done.send(data)
+        return data
+
+media_range_reader = RangeReadCoalescer(MEDIA_RANGE_CACHE_BYTES, MEDIA_RANGE_BLOCK_BYTES)
+
+def _stream_file_range(path, start, stop):
+    with open(path, 'rb') as f:
+        while start < stop:
+            block = background.call(_read_at, f, start, min(MEDIA_STREAM_BLOCK_BYTES, stop - start), priority=TASK_PRIORITY_HIGH)
+            if not block: return
+            start += len(block)
+            yield block
+
+@app.route('/media/<folder>/<path:filename>')
+def serve_media(folder, filename):
+    """
+    Vídeos de la playlist. Con un proxy con X-Sendfile, o un servidor WSGI con 'wsgi.file_wrapper', se delega
+    en send_file para que la copia la haga el kernel. Con eventlet (que no lo ofrece) los rangos se sirven
+    aquí, leyendo en hilos del ejecutor: un rango abierto ('bytes=N-', lo que piden los navegadores al buscar)
+    se recorta al final de su bloque (un 206 más corto es válido y el navegador pide lo siguiente), así que
+    las búsquedas al mismo punto comparten lectura en RangeReadCoalescer.
+    """
+    path = safe_join(MEDIA_FOLDERS[folder], filename) if folder in MEDIA_FOLDERS else None
+    if not path or not os.path.isfile(path): abort(404)
+    stat = os.stat(path)
+    etag = f"{stat.st_size:x}-{stat.st_mtime_ns:x}" # Cambia si el fichero se reemplaza: ETag fuerte
+    max_age = IMMUTABLE_MAX_AGE_SECONDS if folder in IMMUTABLE_MEDIA_FOLDERS else MEDIA_MAX_AGE_SECONDS
+
+    if app.config['USE_X_SENDFILE'] or 'wsgi.file_wrapper' in request.environ:
+        return send_file(os.path.abspath(path), conditional=True, etag=etag, max_age=max_age)
+
+    response = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(int(stat.st_mtime), tz=timezone.utc)
+    response.accept_ranges = 'bytes'
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if folder in IMMUTABLE_MEDIA_FOLDERS: response.cache_control.immutable = True
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+
+    start, stop = 0, stat.st_size
+    if_range = request.if_range
+    range_applies = request.range and ((if_range.etag is None and if_range.date is None) or if_range.etag == etag
+                                       or (if_range.date and if_range.date >= response.last_modified))
+    if range_applies:
+        byte_range = request.range.range_for_length(stat.st_size)
+        if byte_range is None:
+            response.status_code = 416
+            response.headers['Content-Range'] = f"bytes */{stat.st_size}"
+            return response
+        start, stop = byte_range
+        if request.range.ranges[0][1] is None and request.range.ranges[0][0] >= 0: # 'bytes=N-'
+            stop = min(stop, (start // MEDIA_RANGE_BLOCK_BYTES + 1) * MEDIA_RANGE_BLOCK_BYTES)
+        response.status_code = 206
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{stat.st_size}"
+
+    if stop - start <= MEDIA_COALESCE_MAX_RANGE_BYTES:
+        response.set_data(media_range_reader.read(path, etag, start, stop))
+    else:
+        response.response = _stream_file_range(path, start, stop)
+        response.content_length = stop - start
+    return response
+
 # --- 6. LÓGICA DE PROYECCIÓN Y SOCKET.IO ---
 def start_projection(session_id):
-    with sessions_lock:
-        if session_id not in active_sessions or active_sessions[session_id]['state']['status'] != STATUS_VESTIBULE:
-            print(f"[Transition Aborted]: Intento de iniciar sesión {session_id}, pero su estado es '{active_sessions.get(session_id, {}).get('state', {}).get('status')}' en lugar de 'vestibule'.")
+    with locked_session(session_id) as s_data:
+        if not s_data or s_data.state['status'] != STATUS_VESTIBULE:
+            projection_log.warning("Intento de iniciar la sesión %s, pero su estado es '%s' en lugar de 'vestibule'.", session_id, s_data.state.get('status') if s_data else None)
             return
         
-        print(f"[Transition]: Iniciando proyección para sesión {session_id}. Actualizando estado a ACTIVE.")
-        s_data = active_sessions[session_id]
+        projection_log.info("Iniciando proyección para la sesión %s. Actualizando estado a ACTIVE.", session_id)
         
         # 1. Actualizar estado a ACTIVO
-        s_data['state'].update({
+        s_data.state.update({
             'status': STATUS_ACTIVE, 'playing': False, 'time': 0, 'current_video_index': 0
         })
+        publish_snapshot(s_data)
         
-        # 2. Notificar a los clientes del vestíbulo para que se muevan
-        socketio.emit('force_start_projection', to=f"{session_id}_vestibule")
+        # 2. Notificar a los clientes del vestíbulo para que se muevan (al soltar el cerrojo: nada de E/S con él tomado)
+        after_unlock(socketio.emit, 'force_start_projection', to=f"{session_id}_vestibule")
 
-        # 3. Iniciar el hilo del proyeccionista
-        projectionist = VirtualProjectionist(session_id)
-        projectionist.start()
-        s_data['projectionist_thread'] = projectionist
+        # 3. Registrar la sesión en el planificador de reproducción (sin plazos hasta que empiece a sonar)
+        projection_scheduler.schedule(session_id)
         
         # 4. Programar el inicio de la reproducción tras una cuenta atrás
+        s_data['countdown_ends_at'] = time.time() + 5
         def delayed_start(sid):
             # Emitir a la sala principal (donde estarán los de watch_room)
             socketio.emit('playback_starting', {'countdown': 5}, to=sid)
             socketio.sleep(5)
-            with sessions_lock:
-                if sid in active_sessions and active_sessions[sid]['state']['status'] == STATUS_ACTIVE:
-                    print(f"[Playback {sid}]: Cuenta atrás finalizada. Estableciendo 'playing' a True.")
-                    active_sessions[sid]['state']['playing'] = True
+            with locked_session(sid) as s:
+                if s and s.state['status'] == STATUS_ACTIVE:
+                    projection_log.info("Sesión %s: cuenta atrás finalizada. Estableciendo 'playing' a True.", sid)
+                    s.state['playing'] = True
+                    s['started_at'] = time.monotonic()
+                    s.pop('countdown_ends_at', None)
+                    projection_scheduler.schedule(sid)
+                    delta = state_delta(s)
+                    publish_snapshot(s)
                     # Notificar a todos los clientes del cambio de estado final (ahora con playing=True)
-                    socketio.emit('state_change', active_sessions[sid]['state'], to=sid)
+                    after_unlock(socketio.emit, 'state_change', delta, to=sid)
         
         socketio.start_background_task(target=delayed_start, sid=session_id)
         
         # 5. Actualizar la base de datos y el panel de admin
-        conn = get_db_connection()
-        conn.execute("UPDATE sessions SET status = ? WHERE id = ?", (STATUS_ACTIVE, session_id))
-        conn.commit(); conn.close()
-        socketio.emit('admin_panel_update')
-        print(f"[Transition]: El estado de la sesión {session_id} ahora es {s_data['state']}.")
+        session_status_writer.set(session_id, STATUS_ACTIVE)
+        admin_feed.mark(session_id)
+        projection_log.debug("El estado de la sesión %s ahora es %s.", session_id, s_data.state)
+
+class ChatFanout(DebouncedBatcher):
+    """
+    Difusión agrupada del chat. Los mensajes y las entradas/salidas de cada sala se acumulan
+    durante CHAT_BATCH_INTERVAL_SECONDS y se envían en un único frame por sala: 'new_messages'
+    con la lista de mensajes y un 'system_message' resumen ("12 personas se han unido.").
+    """
+    def __init__(self, interval):
+        super().__init__(interval)
+        self._pending = {}  # socket_room_id -> {'messages': [...], 'joined': [(username, sid)], 'left': [username]}
+
+    def _room(self, socket_room_id):
+        return self._pending.setdefault(socket_room_id, {'messages': [], 'joined': [], 'left': []})
+
+    def message(self, socket_room_id, msg):
+        with self._lock: self._room(socket_room_id)['messages'].append(msg)
+        self._notify()
+
+    def joined(self, socket_room_id, username, sid):
+        with self._lock: self._room(socket_room_id)['joined'].append((username, sid))
+        self._notify()
+
+    def left(self, socket_room_id, username):
+        with self._lock: self._room(socket_room_id)['left'].append(username)
+        self._notify()
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for socket_room_id, batch in pending.items():
+            if batch['joined']:
+                names = [username for username, _ in batch['joined']]
+                # Una sola entrada: no se le anuncia a quien acaba de entrar
+                skip_sid = batch['joined'][0][1] if len(names) == 1 else None
+                text = f"'{names[0]}' se ha unido." if len(names) == 1 else f"{len(names)} personas se han unido."
+                socketio.emit('system_message', {'text': text}, to=socket_room_id, skip_sid=skip_sid)
+            if batch['left']:
+                names = batch['left']
+                text = f"'{names[0]}' ha salido." if len(names) == 1 else f"{len(names)} personas han salido."
+                socketio.emit('system_message', {'text': text}, to=socket_room_id)
+            if batch['messages']:
+                EMIT_FANOUT.observe(room_size(socket_room_id), 'new_messages')
+                socketio.emit('new_messages', {'messages': batch['messages']}, to=socket_room_id)
+
+chat_fanout = ChatFanout(CHAT_BATCH_INTERVAL_SECONDS)
+
+def admin_live_fields(session_id, fallback_status=None):
+    """Estado y contadores en memoria de una sesión para el panel (desde la vista publicada, sin cerrojo)."""
+    snapshot = active_sessions.snapshot(session_id)
+    if snapshot:
+        vestibule, watch_room = cluster.viewer_counts(session_id) # Con varios workers, la suma de todos
+        return {'current_status_in_memory': snapshot['state'].get('status', 'N/A'),
+                'user_count_vestibule': vestibule, 'user_count_watch_room': watch_room}
+    if fallback_status is None: return None
+    return {'current_status_in_memory': fallback_status, 'user_count_vestibule': 0, 'user_count_watch_room': 0}
+
+class AdminFeed(DebouncedBatcher):
+    """
+    Actualizaciones en vivo del panel de administración por el namespace '/admin'.
+    Las sesiones que cambian se marcan y, pasada la ventana de agrupado, se emite un único
+    'sessions_delta' con solo los campos que difieren de lo último enviado, más las altas y bajas.
+    """
+    def __init__(self, interval):
+        super().__init__(interval)
+        self._dirty = {}      # session_id -> estado a mostrar si ya no está en memoria
+        self._added = {}
+        self._removed = set()
+        self._last_sent = {}
+
+    def mark(self, session_id, fallback_status=None):
+        with self._lock: self._dirty[session_id] = fallback_status or self._dirty.get(session_id)
+        self._notify()
+
+    def added(self, row):
+        with self._lock: self._added[row['id']] = row
+        self._notify()
+
+    def removed(self, session_id):
+        with self._lock:
+            self._removed.add(session_id)
+            self._added.pop(session_id, None); self._dirty.pop(session_id, None)
+        self._notify()
+
+    def _flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            added, self._added = self._added, {}
+            removed, self._removed = self._removed, set()
+        changed = {}
+        for session_id, fallback_status in dirty.items():
+            current = admin_live_fields(session_id, fallback_status)
+            if not current: continue
+            last = self._last_sent.setdefault(session_id, {})
+            diff = {key: value for key, value in current.items() if last.get(key) != value}
+            if diff:
+                changed[session_id] = diff
+                last.update(diff)
+        for session_id in removed: self._last_sent.pop(session_id, None)
+        if changed or added or removed:
+            socketio.emit('sessions_delta', {'changed': changed, 'added': list(added.values()), 'removed': list(removed)}, namespace='/admin')
+
+admin_feed = AdminFeed(ADMIN_FEED_INTERVAL_SECONDS)
+
+class TokenBucketLimiter:
+    """Límite de frecuencia por clave (sid): 'rate' fichas por segundo con ráfagas de hasta 'burst'."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # clave -> (fichas, instante de la última recarga)
+
+    def allow(self, key):
+        now = time.monotonic()
+        tokens, last = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return False
+        self._buckets[key] = (tokens - 1, now)
+        return True
+
+    def forget(self, key):
+        self._buckets.pop(key, None)
+
+chat_rate_limiter = TokenBucketLimiter(CHAT_RATE_PER_SECOND, CHAT_RATE_BURST)
 
 # --- 7. MANEJADORES DE EVENTOS SOCKET.IO ---
-@socketio.on('join')
+@timed_event('connect')
+def on_connect(auth=None):
+    # El cliente elige el formato de lo que se le difunde (auth.encoding); si no, o si falta msgpack, JSON
+    if isinstance(auth, dict): socketio.server.manager.negotiate(request.sid, auth.get('encoding'))
+
+@timed_event('connect', namespace='/admin')
+def on_admin_connect(auth=None):
+    # El namespace del panel solo admite sesiones de administrador
+    if not is_admin(): return False
+
+@timed_event('join')
 def on_join(data):
     session_id = data.get('session_id'); room_type = data.get('room_type')
     username = data.get('username', 'Anónimo').strip()[:25]; sid = request.sid
     if not all([session_id, room_type, username]): return
 
-    with sessions_lock:
-        if session_id not in active_sessions:
-            emit('force_disconnect', {'reason': 'La sesión ha finalizado.'}); return
+    # Si el socket estaba en otra sesión, sacarlo de ella antes de tomar el cerrojo de esta
+    previous = active_sessions.member(sid)
+    if previous and previous[0] != session_id: leave_session(sid)
+    # Sin sesiones pegajosas el socket puede caer en un worker que aún no conoce la sesión
+    if session_id not in active_sessions: cluster.load_replica(session_id)
+
+    with locked_session(session_id) as s:
+        if not s:
+            after_unlock(emit, 'force_disconnect', {'reason': 'La sesión ha finalizado.'}); return
         
-        s = active_sessions[session_id]
-        print(f"[Join]: Usuario '{username}' (sid: {sid}) se une a '{room_type}' en sesión '{session_id}'.")
+        socket_log.debug("Usuario '%s' (sid: %s) se une a '%s' en sesión '%s'.", username, sid, room_type, session_id)
         
         # Asignar a la sala de socket.io correcta
         socket_room_id = f"{session_id}_{room_type}" if room_type == 'vestibule' else session_id
         join_room(socket_room_id)
         
-        # Eliminar al usuario de otras salas de esta sesión si existiera
-        if sid in s['users']['vestibule']: del s['users']['vestibule'][sid]
-        if sid in s['users']['watch_room']: del s['users']['watch_room'][sid]
-        s['users'][room_type][sid] = username
+        # Eliminar al usuario de otras salas de esta sesión si existiera (conserva su Viewer si no cambia de nombre)
+        previous = active_sessions.member(sid)
+        viewer = s.users[previous[1]].pop(sid, None) if previous and previous[0] == session_id else None
+        if viewer is None or viewer.username != username: viewer = Viewer(sid, username)
+        s.users[room_type][sid] = viewer
+        active_sessions.bind(sid, session_id, room_type, viewer.username)
+        publish_snapshot(s)
 
-        emit('system_message', {'text': f"'{username}' se ha unido."}, to=socket_room_id, include_self=False)
+        chat_fanout.joined(socket_room_id, username, sid)
         
-        print(f"[State Sent]: Enviando 'initial_state' a '{username}'. Estado actual: {s['state']}")
-        emit('initial_state', {
+        # Solo los últimos mensajes; el resto se pide por páginas con 'chat_history_before'
+        chat_history = s.chat[room_type].recent(CHAT_JOIN_HISTORY)
+        socket_log.debug("Enviando 'initial_state' a '%s'. Estado actual: %s", username, s.state)
+        # Estado y playlist van en 'room_state', el mismo para todos; 'initial_state' lleva solo lo de este socket
+        after_unlock(socketio.server.manager.emit_cached, room_payload(s), sid)
+        after_unlock(emit, 'initial_state', {
             'my_sid': sid, 'my_username': username,
-            'chat_history': s['chat'].get(room_type, []),
-            'state': s['state'],
-            'playlist': s['playlist']
+            'chat_history': chat_history,
+            'chat_has_more': bool(chat_history) and s.chat[room_type].has_before(chat_history[0]['id'])
         })
-        socketio.emit('admin_panel_update')
+        admin_feed.mark(session_id)
 
-@socketio.on('chat_message')
+@timed_event('chat_message')
 def on_chat_message(data):
     session_id = data.get('session_id'); room_type = data.get('room_type')
     message_text = data.get('message', '').strip(); sid = request.sid
     if not all([session_id, room_type, message_text]): return
 
-    with sessions_lock:
-        if session_id not in active_sessions: return
-        s = active_sessions[session_id]
+    with locked_session(session_id) as s:
+        if not s: return
         
-        if not s['state'].get('chat_enabled', True): return
+        if not s.state.get('chat_enabled', True): return
         
-        username = s['users'].get(room_type, {}).get(sid)
-        if not username or username in s.get('muted_users', set()): return
+        viewer = s.users.get(room_type, {}).get(sid)
+        if not viewer or viewer.username in s.muted_users: return
+        if not chat_rate_limiter.allow(sid):
+            after_unlock(emit, 'system_message', {'text': 'Estás enviando mensajes demasiado rápido. Espera un momento.'})
+            return
 
-        msg = {'sid': sid, 'username': username, 'text': message_text}
-        s['chat'][room_type].append(msg)
-        
+        message = {'room_type': room_type, 'sid': sid, 'username': viewer.username, 'text': message_text}
+    # Ya sin el cerrojo: reenviarlo a otro worker es un INSERT en session_commands
+    if not cluster.forward(session_id, 'chat_message', message):
+        post_chat_message(session_id, message)
+
+def post_chat_message(session_id, message):
+    """Guarda el mensaje en el historial de su sala y lo difunde. Solo en el líder de la sesión."""
+    with locked_session(session_id) as s:
+        if not s: return
+        room_type = message['room_type']
+        # El autor suele seguir en la sala; si no (o el mensaje viene de otro worker) se crea uno para el mensaje
+        author = s.users[room_type].get(message['sid'])
+        if author is None or author.username != message['username']: author = Viewer(message['sid'], message['username'])
+        msg = s.chat[room_type].append(ChatMessage(author, message['text']))
+        live_state.mark(session_id, chat=True)
         socket_room_id = f"{session_id}_{room_type}" if room_type == 'vestibule' else session_id
-        emit('new_message', msg, to=socket_room_id)
+        chat_fanout.message(socket_room_id, msg.as_dict())
 
-@socketio.on('admin_action')
+@timed_event('chat_history_before')
+def on_chat_history_before(data):
+    """Página de mensajes anteriores a 'before_id' para quien ya está en esa sala."""
+    session_id = data.get('session_id'); room_type = data.get('room_type'); sid = request.sid
+    before_id = data.get('before_id'); limit = min(int(data.get('limit') or CHAT_PAGE_SIZE), CHAT_PAGE_SIZE)
+    if not isinstance(before_id, int) or room_type not in ('vestibule', 'watch_room'): return
+
+    with locked_session(session_id) as s:
+        if not s or sid not in s.users[room_type]: return
+        messages = s.chat[room_type].before(before_id, limit)
+        has_more = bool(messages) and s.chat[room_type].has_before(messages[0]['id'])
+    emit('chat_history_page', {'messages': messages, 'has_more': has_more})
+
+@timed_event('admin_action')
 def on_admin_action(data):
     if not is_admin(): return
     session_id = data.get('session_id'); action = data.get('action')
-    print(f"[Admin Action]: Recibida acción '{action}' para la sesión '{session_id}' con datos: {data}")
-    
-    with sessions_lock:
-        if session_id not in active_sessions: return
-        s = active_sessions[session_id]
+    admin_log.info("Recibida acción '%s' para la sesión '%s' con datos: %s", action, session_id, data)
+    if not cluster.forward(session_id, 'admin_action', data):
+        apply_admin_action(session_id, data)
+
+def apply_admin_action(session_id, data):
+    """Aplica una acción de administración ya autorizada. Solo en el líder de la sesión."""
+    action = data.get('action')
+    with locked_session(session_id) as s:
+        if not s: return
         
         # Las acciones de chat necesitan saber la sala (vestibulo o watch_room)
         room_type = data.get('room_type')
@@ -486,67 +2766,107 @@ def on_admin_action(data):
         
         elif action == 'state_change':
             # Aplicar solo a sesiones activas
-            if s['state']['status'] == STATUS_ACTIVE:
-                s['state'].update(data.get('state', {}))
-                socketio.emit('state_change', s['state'], to=session_id)
-                print(f"[Admin Action SUCCESS]: Estado de {session_id} cambiado a {s['state']}")
+            if s.state['status'] == STATUS_ACTIVE:
+                anchor_playback(s)
+                s.state.update(data.get('state', {}))
+                s['started_at'] = time.monotonic()
+                projection_scheduler.schedule(session_id)
+                delta = state_delta(s)
+                publish_snapshot(s)
+                after_unlock(socketio.emit, 'state_change', delta, to=session_id)
+                admin_log.info("Estado de %s cambiado a %s", session_id, s.state)
             else:
-                print(f"[Admin Action FAIL]: Se intentó cambiar el estado de la sesión {session_id}, pero no está 'active'. Estado actual: {s['state']['status']}")
+                admin_log.warning("Se intentó cambiar el estado de la sesión %s, pero no está 'active'. Estado actual: %s", session_id, s.state['status'])
         
         elif action == 'toggle_chat':
-            s['state']['chat_enabled'] = not s['state'].get('chat_enabled', True)
-            status_text = "activado" if s['state']['chat_enabled'] else "desactivado"
-            socketio.emit('chat_state_change', {'chat_enabled': s['state']['chat_enabled']}, to=socket_room_id)
-            socketio.emit('system_message', {'text': f"Un administrador ha {status_text} el chat."}, to=socket_room_id)
+            s.state['chat_enabled'] = not s.state.get('chat_enabled', True)
+            status_text = "activado" if s.state['chat_enabled'] else "desactivado"
+            publish_snapshot(s)
+            after_unlock(socketio.emit, 'chat_state_change', {'chat_enabled': s.state['chat_enabled']}, to=socket_room_id)
+            after_unlock(socketio.emit, 'system_message', {'text': f"Un administrador ha {status_text} el chat."}, to=socket_room_id)
 
         elif action == 'mute_user':
             username = data.get('username')
             if username:
-                s['muted_users'].add(username)
-                socketio.emit('system_message', {'text': f"'{username}' ha sido silenciado por un administrador."}, to=socket_room_id)
+                s.muted_users.add(username)
+                live_state.mark(session_id)
+                after_unlock(socketio.emit, 'system_message', {'text': f"'{username}' ha sido silenciado por un administrador."}, to=socket_room_id)
 
         elif action == 'ban_user':
             username = data.get('username'); sid_to_ban = data.get('sid')
             if sid_to_ban and username:
-                emit('force_disconnect', {'reason': 'Has sido baneado de la sesión por un administrador.'}, to=sid_to_ban)
-                disconnect(sid=sid_to_ban)
-                socketio.emit('system_message', {'text': f"'{username}' ha sido baneado por un administrador."}, to=socket_room_id)
+                leave_session(sid_to_ban)
+                after_unlock(socketio.emit, 'force_disconnect', {'reason': 'Has sido baneado de la sesión por un administrador.'}, to=sid_to_ban)
+                after_unlock(socketio.server.disconnect, sid_to_ban, namespace='/') # Con cola de mensajes llega al worker que tenga el socket
+                after_unlock(socketio.emit, 'system_message', {'text': f"'{username}' ha sido baneado por un administrador."}, to=socket_room_id)
 
-@socketio.on('request_state_sync')
+@timed_event('request_state_sync')
 def on_request_state(data):
     """
-    Un cliente pide el estado actual porque su vídeo se ha parado.
+    Un cliente pide el estado completo porque su vídeo se ha parado o ha visto un hueco en 'seq'.
+    Se responde desde la vista publicada, sin tomar el cerrojo de la sesión.
     """
     session_id = data.get('session_id')
     sid = request.sid
-    with sessions_lock:
-        if session_id in active_sessions:
-            s = active_sessions[session_id]
-            print(f"[Sync Request]: El usuario {sid} pide resincronización. Enviando estado actual.")
-            # Emitir solo al usuario que lo pidió
-            emit('state_change', s['state'], to=sid)
-
-@socketio.on('disconnect')
-def on_disconnect():
+    snapshot = active_sessions.snapshot(session_id)
+    if snapshot:
+        socket_log.debug("El usuario %s pide resincronización. Enviando estado actual.", sid)
+        # Emitir solo al usuario que lo pidió
+        emit('state_snapshot', state_snapshot(snapshot), to=sid)
+
+@timed_event('time_sync')
+def on_time_sync(data):
+    """Intercambio tipo NTP: con t0 (envío del cliente), t1 (recepción) y t2 (respuesta) el cliente calcula RTT y desfase."""
+    received = time.time()
+    emit('time_sync_reply', {'t0': data.get('t0'), 't1': received, 't2': time.time()})
+
+@timed_event('sync_report')
+def on_sync_report(data):
+    """
+    Un cliente se ha desviado más de lo que puede corregir variando playbackRate y ha tenido que saltar.
+    Recibe un ancla nueva y la sala vuelve a pulsos frecuentes hasta que se estabilice.
+    """
+    session_id = data.get('session_id')
+    snapshot = active_sessions.snapshot(session_id)
+    if not snapshot or snapshot['state'].get('status') != STATUS_ACTIVE or not snapshot['state'].get('playing'): return
+    emit('sync_pulse', pulse_payload(snapshot))
+    with locked_session(session_id) as s:
+        if s and s.get('pulse_interval', PULSE_INTERVAL_SECONDS) > PULSE_INTERVAL_SECONDS * 2:
+            projection_scheduler.schedule(session_id)
+
+def drop_session(session_id):
+    schedule_monitor.cancel(session_id)
+    if active_sessions.remove(session_id):
+        projection_scheduler.remove(session_id)
+
+# Comandos que los demás workers dejan al líder de una sesión en session_commands
+CLUSTER_COMMANDS = {
+    'chat_message': post_chat_message,
+    'admin_action': apply_admin_action,
+    'delete_session': lambda session_id, payload: drop_session(session_id),
+}
+
+@timed_event('disconnect')
+def on_disconnect(reason=None):
+    # python-socketio pasa el motivo; sin este argumento repite la llamada sin él y el evento se mediría dos veces
     sid = request.sid
-    with sessions_lock:
-        for session_id, s_data in active_sessions.items():
-            for room_type in ['vestibule', 'watch_room']:
-                if sid in s_data['users'][room_type]:
-                    username = s_data['users'][room_type].pop(sid)
-                    socket_room_id = f"{session_id}_{room_type}" if room_type == 'vestibule' else session_id
-                    emit('system_message', {'text': f"'{username}' ha salido."}, to=socket_room_id)
-                    print(f"Usuario '{username}' (sid: {sid}) desconectado de {room_type} en sesión {session_id}.")
-                    socketio.emit('admin_panel_update')
-                    return
+    chat_rate_limiter.forget(sid)
+    socketio.server.manager.forget(sid)
+    member = leave_session(sid)
+    if not member: return
+    session_id, room_type, username = member
+    socket_room_id = f"{session_id}_{room_type}" if room_type == 'vestibule' else session_id
+    chat_fanout.left(socket_room_id, username)
+    socket_log.debug("Usuario '%s' (sid: %s) desconectado de %s en sesión %s.", username, sid, room_type, session_id)
+    admin_feed.mark(session_id)
 
 # --- 8. INICIO DE LA APLICACIÓN ---
 if __name__ == '__main__':
     init_db()
-    # Iniciar el monitor de sesiones en segundo plano
-    scheduler_thread = threading.Thread(target=schedule_monitor)
-    scheduler_thread.daemon = True
-    scheduler_thread.start()
+    cluster.start()
+    restore_live_sessions()
+    schedule_monitor.start()
+    projection_scheduler.start()
     
     print("===============================================================")
     print("== INICIANDO SERVIDOR CON EVENTLET                           ==")
@@ -554,4 +2874,4 @@ if __name__ == '__main__':
     print("== Servidor disponible en http://127.0.0.1:5000              ==")
     print("===============================================================")
     
-    socketio.run(app, host='0.0.0.0', port=5000, use_reloader=False)
\ No newline at end of file
+    socketio.run(app, host='0.0.0.0', port=PORT, use_reloader=False, max_size=MAX_CONNECTIONS)
\ No newline at end of file
@@ -0,0 +1,35 @@
+# poster_worker.py
+
+# Lo que corre en los procesos del carril 'cpu' de peliculasv5_refactored.py. Un hijo 'spawn' importa
+# este módulo (y no la aplicación, que al importarse parchea con eventlet, crea SocketIO y arranca hilos),
+# así que aquí solo hay Pillow y funciones puras: nada se ejecuta al importarlo.
+import os
+import uuid
+
+from PIL import Image, ImageOps, features
+
+# Formato -> (nombre en Pillow, opciones de guardado). WebP solo si este Pillow lo sabe escribir.
+POSTER_FORMATS = {'webp': ('WEBP', {'method': 4}), 'jpeg': ('JPEG', {'optimize': True, 'progressive': True})}
+if not features.check('webp'): del POSTER_FORMATS['webp']
+
+def render_poster_variants(source, content_hash, folder, widths, quality):
+    """
+    Genera las variantes de un póster (widths x POSTER_FORMATS) en 'folder'.
+    Devuelve [(formato, ancho, alto, fichero)]; las que ya existen no se vuelven a escribir.
+    """
+    variants = []
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original).convert('RGB') # Un GIF animado se queda con su primer fotograma
+    widths = [width for width in widths if width <= image.width] or [image.width] # Nunca se amplía
+    for width in widths:
+        height = round(image.height * width / image.width)
+        resized = image.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+        for fmt, (pil_format, options) in POSTER_FORMATS.items():
+            filename = f"{content_hash[:20]}-{width}.{fmt}"
+            path = os.path.join(folder, filename)
+            if not os.path.exists(path):
+                partial = f"{path}.{uuid.uuid4().hex[:6]}.part" # Se escribe aparte y se renombra: nunca se sirve a medias
+                resized.save(partial, pil_format, quality=quality, **options)
+                os.replace(partial, path)
+            variants.append((fmt, width, height, filename))
+    return variants
@@ -5,13 +5,20 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!chatContainer) return;
 
     // --- 1. CONFIG & ELEMENTS ---
-    const socket = io();
+    // Solo WebSocket: el handshake y la conexión van a un mismo worker, así que no hacen falta sesiones pegajosas.
+    // Con socket_codec.js cargado las difusiones llegan en MessagePack (más compacto que JSON)
+    const socket = io({ transports: ['websocket'], ...(window.socketCodec ? window.socketCodec.options : {}) });
     const sessionId = chatContainer.dataset.sessionId;
     const roomType = chatContainer.dataset.roomType;
     const isAdmin = chatContainer.dataset.isAdmin === 'true';
     let mySid = '';
     // NUEVO: Variable para guardar el estado de la moderación
     let moderationState = { muted: [], banned: [] };
+    // Paginación del historial: el servidor solo envía los últimos mensajes al unirse
+    let oldestMessageId = null, hasMoreHistory = false, loadingHistory = false;
+    // El último mensaje mostrado: un mensaje que llega en el historial del 'join' puede volver a llegar en el siguiente lote
+    let newestMessageId = null;
+    let joinedAs = null; // Al reconectar (p. ej. tras reiniciar el servidor) se vuelve a entrar con el mismo nombre
 
     const elements = {
         headerText: document.getElementById('chat-header-text'),
@@ -27,7 +34,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- 2. CORE FUNCTIONS ---
     function autoJoinWithTempName() {
-        const tempUser = `user_${Math.floor(Math.random() * 10000)}`;
+        const tempUser = joinedAs || `user_${Math.floor(Math.random() * 10000)}`;
+        joinedAs = tempUser;
         sessionStorage.setItem('cinesaUsername', tempUser);
         socket.emit('join', { 'session_id': sessionId, 'room_type': roomType, 'username': tempUser });
     }
@@ -36,6 +44,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const username = elements.usernameInput.value.trim();
         if (username) {
             sessionStorage.setItem('cinesaUsername', username);
+            joinedAs = username;
             socket.emit('set_username', { session_id: sessionId, room_type: roomType, username: username });
             if(elements.usernameArea) elements.usernameArea.style.display = 'none';
             if(elements.inputArea) elements.inputArea.style.display = 'flex';
@@ -51,11 +60,11 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    function addMessageToChat(msg, isHistory = false) {
+    function addMessageToChat(msg, isHistory = false, prepend = false) {
         if (!elements.chatBox) return;
         const wrapper = document.createElement('div');
         // NUEVO: Asignar un ID al contenedor del mensaje para poder borrarlo
-        wrapper.id = msg.id;
+        wrapper.id = `msg-${msg.id}`;
         wrapper.classList.add('message-wrapper', msg.sid === mySid ? 'my-message' : 'other-message');
 
         const avatar = document.createElement('div');
@@ -92,7 +101,8 @@ document.addEventListener('DOMContentLoaded', () => {
         messageContent.appendChild(bubble);
         wrapper.appendChild(avatar);
         wrapper.appendChild(messageContent);
-        elements.chatBox.appendChild(wrapper);
+        if (prepend) elements.chatBox.insertBefore(wrapper, elements.chatBox.firstChild);
+        else elements.chatBox.appendChild(wrapper);
 
         if (!isHistory) {
             elements.chatBox.scrollTop = elements.chatBox.scrollHeight;
@@ -170,11 +180,18 @@ document.addEventListener('DOMContentLoaded', () => {
         setTimeout(() => document.body.addEventListener('click', () => menu.remove(), { once: true }), 0);
     }
 
+    function requestOlderMessages() {
+        if (!hasMoreHistory || loadingHistory || oldestMessageId === null) return;
+        loadingHistory = true;
+        socket.emit('chat_history_before', { session_id: sessionId, room_type: roomType, before_id: oldestMessageId });
+    }
+
     // --- 3. EVENT LISTENERS ---
     elements.joinBtn?.addEventListener('click', sendUsername);
     elements.usernameInput?.addEventListener('keyup', (e) => { if (e.key === 'Enter') sendUsername(); });
     elements.sendBtn?.addEventListener('click', sendChatMessage);
     elements.chatInput?.addEventListener('keyup', (e) => { if (e.key === 'Enter') sendChatMessage(); });
+    elements.chatBox?.addEventListener('scroll', () => { if (elements.chatBox.scrollTop < 40) requestOlderMessages(); });
 
     if (isAdmin && elements.toggleChatBtn) {
         elements.toggleChatBtn.addEventListener('click', () => {
@@ -187,17 +204,40 @@ document.addEventListener('DOMContentLoaded', () => {
         mySid = data.my_sid;
         elements.chatBox.innerHTML = '';
         data.chat_history.forEach(msg => addMessageToChat(msg, true));
-        updateChatState(data.state.chat_enabled);
+        oldestMessageId = data.chat_history.length ? data.chat_history[0].id : null;
+        newestMessageId = data.chat_history.length ? data.chat_history[data.chat_history.length - 1].id : null;
+        hasMoreHistory = data.chat_has_more;
+        loadingHistory = false;
         if (elements.chatBox) elements.chatBox.scrollTop = elements.chatBox.scrollHeight;
     });
 
-    socket.on('new_message', (msg) => addMessageToChat(msg));
+    // El estado de la sala llega justo antes de 'initial_state', compartido con todos los que se unen
+    socket.on('room_state', (data) => updateChatState(data.state.chat_enabled));
+
+    // Los mensajes llegan agrupados por sala en frames 'new_messages'
+    socket.on('new_messages', (data) => {
+        const messages = newestMessageId === null ? data.messages : data.messages.filter(msg => msg.id > newestMessageId);
+        if (!messages.length) return;
+        if (oldestMessageId === null) oldestMessageId = messages[0].id;
+        newestMessageId = messages[messages.length - 1].id;
+        messages.forEach(msg => addMessageToChat(msg));
+    });
+
+    // Página de historial antiguo: se inserta arriba sin mover lo que el usuario está leyendo
+    socket.on('chat_history_page', (data) => {
+        const previousHeight = elements.chatBox.scrollHeight;
+        data.messages.slice().reverse().forEach(msg => addMessageToChat(msg, true, true));
+        elements.chatBox.scrollTop += elements.chatBox.scrollHeight - previousHeight;
+        if (data.messages.length) oldestMessageId = data.messages[0].id;
+        hasMoreHistory = data.has_more;
+        loadingHistory = false;
+    });
     socket.on('system_message', (data) => addSystemMessage(data.text));
     socket.on('chat_state_change', (data) => updateChatState(data.chat_enabled));
     
     // NUEVO: Listener para borrar un mensaje del DOM
     socket.on('message_deleted', (data) => {
-        const msgElement = document.getElementById(data.id);
+        const msgElement = document.getElementById(`msg-${data.id}`);
         if (msgElement) {
             msgElement.style.transition = 'opacity 0.3s, transform 0.3s';
             msgElement.style.opacity = '0';
@@ -221,5 +261,5 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- 5. INITIALIZATION ---
     window.chatApp = { socket, join: sendUsername };
-    autoJoinWithTempName();
+    socket.on('connect', autoJoinWithTempName);
 });
\ No newline at end of file
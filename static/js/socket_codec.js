@@ -0,0 +1,95 @@
+// static/js/socket_codec.js
+
+// Parser de Socket.IO que acepta las difusiones del servidor en MessagePack (frames binarios) además de
+// en JSON (frames de texto). El cliente lo pide al conectar con auth.encoding = 'msgpack'; si el servidor
+// no tiene msgpack sigue enviando JSON y todo funciona igual. Lo que envía el cliente va siempre en JSON.
+(() => {
+    const utf8 = new TextDecoder();
+
+    // --- 1. DECODIFICADOR DE MESSAGEPACK (solo los tipos que produce el servidor: sin extensiones) ---
+    function unpack(buffer) {
+        const bytes = buffer instanceof ArrayBuffer ? new Uint8Array(buffer) : new Uint8Array(buffer.buffer, buffer.byteOffset, buffer.byteLength);
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let offset = 0;
+
+        function take(length) { const start = offset; offset += length; return start; }
+        function str(length) { const start = take(length); return utf8.decode(bytes.subarray(start, start + length)); }
+        function bin(length) { const start = take(length); return bytes.slice(start, start + length).buffer; }
+        function array(length) { const items = new Array(length); for (let i = 0; i < length; i++) items[i] = read(); return items; }
+        function map(length) { const obj = {}; for (let i = 0; i < length; i++) { const key = read(); obj[key] = read(); } return obj; }
+
+        function read() {
+            const byte = view.getUint8(take(1));
+            if (byte <= 0x7f) return byte;
+            if (byte <= 0x8f) return map(byte & 0x0f);
+            if (byte <= 0x9f) return array(byte & 0x0f);
+            if (byte <= 0xbf) return str(byte & 0x1f);
+            if (byte >= 0xe0) return byte - 0x100;
+            switch (byte) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return bin(view.getUint8(take(1)));
+                case 0xc5: return bin(view.getUint16(take(2)));
+                case 0xc6: return bin(view.getUint32(take(4)));
+                case 0xca: return view.getFloat32(take(4));
+                case 0xcb: return view.getFloat64(take(8));
+                case 0xcc: return view.getUint8(take(1));
+                case 0xcd: return view.getUint16(take(2));
+                case 0xce: return view.getUint32(take(4));
+                case 0xcf: return Number(view.getBigUint64(take(8)));
+                case 0xd0: return view.getInt8(take(1));
+                case 0xd1: return view.getInt16(take(2));
+                case 0xd2: return view.getInt32(take(4));
+                case 0xd3: return Number(view.getBigInt64(take(8)));
+                case 0xd9: return str(view.getUint8(take(1)));
+                case 0xda: return str(view.getUint16(take(2)));
+                case 0xdb: return str(view.getUint32(take(4)));
+                case 0xdc: return array(view.getUint16(take(2)));
+                case 0xdd: return array(view.getUint32(take(4)));
+                case 0xde: return map(view.getUint16(take(2)));
+                case 0xdf: return map(view.getUint32(take(4)));
+            }
+            throw new Error(`MessagePack: tipo 0x${byte.toString(16)} no soportado`);
+        }
+        return read();
+    }
+
+    // --- 2. PARSER PARA SOCKET.IO-CLIENT ---
+    // Texto: <tipo>[<nsp>,][<id>][<json>], el formato estándar de Socket.IO (sin adjuntos binarios)
+    const TEXT_PACKET = /^(\d)(?:(\/[^,]*),)?(\d+)?([\s\S]*)$/;
+
+    class Encoder {
+        encode(packet) {
+            const nsp = packet.nsp && packet.nsp !== '/' ? `${packet.nsp},` : '';
+            const id = packet.id !== undefined && packet.id !== null ? packet.id : '';
+            const data = packet.data !== undefined ? JSON.stringify(packet.data) : '';
+            return [`${packet.type}${nsp}${id}${data}`];
+        }
+    }
+
+    class Decoder {
+        constructor() { this.listeners = []; }
+        on(event, fn) { if (event === 'decoded') this.listeners.push(fn); return this; }
+        off(event, fn) { this.listeners = fn ? this.listeners.filter(l => l !== fn) : []; return this; }
+        add(chunk) {
+            let packet;
+            if (typeof chunk === 'string') {
+                const match = TEXT_PACKET.exec(chunk);
+                if (!match) throw new Error(`Paquete de Socket.IO no válido: ${chunk}`);
+                packet = { type: Number(match[1]), nsp: match[2] || '/' };
+                if (match[3] !== undefined) packet.id = Number(match[3]);
+                if (match[4]) packet.data = JSON.parse(match[4]);
+            } else {
+                const decoded = unpack(chunk);
+                packet = { type: decoded.type, nsp: decoded.nsp || '/', data: decoded.data };
+                if (decoded.id !== undefined && decoded.id !== null) packet.id = decoded.id;
+            }
+            this.listeners.slice().forEach(fn => fn(packet));
+        }
+        destroy() { this.listeners = []; }
+    }
+
+    // Opciones para io(): el parser y la petición de MessagePack al servidor
+    window.socketCodec = { options: { parser: { protocol: 5, Encoder, Decoder }, auth: { encoding: 'msgpack' } } };
+})();